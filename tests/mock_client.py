@@ -1,5 +1,7 @@
 #! python
 
+import datetime
+import hashlib
 import logging
 import os
 
@@ -17,6 +19,9 @@ from waste.handler.shared import (
 
 from botocore.exceptions import ClientError as BotocoreClientError
 
+# All objects in the simulated bucket share a modification time
+MOCK_LAST_MODIFIED = datetime.datetime(2020,1,1,tzinfo=datetime.timezone.utc)
+
 MockClientInstruction = namedtuple('MockClientInstruction', 'op_name outcome extra')
 
 class MockClient:
@@ -38,6 +43,8 @@ class MockS3Client(MockClient):
     def __init__(self, simulated_bucket_contents = [],envvars={}):
         super().__init__()
         self.bucket_sim = { }        
+        self.get_object_calls = []
+        self.head_object_calls = []
         set_mock_s3_client(self)
         for content_item in simulated_bucket_contents:
             self.mock_put_object(*content_item)
@@ -48,7 +55,21 @@ class MockS3Client(MockClient):
         super().dispose()
     def mock_put_object(self, key, content_type, body ):
         self.bucket_sim[key] = ( content_type, body )
-    def get_object(self,Bucket,Key):
+    def head_object(self,Bucket,Key):
+        self.head_object_calls += [ Key ]
+        if Key not in self.bucket_sim:
+            error_response = { "Error": { "Code": "404" } }
+            raise BotocoreClientError(error_response,"head_object")
+        response_details = self.bucket_sim[Key]
+        return {
+            "ResponseMetadata": { "HTTPStatusCode": 200 },
+            JSON_CONTENT_TYPE_KEY: response_details[0],
+            "ETag": '"%s"' % (hashlib.md5(response_details[1]).hexdigest(),),
+            "LastModified": MOCK_LAST_MODIFIED,
+            "ContentLength": len(response_details[1])
+        }
+    def get_object(self,Bucket,Key,Range=None,IfMatch=None,IfNoneMatch=None):
+        self.get_object_calls += [ ( Key, Range ) ]
         if len(self.instructions) > 0:
             op_name, outcome, extra = self.instructions.pop(0)
             assert op_name == "get_object"
@@ -57,11 +78,45 @@ class MockS3Client(MockClient):
             raise BotocoreClientError(error_response,"get_object")
         elif Key in self.bucket_sim:
             response_details = self.bucket_sim[Key]
-            return {
+            response = {
                 "ResponseMetadata": { "HTTPStatusCode": 200 },
                 JSON_CONTENT_TYPE_KEY: response_details[0],
+                "ETag": '"%s"' % (hashlib.md5(response_details[1]).hexdigest(),),
+                "LastModified": MOCK_LAST_MODIFIED,
+                "ContentLength": len(response_details[1]),
                 "Body" : BytesIO(response_details[1])
             }
+            if IfNoneMatch is not None and IfNoneMatch == response["ETag"]:
+                error_response = {
+                    "Error": { "Code": "304", "Message": "Not Modified" },
+                    "ResponseMetadata": { "HTTPStatusCode": 304 }
+                }
+                raise BotocoreClientError(error_response,"get_object")
+            if IfMatch is not None and IfMatch != response["ETag"]:
+                error_response = { "Error": { "Code": "PreconditionFailed" } }
+                raise BotocoreClientError(error_response,"get_object")
+            if Range is not None:
+                body = response_details[1]
+                first, _, last = Range[len("bytes="):].partition("-")
+                if len(first) == 0:
+                    first = max(0, len(body) - int(last))
+                    last = len(body) - 1
+                else:
+                    first = int(first)
+                    last = min(len(body) - 1, int(last or len(body) - 1))
+                if first >= len(body):
+                    error_response = { "Error": {
+                        "Code": "InvalidRange",
+                        "ActualObjectSize": str(len(body))
+                    } }
+                    raise BotocoreClientError(error_response,"get_object")
+                response["ResponseMetadata"]["HTTPStatusCode"] = 206
+                response["ContentLength"] = last + 1 - first
+                response["ContentRange"] = "bytes %d-%d/%d" % (
+                    first, last, len(body)
+                )
+                response["Body"] = BytesIO(body[first:last + 1])
+            return response
         elif True:
             return { "ResponseMetadata": { "HTTPStatusCode": 403 } }
         else:
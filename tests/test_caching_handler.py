@@ -1,11 +1,15 @@
 #! python
 
 import base64
+import datetime
+import gzip
 import hashlib
 import io
+import json
 import logging
 import os
 import random
+import time
 import zipfile
 
 import requests
@@ -20,11 +24,30 @@ from waste.handler.shared import (
     ENVVAR_CONTENT_BUCKET_NAME, 
     ENVVAR_DEFAULT_DOCUMENT_NAME,
     ENVVAR_CACHE_OBJECT_NAME,
+    ENVVAR_CACHE_SPOOL_DIR,
+    ENVVAR_CACHE_LAZY,
+    ENVVAR_CACHE_RELOAD_INTERVAL,
+    ENVVAR_CACHE_SHARDS,
+    cache_memory_budget,
+    cache_memory_fraction,
     serialize_object_for_log,
     override_max_body_length,
+    build_positive_response,
+    apply_if_range,
+    negotiate_content_encoding,
     debug_log
 )
 
+from waste.handler.cache_control import ENVVAR_CACHE_CONTROL_POLICY
+from waste.handler.streaming import collect_streamed_response
+from waste.handler.wpack import write_wpack
+from waste.deploy.content_support import (
+    build_cache_archive,
+    cache_archive_report
+)
+import waste.deploy.content_support
+from waste.handler.metrics import ENVVAR_EMIT_METRICS, ENVVAR_SERVER_TIMING
+
 from simulated_content_generation import (
     gen_random_byte_sequence,
     SIMULATED_CACHE_CONTENTS,
@@ -175,3 +198,1205 @@ def test_cached_large_document():
     )]
     template_test_method('cached_10M',206,10000000,test_specific_bucket_content,1)
 
+
+def test_unaligned_range_start_encodes_only_requested_fragment():
+    print("") # close the line containing the '.' emitted by pytest
+    override_max_body_length(400)
+    doc_bytes = SIMULATED_CACHE_CONTENTS["cached_10k"]
+    response = build_positive_response(
+        io.BytesIO(doc_bytes), "bytes=1001-", len(doc_bytes)
+    )
+    override_max_body_length()
+    assert 206 == response["statusCode"]
+    assert response["isBase64Encoded"] is True
+    assert 400 == len(response["body"])
+    assert doc_bytes[1001:1301] == base64.b64decode(response["body"])
+    assert "bytes 1001-1300/10000" == response["headers"]["Content-Range"]
+
+def test_text_fragment_does_not_split_multibyte_character():
+    print("") # close the line containing the '.' emitted by pytest
+    override_max_body_length(8)
+    doc_bytes = bytes("abcdefgö","utf-8") + bytes("xyz","utf-8")
+    response = build_positive_response(io.BytesIO(doc_bytes), "bytes=0-")
+    override_max_body_length()
+    assert 206 == response["statusCode"]
+    assert "abcdefg" == response["body"]
+    assert "bytes 0-6/12" == response["headers"]["Content-Range"]
+
+def test_bounded_suffix_and_unsatisfiable_ranges():
+    print("") # close the line containing the '.' emitted by pytest
+    doc_bytes = SIMULATED_CACHE_CONTENTS["cached_10k"]
+    response = build_positive_response(io.BytesIO(doc_bytes), "bytes=10-19")
+    assert 206 == response["statusCode"]
+    assert doc_bytes[10:20] == base64.b64decode(response["body"])
+    assert "bytes 10-19/10000" == response["headers"]["Content-Range"]
+    response = build_positive_response(io.BytesIO(doc_bytes), "bytes=-100")
+    assert doc_bytes[-100:] == base64.b64decode(response["body"])
+    assert "bytes 9900-9999/10000" == response["headers"]["Content-Range"]
+    response = build_positive_response(io.BytesIO(doc_bytes), "bytes=10000-")
+    assert 416 == response["statusCode"]
+    assert "bytes */10000" == response["headers"]["Content-Range"]
+    # Malformed range specs are ignored
+    response = build_positive_response(io.BytesIO(doc_bytes), "bytes=20-10")
+    assert 200 == response["statusCode"]
+    for range_spec in ("bytes=\u00b2-3", "bytes=\u0661-3", "bytes=+1-3"):
+        response = build_positive_response(io.BytesIO(doc_bytes), range_spec)
+        assert 200 == response["statusCode"], range_spec
+
+def test_non_ascii_digit_range_ignored_by_handler():
+    print("") # close the line containing the '.' emitted by pytest
+    mock_s3_client = MockS3Client(simulated_bucket_contents = SIMULATED_BUCKET_CONTENTS)
+    waste.handler.caching_lambda_handler.invalidate_cache_for_test()
+    try:
+        doc_response = waste.handler.caching_lambda_handler.lambda_handler({
+            "requestContext": {
+                "http": { "method": "GET", "path": "/cached_10k" }
+            },
+            "body": "",
+            "headers": { "Range": "bytes=\u00b2-3" }
+        },context=None)
+    finally:
+        mock_s3_client.dispose()
+    assert 200 == doc_response["statusCode"]
+    assert "Content-Range" not in doc_response["headers"]
+
+def test_multiple_ranges():
+    print("") # close the line containing the '.' emitted by pytest
+    doc_bytes = bytes("0123456789abcdefghij","utf-8")
+    response = build_positive_response(
+        io.BytesIO(doc_bytes), "bytes=0-1, 15-, 1-3", content_type="text/plain"
+    )
+    assert 206 == response["statusCode"]
+    content_type = response["headers"]["Content-Type"]
+    assert content_type.startswith("multipart/byteranges; boundary=")
+    boundary = content_type.split("=")[1]
+    parts = response["body"].split("--" + boundary)
+    assert 4 == len(parts)
+    assert parts[1].endswith("Content-Range: bytes 0-3/20\r\n\r\n0123\r\n")
+    assert parts[2].endswith("Content-Range: bytes 15-19/20\r\n\r\nfghij\r\n")
+    assert "--\r\n" == parts[3]
+
+def test_if_range():
+    print("") # close the line containing the '.' emitted by pytest
+    last_modified = datetime.datetime(2020,1,1,tzinfo=datetime.timezone.utc)
+    etag = '"abc"'
+    assert "bytes=5-" == apply_if_range("bytes=5-", None, etag)
+    assert "bytes=5-" == apply_if_range("bytes=5-", '"abc"', etag)
+    assert apply_if_range("bytes=5-", '"abd"', etag) is None
+    assert apply_if_range("bytes=5-", 'W/"abc"', etag) is None
+    assert "bytes=5-" == apply_if_range(
+        "bytes=5-", "Wed, 01 Jan 2020 00:00:00 GMT", etag, last_modified
+    )
+    assert apply_if_range(
+        "bytes=5-", "Thu, 02 Jan 2020 00:00:00 GMT", etag, last_modified
+    ) is None
+    # Without validators the precondition can never be confirmed
+    assert apply_if_range("bytes=5-", '"abc"') is None
+
+def test_cache_entry_classification_and_encoded_body_retention():
+    print("") # close the line containing the '.' emitted by pytest
+    cache = waste.handler.caching_lambda_handler.Cache()
+    cache.load_from_stream(
+        "cache.zip",build_cache_stream(SIMULATED_CACHE_CONTENTS)
+    )
+    assert ("Göteborg", False) == cache.encoded_body("cached_non_ascii_text_utf8")
+    assert cache.entry_is_text["cached_non_ascii_text_utf8"] is True
+    assert cache.encoded_body("cached_non_ascii_text_latin1")[1] is True
+    assert cache.entry_is_text["cached_non_ascii_text_latin1"] is False
+    body_str, body_is_base64 = cache.encoded_body("cached_10k")
+    assert body_is_base64 is True
+    assert cache.entry_is_text["cached_10k"] is False
+    # The encoded form is only retained once an entry has been
+    # requested more than once
+    assert "cached_10k" not in cache._encoded_bodies
+    assert body_str == cache.encoded_body("cached_10k")[0]
+    assert "cached_10k" in cache._encoded_bodies
+
+def test_range_of_unadmitted_entry_not_read_whole(monkeypatch):
+    print("") # close the line containing the '.' emitted by pytest
+    # With 1MB of memory the entry cache does not admit cached_100k,
+    # so it is streamed from the archive
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE","1")
+    entries_read = []
+    read_member = waste.handler.caching_lambda_handler.Cache._read_member
+    def recording_read_member(cache, file_name):
+        entries_read.append(file_name)
+        return read_member(cache, file_name)
+    monkeypatch.setattr(
+        waste.handler.caching_lambda_handler.Cache, "_read_member",
+        recording_read_member
+    )
+    mock_s3_client = MockS3Client(
+        simulated_bucket_contents = SIMULATED_BUCKET_CONTENTS,
+        envvars = {
+            ENVVAR_CONTENT_BUCKET_NAME: "test1_bucket",
+            ENVVAR_CACHE_OBJECT_NAME: "cache.zip"
+        }
+    )
+    waste.handler.caching_lambda_handler.invalidate_cache_for_test()
+    try:
+        range_response = waste.handler.caching_lambda_handler.lambda_handler({
+            "requestContext": {
+                "http": { "method": "GET", "path": "/cached_100k" }
+            },
+            "body": "",
+            "headers": { "Range": "bytes=0-99" }
+        },context=None)
+    finally:
+        waste.handler.caching_lambda_handler.invalidate_cache_for_test()
+        mock_s3_client.dispose()
+    assert 206 == range_response["statusCode"]
+    assert expected_bytes_for_docpath("/cached_100k")[:100] == base64.b64decode(
+        range_response["body"]
+    )
+    assert "cached_100k" not in entries_read
+
+def test_response_memo():
+    print("") # close the line containing the '.' emitted by pytest
+    memo = waste.handler.caching_lambda_handler.ResponseMemo(byte_budget=4000)
+    response = { "statusCode": 200, "headers": {}, "body": "x" * 1000 }
+    assert memo.get(("/a", None)) is None
+    memo.put(("/a", None), response)
+    memo.put(("/b", None), response)
+    memo_response = memo.get(("/a", None))
+    assert response == memo_response
+    # Headers added by the caller do not leak into the memo
+    memo_response["headers"]["Server-Timing"] = "x"
+    assert "Server-Timing" not in memo.get(("/a", None))["headers"]
+    # /b is now least recently used so is evicted first
+    memo.put(("/c", None), response)
+    assert memo.get(("/b", None)) is None
+    stats = memo.stats()
+    assert (2, 2, 1, 2) == (
+        stats["hits"], stats["misses"], stats["evictions"], stats["entries"]
+    )
+    assert stats["bytes_used"] <= stats["byte_budget"]
+
+def test_repeated_request_served_from_response_memo():
+    print("") # close the line containing the '.' emitted by pytest
+    template_test_method('/cached_10k',200,10000)
+    mock_s3_client = MockS3Client(simulated_bucket_contents = SIMULATED_BUCKET_CONTENTS)
+    doc_event = {
+        "requestContext": {
+            "http": { "method": "GET", "path": "/cached_10k" }
+        },
+        "body": "",
+        "headers": {}
+    }
+    doc_response = waste.handler.caching_lambda_handler.lambda_handler(
+        doc_event,context=None
+    )
+    mock_s3_client.dispose()
+    assert 200 == doc_response["statusCode"]
+    stats = waste.handler.caching_lambda_handler.response_memo_stats()
+    assert 1 == stats["hits"]
+    assert 1 == stats["misses"]
+
+def test_validators_and_not_modified():
+    print("") # close the line containing the '.' emitted by pytest
+    mock_s3_client = MockS3Client(simulated_bucket_contents = SIMULATED_BUCKET_CONTENTS)
+    waste.handler.caching_lambda_handler.invalidate_cache_for_test()
+    doc_event = {
+        "requestContext": {
+            "http": { "method": "GET", "path": "/cached_10k" }
+        },
+        "body": "",
+        "headers": {}
+    }
+    doc_response = waste.handler.caching_lambda_handler.lambda_handler(
+        doc_event,context=None
+    )
+    assert 200 == doc_response["statusCode"]
+    etag = doc_response["headers"]["ETag"]
+    last_modified = doc_response["headers"]["Last-Modified"]
+    assert etag.startswith('"') and etag.endswith('-2710"')
+    for conditional_headers in (
+        { "If-None-Match": etag },
+        { "if-none-match": '"other", W/' + etag },
+        { "If-None-Match": "*" },
+        { "If-Modified-Since": last_modified },
+    ):
+        doc_event["headers"] = conditional_headers
+        doc_response = waste.handler.caching_lambda_handler.lambda_handler(
+            doc_event,context=None
+        )
+        assert 304 == doc_response["statusCode"], conditional_headers
+        assert "body" not in doc_response
+        assert etag == doc_response["headers"]["ETag"]
+    for conditional_headers in (
+        { "If-None-Match": '"other"' },
+        { "If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT" },
+        # If-Modified-Since is ignored when If-None-Match is present
+        { "If-None-Match": '"other"', "If-Modified-Since": last_modified },
+    ):
+        doc_event["headers"] = conditional_headers
+        doc_response = waste.handler.caching_lambda_handler.lambda_handler(
+            doc_event,context=None
+        )
+        assert 200 == doc_response["statusCode"], conditional_headers
+    # The cache's validators are now usable with If-Range
+    doc_event["headers"] = { "Range": "bytes=9990-", "If-Range": etag }
+    doc_response = waste.handler.caching_lambda_handler.lambda_handler(
+        doc_event,context=None
+    )
+    mock_s3_client.dispose()
+    assert 206 == doc_response["statusCode"]
+    assert "bytes 9990-9999/10000" == doc_response["headers"]["Content-Range"]
+
+def test_negotiate_content_encoding():
+    print("") # close the line containing the '.' emitted by pytest
+    def negotiate(accept_encoding, available_encodings=("br","gzip")):
+        return negotiate_content_encoding(
+            { "headers": { "Accept-Encoding": accept_encoding } },
+            available_encodings
+        )
+    assert "br" == negotiate("gzip, deflate, br")
+    assert "gzip" == negotiate("gzip, deflate, br;q=0.5")
+    assert "gzip" == negotiate("gzip", ("gzip",))
+    assert negotiate("deflate") is None
+    assert negotiate("br;q=0, gzip;q=0") is None
+    assert "br" == negotiate("*")
+    assert negotiate_content_encoding({ "headers": {} }, ("gzip",)) is None
+
+def test_content_encoding_negotiation():
+    print("") # close the line containing the '.' emitted by pytest
+    page_bytes = bytes("<html>" + "Public HTML " * 1000 + "</html>","utf-8")
+    style_bytes = bytes("body { color: black; }\n" * 100,"utf-8")
+    style_gz_bytes = gzip.compress(style_bytes)
+    test_specific_bucket_content = SIMULATED_BUCKET_CONTENTS + [ (
+        "cache.zip",
+        "application/octet-stream",
+        build_cache_stream({
+            "/page.html": page_bytes,
+            "/style.css": style_bytes,
+            "/style.css.gz": style_gz_bytes,
+        }).read()
+    ) ]
+    mock_s3_client = MockS3Client(
+        simulated_bucket_contents = test_specific_bucket_content
+    )
+    waste.handler.caching_lambda_handler.invalidate_cache_for_test()
+    def request(path, headers):
+        return waste.handler.caching_lambda_handler.lambda_handler({
+            "requestContext": { "http": { "method": "GET", "path": path } },
+            "body": "",
+            "headers": headers
+        },context=None)
+    # Precompressed sibling entry
+    response = request("/style.css", { "Accept-Encoding": "gzip, br" })
+    assert "gzip" == response["headers"]["Content-Encoding"]
+    assert "text/css" == response["headers"]["Content-Type"]
+    assert style_gz_bytes == base64.b64decode(response["body"])
+    # Compressed on demand, with a distinct entity tag
+    identity_response = request("/page.html", {})
+    assert "Content-Encoding" not in identity_response["headers"]
+    assert page_bytes == identity_response["body"].encode("utf-8")
+    response = request("/page.html", { "Accept-Encoding": "gzip" })
+    assert "gzip" == response["headers"]["Content-Encoding"]
+    assert "Accept-Encoding" == response["headers"]["Vary"]
+    assert page_bytes == gzip.decompress(base64.b64decode(response["body"]))
+    assert len(response["body"]) < len(page_bytes) / 10
+    assert identity_response["headers"]["ETag"] != response["headers"]["ETag"]
+    response = request("/page.html", {
+        "Accept-Encoding": "gzip",
+        "If-None-Match": response["headers"]["ETag"]
+    })
+    assert 304 == response["statusCode"]
+    mock_s3_client.dispose()
+
+def test_on_the_fly_compression_limited_to_retainable_entries():
+    print("") # close the line containing the '.' emitted by pytest
+    small_bytes = bytes("<html>" + "Small page " * 100 + "</html>","utf-8")
+    large_bytes = bytes("<html>" + "Large page " * 1000 + "</html>","utf-8")
+    large_gz_bytes = gzip.compress(large_bytes)
+    cache = waste.handler.caching_lambda_handler.Cache(
+        compressed_body_budget=16000
+    )
+    cache.load_from_stream("cache.zip", build_cache_stream({
+        "/small.html": small_bytes,
+        "/large.html": large_bytes,
+        "/huge.html": large_bytes,
+        "/huge.html.gz": large_gz_bytes,
+    }))
+    gzip_event = { "headers": { "Accept-Encoding": "gzip" } }
+    # Entries whose compressed copies can be kept are compressed
+    representation = cache.representation("/small.html", gzip_event)
+    assert "gzip" == representation.content_encoding
+    assert representation.source_name is None
+    stream, doc_len = cache.open_representation(representation)
+    assert small_bytes == gzip.decompress(stream.read())
+    assert ("/small.html", "gzip") in cache._compressed_bodies
+    # Larger entries are served as they are, or from a sibling
+    representation = cache.representation("/large.html", gzip_event)
+    assert representation.content_encoding is None
+    assert "/large.html" == representation.source_name
+    representation = cache.representation("/huge.html", gzip_event)
+    assert "gzip" == representation.content_encoding
+    assert "/huge.html.gz" == representation.source_name
+
+def test_multiple_ranges_of_typed_entry():
+    print("") # close the line containing the '.' emitted by pytest
+    doc_bytes = bytes("Göteborg " * 100,"utf-8")
+    mock_s3_client = MockS3Client(
+        simulated_bucket_contents = SIMULATED_BUCKET_CONTENTS + [ (
+            "cache.zip", "application/octet-stream",
+            build_cache_stream({ "/doc.txt": doc_bytes }).read()
+        ) ]
+    )
+    waste.handler.caching_lambda_handler.invalidate_cache_for_test()
+    try:
+        response = waste.handler.caching_lambda_handler.lambda_handler({
+            "requestContext": {
+                "http": { "method": "GET", "path": "/doc.txt" }
+            },
+            "body": "",
+            "headers": { "Range": "bytes=0-1,100-200" }
+        },context=None)
+    finally:
+        mock_s3_client.dispose()
+    assert 206 == response["statusCode"]
+    # The parts carry the entry's type, the response carries the boundary
+    content_type = response["headers"]["Content-Type"]
+    assert content_type.startswith("multipart/byteranges; boundary=")
+    body = response["body"]
+    if response.get("isBase64Encoded") is True:
+        body = base64.b64decode(body).decode("utf-8", errors="replace")
+    assert "Content-Type: text/plain" in body
+    assert "--" + content_type.partition("boundary=")[2] in body
+
+def test_split_character_does_not_classify_entry():
+    print("") # close the line containing the '.' emitted by pytest
+    doc_text = "Göteborg " * 100
+    mock_s3_client = MockS3Client(
+        simulated_bucket_contents = SIMULATED_BUCKET_CONTENTS + [ (
+            "cache.zip", "application/octet-stream",
+            build_cache_stream({ "/doc.txt": bytes(doc_text,"utf-8") }).read()
+        ) ]
+    )
+    waste.handler.caching_lambda_handler.invalidate_cache_for_test()
+    def request(headers):
+        return waste.handler.caching_lambda_handler.lambda_handler({
+            "requestContext": {
+                "http": { "method": "GET", "path": "/doc.txt" }
+            },
+            "body": "",
+            "headers": headers
+        },context=None)
+    try:
+        # Both a multipart response and a fragment which start part
+        # way through a character need base64
+        for range_spec in ( "bytes=0-1,100-200", "bytes=2-50" ):
+            response = request({ "Range": range_spec })
+            assert 206 == response["statusCode"]
+            assert response["isBase64Encoded"] is True
+        response = request({})
+    finally:
+        mock_s3_client.dispose()
+    assert 200 == response["statusCode"]
+    assert doc_text == response["body"]
+    assert response.get("isBase64Encoded", False) is False
+
+def test_cache_control_applied_to_cached_responses():
+    print("") # close the line containing the '.' emitted by pytest
+    mock_s3_client = MockS3Client(
+        simulated_bucket_contents = SIMULATED_BUCKET_CONTENTS,
+        envvars = { ENVVAR_CACHE_CONTROL_POLICY: """[
+            { "path": "/immutable/*", "max_age": 31536000, "immutable": true },
+            { "max_age": 60 }
+        ]""" }
+    )
+    waste.handler.caching_lambda_handler.invalidate_cache_for_test()
+    doc_event = {
+        "requestContext": {
+            "http": { "method": "GET", "path": "/cached_10k" }
+        },
+        "body": "",
+        "headers": {}
+    }
+    doc_response = waste.handler.caching_lambda_handler.lambda_handler(
+        doc_event,context=None
+    )
+    assert "max-age=60" == doc_response["headers"]["Cache-Control"]
+    # The second path resolves to the same entry and is served from
+    # the response memo, but its own policy applies
+    doc_event["requestContext"]["http"]["path"] = "/immutable/cached_10k"
+    doc_response = waste.handler.caching_lambda_handler.lambda_handler(
+        doc_event,context=None
+    )
+    assert 1 == waste.handler.caching_lambda_handler.response_memo_stats()["hits"]
+    assert "max-age=31536000, immutable" == doc_response["headers"]["Cache-Control"]
+    doc_event["headers"]["If-None-Match"] = doc_response["headers"]["ETag"]
+    doc_response = waste.handler.caching_lambda_handler.lambda_handler(
+        doc_event,context=None
+    )
+    mock_s3_client.set_envvar(ENVVAR_CACHE_CONTROL_POLICY,None)
+    mock_s3_client.dispose()
+    assert 304 == doc_response["statusCode"]
+    assert "max-age=31536000, immutable" == doc_response["headers"]["Cache-Control"]
+
+def test_streaming_handler():
+    print("") # close the line containing the '.' emitted by pytest
+    mock_s3_client = MockS3Client(simulated_bucket_contents = SIMULATED_BUCKET_CONTENTS)
+    waste.handler.caching_lambda_handler.invalidate_cache_for_test()
+    def request(path, headers={}):
+        return collect_streamed_response(
+            waste.handler.caching_lambda_handler.streaming_lambda_handler({
+                "requestContext": { "http": { "method": "GET", "path": path } },
+                "body": "",
+                "headers": headers
+            },context=None)
+        )
+    # Cached documents are streamed unencoded, in chunks, in a
+    # single response regardless of the maximum body length
+    override_max_body_length(5000)
+    response = request("/cached_100k")
+    override_max_body_length()
+    assert 200 == response["statusCode"]
+    assert SIMULATED_CACHE_CONTENTS["cached_100k"] == response["body"]
+    assert 1 < response["bodyChunkCount"]
+    assert 100000 == response["headers"]["Content-Length"]
+    assert "ETag" in response["headers"]
+    response = request("/cached_100k", { "Range": "bytes=-10" })
+    assert 206 == response["statusCode"]
+    assert SIMULATED_CACHE_CONTENTS["cached_100k"][-10:] == response["body"]
+    assert "bytes 99990-99999/100000" == response["headers"]["Content-Range"]
+    response = request("/cached_100k", { "Range": "bytes=100000-" })
+    assert 416 == response["statusCode"]
+    # Documents which are not cached are streamed whole from the bucket
+    override_max_body_length(5000)
+    response = request("not_cached_10k")
+    override_max_body_length()
+    assert 200 == response["statusCode"]
+    assert expected_bytes_for_docpath("not_cached_10k") == response["body"]
+    response = request("/nonexistent.docx")
+    mock_s3_client.dispose()
+    assert 404 == response["statusCode"]
+
+def test_phase_timing(capsys):
+    print("") # close the line containing the '.' emitted by pytest
+    mock_s3_client = MockS3Client(
+        simulated_bucket_contents = SIMULATED_BUCKET_CONTENTS,
+        envvars = { ENVVAR_EMIT_METRICS: "1", ENVVAR_SERVER_TIMING: "1" }
+    )
+    waste.handler.caching_lambda_handler.invalidate_cache_for_test()
+    capsys.readouterr()
+    doc_event = {
+        "requestContext": {
+            "http": { "method": "GET", "path": "/cached_10k" }
+        },
+        "body": "",
+        "headers": {}
+    }
+    doc_response = waste.handler.caching_lambda_handler.lambda_handler(
+        doc_event,context=None
+    )
+    doc_event["requestContext"]["http"]["path"] = "not_cached_10k"
+    waste.handler.caching_lambda_handler.lambda_handler(doc_event,context=None)
+    mock_s3_client.set_envvar(ENVVAR_EMIT_METRICS,None)
+    mock_s3_client.set_envvar(ENVVAR_SERVER_TIMING,None)
+    mock_s3_client.dispose()
+    server_timing = doc_response["headers"]["Server-Timing"]
+    for phase_name in ( "cache_load", "cache_lookup", "encode", "total" ):
+        assert phase_name + ";dur=" in server_timing
+    emf_records = [
+        json.loads(line) for line in capsys.readouterr().out.splitlines()
+        if line.startswith('{"_aws"')
+    ]
+    assert [ "hit", "miss" ] == [ r["CacheResult"] for r in emf_records ]
+    assert "s3_get_object" in emf_records[1]
+    metric_names = [
+        metric["Name"]
+        for metric in emf_records[0]["_aws"]["CloudWatchMetrics"][0]["Metrics"]
+    ]
+    assert "total" in metric_names
+    assert [["Handler","CacheResult"]] == (
+        emf_records[0]["_aws"]["CloudWatchMetrics"][0]["Dimensions"]
+    )
+
+def test_cache_index_resolution():
+    print("") # close the line containing the '.' emitted by pytest
+    cache = waste.handler.caching_lambda_handler.Cache(default_doc_name="index.html")
+    cache.load_from_stream("cache.zip",build_cache_stream({
+        "/index.html": bytes("<html>root</html>","utf-8"),
+        "/docs/index.html": bytes("<html>docs</html>","utf-8"),
+        "/docs/guide/page.html": bytes("<html>page</html>","utf-8"),
+    }))
+    assert "/index.html" == cache.resolve("/")
+    assert "/index.html" == cache.resolve("")
+    assert "/docs/index.html" == cache.resolve("/docs/")
+    assert "/docs/index.html" == cache.resolve("/docs")
+    assert "/docs/index.html" == cache.resolve("docs//index.html")
+    assert "/docs/guide/page.html" == cache.resolve("/docs/guide/page.html")
+    # Subpath search finds the longest matching suffix of the path
+    assert "/docs/guide/page.html" == cache.resolve("/v1/docs/guide/page.html")
+    assert "/docs/index.html" == cache.resolve("/v1/docs/")
+    assert cache.resolve("/docs/guide/") is None
+    assert cache.resolve("/docs/missing.html") is None
+    cache = waste.handler.caching_lambda_handler.Cache(search_subpaths=False)
+    cache.load_from_stream("cache.zip",build_cache_stream({
+        "/docs/index.html": bytes("<html>docs</html>","utf-8"),
+    }))
+    assert cache.resolve("/docs/") is None
+    assert cache.resolve("/v1/docs/index.html") is None
+
+def test_entry_cache():
+    print("") # close the line containing the '.' emitted by pytest
+    cache = waste.handler.caching_lambda_handler.Cache(entry_cache_budget=6000)
+    cache.load_from_stream("cache.zip",build_cache_stream({
+        "/a.txt": bytes("a" * 1000,"utf-8"),
+        "/b.txt": bytes("b" * 1000,"utf-8"),
+        "/c.txt": bytes("c" * 1500,"utf-8"),
+        "/d.txt": bytes("d" * 1500,"utf-8"),
+        "/pinned.txt": bytes("p" * 1500,"utf-8"),
+        "/large.bin": gen_random_byte_sequence(4000),
+    }))
+    assert 1 == cache.pin(["pinned.*"])
+    assert "a" * 1000 == cache.search("/a.txt").read().decode("utf-8")
+    assert "a" * 1000 == cache.search("/a.txt").read().decode("utf-8")
+    cache.entry_bytes("/b.txt")
+    cache.entry_bytes("/c.txt")
+    # Entries larger than a quarter of the budget are streamed
+    # from the archive and not admitted
+    assert 4000 == len(cache.search("/large.bin").read())
+    assert 5000 == cache.entry_cache.bytes_used
+    # /a.txt is least recently used so is evicted first, the
+    # pinned entry is never evicted
+    cache.entry_bytes("/d.txt")
+    stats = cache.entry_cache.stats()
+    assert (1, 1, 3, 5500) == (
+        stats["evictions"], stats["pinned_entries"],
+        stats["entries"], stats["bytes_used"]
+    )
+    misses = stats["misses"]
+    assert "p" * 1500 == cache.entry_bytes("/pinned.txt").decode("utf-8")
+    cache.entry_bytes("/b.txt")
+    assert misses == cache.entry_cache.stats()["misses"]
+    cache.entry_bytes("/a.txt")
+    assert misses + 1 == cache.entry_cache.stats()["misses"]
+    # Without an explicit budget, the archive is charged against
+    # the memory allocated to entries
+    os.environ["AWS_LAMBDA_FUNCTION_MEMORY_SIZE"] = "1"
+    try:
+        cache = waste.handler.caching_lambda_handler.Cache()
+        cache.load_from_stream("cache.zip",build_cache_stream({
+            "/a.txt": bytes("a" * 1000,"utf-8"),
+        }))
+        assert (
+            cache_memory_budget("entries") - cache.archive_size ==
+            cache.entry_cache.byte_budget
+        )
+        # Caches which share the function's memory divide every
+        # allocation between them
+        cache = waste.handler.caching_lambda_handler.Cache(memory_share=0.5)
+        cache.load_from_stream("cache.zip",build_cache_stream({
+            "/a.txt": bytes("a" * 1000,"utf-8"),
+        }))
+        assert (
+            cache_memory_budget("entries") // 2 - cache.archive_size ==
+            cache.entry_cache.byte_budget
+        )
+        assert (
+            cache_memory_budget("encoded_bodies") // 2 ==
+            cache._encoded_bodies.byte_budget
+        )
+        assert (
+            cache_memory_budget("compressed_bodies") // 2 ==
+            cache._compressed_bodies.byte_budget
+        )
+    finally:
+        del os.environ["AWS_LAMBDA_FUNCTION_MEMORY_SIZE"]
+
+def test_chunks_of_streamed_member_continue_decompression(monkeypatch):
+    print("") # close the line containing the '.' emitted by pytest
+    doc_bytes = bytes(
+        "".join("line %d of a large page\n" % (i,) for i in range(8000)),
+        "utf-8"
+    )
+    cache_zip_stream = io.BytesIO()
+    with zipfile.ZipFile(cache_zip_stream, "w") as cache_zip:
+        cache_zip.writestr(
+            "/large.txt", doc_bytes, compress_type=zipfile.ZIP_DEFLATED
+        )
+    cache = waste.handler.caching_lambda_handler.Cache(entry_cache_budget=1000)
+    cache.load_from_stream("cache.zip", cache_zip_stream)
+    decompressed_lengths = []
+    zip_ext_file_read = zipfile.ZipExtFile.read
+    def recording_read(zip_ext_file, n=-1):
+        data = zip_ext_file_read(zip_ext_file, n)
+        decompressed_lengths.append(len(data))
+        return data
+    monkeypatch.setattr(zipfile.ZipExtFile, "read", recording_read)
+    override_max_body_length(20000)
+    try:
+        body_received = bytes()
+        while len(body_received) < len(doc_bytes):
+            response = build_positive_response(
+                cache.open("/large.txt"), "bytes=%d-" % (len(body_received),),
+                len(doc_bytes), "text/plain"
+            )
+            assert 206 == response["statusCode"]
+            body_received += response["body"].encode("utf-8")
+    finally:
+        override_max_body_length()
+    assert doc_bytes == body_received
+    # Each chunk continues from where the last one stopped, rather
+    # than decompressing the member from its start
+    assert sum(decompressed_lengths) == len(doc_bytes)
+    # Other readers of the member are not affected
+    assert doc_bytes[:10] == cache.open("/large.txt").read(10)
+
+def test_memory_mapped_cache(tmp_path):
+    print("") # close the line containing the '.' emitted by pytest
+    zip_stream = io.BytesIO()
+    with zipfile.ZipFile(zip_stream,"w") as zip_file:
+        zip_file.writestr("/stored.bin", SIMULATED_CACHE_CONTENTS["cached_10k"])
+        zip_file.writestr(
+            "/deflated.txt", bytes("Göteborg " * 200,"utf-8"),
+            compress_type=zipfile.ZIP_DEFLATED
+        )
+    mock_s3_client = MockS3Client(simulated_bucket_contents = [
+        ( "mapped.zip", "application/zip", zip_stream.getvalue() )
+    ])
+    cache = waste.handler.caching_lambda_handler.Cache(spool_dir=str(tmp_path))
+    cache.load_from_s3_object("test1_bucket", "mapped.zip")
+    mock_s3_client.dispose()
+    assert 1 == len(list(tmp_path.glob("mapped-*.zip")))
+    # Stored members are served as views of the mapping,
+    # compressed members are decompressed as before
+    stored_bytes = cache.entry_bytes("/stored.bin")
+    assert isinstance(stored_bytes, memoryview)
+    assert SIMULATED_CACHE_CONTENTS["cached_10k"] == stored_bytes
+    assert isinstance(cache.entry_bytes("/deflated.txt"), bytes)
+    stream = cache.search("/stored.bin")
+    stream.seek(9990)
+    assert SIMULATED_CACHE_CONTENTS["cached_10k"][9990:] == stream.read(100)
+    assert ("Göteborg " * 200, False) == cache.encoded_body("/deflated.txt")
+    assert cache.entry_is_text["/deflated.txt"] is True
+    response = build_positive_response(
+        cache.search("/stored.bin"), "bytes=0-99", 10000, is_text=False
+    )
+    assert 206 == response["statusCode"]
+    assert (
+        SIMULATED_CACHE_CONTENTS["cached_10k"][:100] ==
+        base64.b64decode(response["body"])
+    )
+
+def test_memory_mapped_cache_served_by_handler(tmp_path):
+    os.environ[ENVVAR_CACHE_SPOOL_DIR] = str(tmp_path)
+    try:
+        override_max_body_length(30000)
+        template_test_method('/cached_100k',206,100000)
+        template_test_method('/cached_non_ascii_text_utf8',200)
+    finally:
+        override_max_body_length(None)
+        del os.environ[ENVVAR_CACHE_SPOOL_DIR]
+        waste.handler.caching_lambda_handler.invalidate_cache_for_test()
+
+def test_lazy_cache():
+    print("") # close the line containing the '.' emitted by pytest
+    zip_stream = io.BytesIO()
+    with zipfile.ZipFile(zip_stream,"w") as zip_file:
+        zip_file.writestr("/a.bin", SIMULATED_CACHE_CONTENTS["cached_100k"])
+        zip_file.writestr(
+            "/b.txt", bytes("Göteborg " * 200,"utf-8"),
+            compress_type=zipfile.ZIP_DEFLATED
+        )
+        zip_file.writestr("/c.bin", SIMULATED_CACHE_CONTENTS["cached_10k"])
+    mock_s3_client = MockS3Client(simulated_bucket_contents = [
+        ( "lazy.zip", "application/zip", zip_stream.getvalue() )
+    ])
+    cache = waste.handler.caching_lambda_handler.Cache(lazy=True)
+    cache.load_from_s3_object("test1_bucket", "lazy.zip")
+    # Only the tail of the archive is fetched at load time
+    assert [ ( "lazy.zip", "bytes=-65557" ) ] == mock_s3_client.get_object_calls
+    assert "/b.txt" == cache.resolve("/v1/b.txt")
+    assert cache.archive_size == len(zip_stream.getvalue())
+    # Each member is fetched with a single GET when first read
+    assert "Göteborg " * 200 == cache.search("/b.txt").read().decode("utf-8")
+    assert SIMULATED_CACHE_CONTENTS["cached_10k"] == cache.search("/c.bin").read()
+    assert 3 == len(mock_s3_client.get_object_calls)
+    member_start, member_stop = cache._member_extents["/c.bin"]
+    assert "bytes=%d-%d" % (member_start, member_stop - 1) == (
+        mock_s3_client.get_object_calls[-1][1]
+    )
+    # and is then served from the entry cache
+    cache.search("/c.bin").read()
+    assert 3 == len(mock_s3_client.get_object_calls)
+    stream = cache.search("/a.bin")
+    stream.seek(99990)
+    assert SIMULATED_CACHE_CONTENTS["cached_100k"][99990:] == stream.read()
+    assert 4 == len(mock_s3_client.get_object_calls)
+    mock_s3_client.dispose()
+
+def test_lazy_cache_chunked_download_of_large_members():
+    print("") # close the line containing the '.' emitted by pytest
+    text_bytes = bytes(
+        "".join("line %d of a large page\n" % (i,) for i in range(4000)),
+        "utf-8"
+    )
+    zip_stream = io.BytesIO()
+    with zipfile.ZipFile(zip_stream,"w") as zip_file:
+        zip_file.writestr("/a.bin", SIMULATED_CACHE_CONTENTS["cached_100k"])
+        zip_file.writestr(
+            "/d.txt", text_bytes, compress_type=zipfile.ZIP_DEFLATED
+        )
+    mock_s3_client = MockS3Client(simulated_bucket_contents = [
+        ( "lazy.zip", "application/zip", zip_stream.getvalue() )
+    ])
+    # Neither member is admitted to the entry cache
+    cache = waste.handler.caching_lambda_handler.Cache(
+        lazy=True, entry_cache_budget=1000
+    )
+    cache.load_from_s3_object("test1_bucket", "lazy.zip")
+    def download_in_chunks(file_name, doc_len):
+        body_received = bytes()
+        while len(body_received) < doc_len:
+            response = build_positive_response(
+                cache.open(file_name), "bytes=%d-" % (len(body_received),),
+                doc_len, is_text=False
+            )
+            body_received += base64.b64decode(response["body"])
+        return body_received
+    def get_lengths():
+        lengths = []
+        for _, s3_range in mock_s3_client.get_object_calls:
+            first, _, last = s3_range[len("bytes="):].partition("-")
+            lengths.append(int(last) + 1 - int(first))
+        return lengths
+    override_max_body_length(20000)
+    try:
+        # Each chunk of a stored member fetches only the bytes of the
+        # chunk, after one GET of its local header
+        mock_s3_client.get_object_calls = []
+        assert SIMULATED_CACHE_CONTENTS["cached_100k"] == download_in_chunks(
+            "/a.bin", 100000
+        )
+        assert 15000 >= max(get_lengths())
+        assert 100000 + 30 == sum(get_lengths())
+        # A compressed member is fetched once for the whole download
+        mock_s3_client.get_object_calls = []
+        assert text_bytes == download_in_chunks("/d.txt", len(text_bytes))
+        assert 1 == len(mock_s3_client.get_object_calls)
+    finally:
+        override_max_body_length()
+        mock_s3_client.dispose()
+
+def test_lazy_cache_served_by_handler():
+    os.environ[ENVVAR_CACHE_LAZY] = "1"
+    try:
+        override_max_body_length(30000)
+        template_test_method('/cached_100k',206,100000)
+        template_test_method('/cached_non_ascii_text_utf8',200)
+        template_test_method('/nonexistent.docx',404)
+    finally:
+        override_max_body_length(None)
+        del os.environ[ENVVAR_CACHE_LAZY]
+        waste.handler.caching_lambda_handler.invalidate_cache_for_test()
+
+def test_lazy_cache_object_replaced():
+    print("") # close the line containing the '.' emitted by pytest
+    def doc_event(doc_path):
+        return {
+            "requestContext": {
+                "http": { "method": "GET", "path": doc_path }
+            },
+            "body": "",
+            "headers": {}
+        }
+    mock_s3_client = MockS3Client(
+        simulated_bucket_contents = SIMULATED_BUCKET_CONTENTS,
+        envvars = {
+            ENVVAR_CONTENT_BUCKET_NAME: "test1_bucket",
+            ENVVAR_CACHE_OBJECT_NAME: "cache.zip",
+            ENVVAR_CACHE_LAZY: "1"
+        }
+    )
+    waste.handler.caching_lambda_handler.invalidate_cache_for_test()
+    original_bucket_contents = mock_s3_client.bucket_sim["cache.zip"]
+    try:
+        lambda_handler = waste.handler.caching_lambda_handler.lambda_handler
+        assert 200 == lambda_handler(
+            doc_event("/cached_non_ascii_text_utf8"),context=None
+        )["statusCode"]
+        mock_s3_client.mock_put_object(
+            "cache.zip", "application/zip",
+            build_cache_stream({ "new.txt": bytes("new","utf-8") }).getvalue()
+        )
+        # Members of the replaced archive can no longer be read, the
+        # request is served from the bucket while the cache reloads
+        assert 404 == lambda_handler(doc_event("/cached_10k"),context=None)["statusCode"]
+        waste.handler.caching_lambda_handler.wait_for_reload_for_test()
+        new_doc_response = lambda_handler(doc_event("/new.txt"),context=None)
+        assert 200 == new_doc_response["statusCode"]
+        assert "new" == new_doc_response["body"]
+    finally:
+        mock_s3_client.bucket_sim["cache.zip"] = original_bucket_contents
+        del os.environ[ENVVAR_CACHE_LAZY]
+        waste.handler.caching_lambda_handler.invalidate_cache_for_test()
+        mock_s3_client.dispose()
+
+def test_parallel_download(tmp_path):
+    print("") # close the line containing the '.' emitted by pytest
+    object_bytes = SIMULATED_CACHE_CONTENTS["cached_100k"]
+    mock_s3_client = MockS3Client(simulated_bucket_contents = [
+        ( "blob.bin", "application/octet-stream", object_bytes )
+    ])
+    object_stream, _ = waste.handler.caching_lambda_handler.download_s3_object(
+        mock_s3_client, "test1_bucket", "blob.bin",
+        part_size=4096, concurrency=4
+    )
+    assert object_bytes == object_stream.read()
+    assert 25 == len(mock_s3_client.get_object_calls)
+    assert sorted(
+        "bytes=%d-%d" % (start, min(start + 4096, 100000) - 1)
+        for start in range(0, 100000, 4096)
+    ) == sorted(call[1] for call in mock_s3_client.get_object_calls)
+    with open(tmp_path / "blob.bin", "wb") as spool_file:
+        waste.handler.caching_lambda_handler.download_s3_object(
+            mock_s3_client, "test1_bucket", "blob.bin",
+            part_size=30000, concurrency=2, spool_file=spool_file
+        )
+    assert object_bytes == (tmp_path / "blob.bin").read_bytes()
+    # Objects smaller than a part are fetched with a single GET
+    mock_s3_client.get_object_calls = []
+    object_stream, _ = waste.handler.caching_lambda_handler.download_s3_object(
+        mock_s3_client, "test1_bucket", "blob.bin", part_size=200000
+    )
+    assert object_bytes == object_stream.read()
+    assert 1 == len(mock_s3_client.get_object_calls)
+    mock_s3_client.dispose()
+
+def test_local_copy_reused_while_etag_unchanged(tmp_path):
+    print("") # close the line containing the '.' emitted by pytest
+    mock_s3_client = MockS3Client(simulated_bucket_contents = [
+        ( "site.zip", "application/zip",
+          build_cache_stream(SIMULATED_CACHE_CONTENTS).getvalue() )
+    ])
+    cache = waste.handler.caching_lambda_handler.Cache(spool_dir=str(tmp_path))
+    cache.load_from_s3_object("test1_bucket", "site.zip")
+    assert 1 == len(mock_s3_client.get_object_calls)
+    spooled_files = os.listdir(tmp_path)
+    assert 1 == len(spooled_files)
+    assert spooled_files[0].startswith("site-")
+    # A later load of the same version does not download it again
+    cache = waste.handler.caching_lambda_handler.Cache(spool_dir=str(tmp_path))
+    cache.load_from_s3_object("test1_bucket", "site.zip")
+    assert 1 == len(mock_s3_client.get_object_calls)
+    assert 2 == len(mock_s3_client.head_object_calls)
+    assert 10000 == len(cache.search("/cached_10k").read())
+    # A new version is downloaded, and replaces the old copy
+    mock_s3_client.mock_put_object(
+        "site.zip", "application/zip",
+        build_cache_stream({ "new.txt": bytes("new","utf-8") }).getvalue()
+    )
+    cache = waste.handler.caching_lambda_handler.Cache(spool_dir=str(tmp_path))
+    cache.load_from_s3_object("test1_bucket", "site.zip")
+    assert 2 == len(mock_s3_client.get_object_calls)
+    assert [ "new.txt" ] == list(cache._members)
+    assert 1 == len(os.listdir(tmp_path))
+    assert spooled_files != os.listdir(tmp_path)
+    mock_s3_client.dispose()
+
+def test_local_copies_of_other_objects_kept(tmp_path):
+    print("") # close the line containing the '.' emitted by pytest
+    cache_zip_bytes = build_cache_stream(SIMULATED_CACHE_CONTENTS).getvalue()
+    mock_s3_client = MockS3Client(simulated_bucket_contents = [
+        ( "site.zip", "application/zip", cache_zip_bytes ),
+        ( "staging/site.zip", "application/zip", cache_zip_bytes ),
+        ( "site-preview.zip", "application/zip", cache_zip_bytes ),
+    ])
+    for cache_object_name in (
+        "site.zip", "staging/site.zip", "site-preview.zip"
+    ):
+        cache = waste.handler.caching_lambda_handler.Cache(
+            spool_dir=str(tmp_path)
+        )
+        cache.load_from_s3_object("test1_bucket", cache_object_name)
+    # Objects with the same name in different folders have their
+    # own copies, even when their contents are identical
+    assert 3 == len(mock_s3_client.get_object_calls)
+    assert 3 == len(os.listdir(tmp_path))
+    site_copies = sorted(os.listdir(tmp_path))
+    # An interrupted download of an earlier version is removed with
+    # the earlier version, but copies of other objects are kept
+    site_copy = [
+        spool_file_name for spool_file_name in site_copies
+        if spool_file_name.startswith("site-") and
+        not spool_file_name.startswith("site-preview-")
+    ]
+    ( tmp_path / ( site_copy[0] + ".partial" ) ).write_bytes(b"part")
+    mock_s3_client.mock_put_object(
+        "site.zip", "application/zip",
+        build_cache_stream({ "new.txt": bytes("new","utf-8") }).getvalue()
+    )
+    cache = waste.handler.caching_lambda_handler.Cache(spool_dir=str(tmp_path))
+    cache.load_from_s3_object("test1_bucket", "site.zip")
+    assert [ "new.txt" ] == list(cache._members)
+    remaining_copies = os.listdir(tmp_path)
+    assert 3 == len(remaining_copies)
+    assert 2 == len(set(site_copies) & set(remaining_copies))
+    assert not any(
+        spool_file_name.endswith(".partial")
+        for spool_file_name in remaining_copies
+    )
+    mock_s3_client.dispose()
+
+def test_cache_reloaded_when_etag_changes():
+    print("") # close the line containing the '.' emitted by pytest
+    doc_event = {
+        "requestContext": {
+            "http": { "method": "GET", "path": "/new.txt" }
+        },
+        "body": "",
+        "headers": {}
+    }
+    mock_s3_client = MockS3Client(
+        simulated_bucket_contents = SIMULATED_BUCKET_CONTENTS,
+        envvars = {
+            ENVVAR_CONTENT_BUCKET_NAME: "test1_bucket",
+            ENVVAR_CACHE_OBJECT_NAME: "cache.zip",
+            ENVVAR_CACHE_RELOAD_INTERVAL: "0.01"
+        }
+    )
+    waste.handler.caching_lambda_handler.invalidate_cache_for_test()
+    original_bucket_contents = mock_s3_client.bucket_sim["cache.zip"]
+    def cache_object_get_count():
+        return len([
+            key for key, _ in mock_s3_client.get_object_calls
+            if key == "cache.zip"
+        ])
+    try:
+        lambda_handler = waste.handler.caching_lambda_handler.lambda_handler
+        assert 404 == lambda_handler(doc_event,context=None)["statusCode"]
+        time.sleep(0.02)
+        # An unchanged object is not reloaded
+        lambda_handler(doc_event,context=None)
+        waste.handler.caching_lambda_handler.wait_for_reload_for_test()
+        assert 1 == len(mock_s3_client.head_object_calls)
+        get_count = cache_object_get_count()
+        mock_s3_client.mock_put_object(
+            "cache.zip", "application/zip",
+            build_cache_stream({ "new.txt": bytes("new","utf-8") }).getvalue()
+        )
+        time.sleep(0.02)
+        # The request which starts the reload is served from the
+        # old cache, the new cache is swapped in for a later request
+        assert 404 == lambda_handler(doc_event,context=None)["statusCode"]
+        waste.handler.caching_lambda_handler.wait_for_reload_for_test()
+        assert get_count + 1 == cache_object_get_count()
+        doc_response = lambda_handler(doc_event,context=None)
+        assert 200 == doc_response["statusCode"]
+        assert "new" == doc_response["body"]
+    finally:
+        mock_s3_client.bucket_sim["cache.zip"] = original_bucket_contents
+        del os.environ[ENVVAR_CACHE_RELOAD_INTERVAL]
+        waste.handler.caching_lambda_handler.invalidate_cache_for_test()
+        mock_s3_client.dispose()
+
+def test_sharded_caches():
+    print("") # close the line containing the '.' emitted by pytest
+    def doc_event(doc_path):
+        return {
+            "requestContext": {
+                "http": { "method": "GET", "path": doc_path }
+            },
+            "body": "",
+            "headers": {}
+        }
+    mock_s3_client = MockS3Client(
+        simulated_bucket_contents = [
+            ( "docs.zip", "application/zip", build_cache_stream({
+                "/docs/guide.txt": bytes("guide","utf-8"),
+            }).getvalue() ),
+            ( "media.zip", "application/zip", build_cache_stream({
+                "/media/logo.txt": bytes("logo","utf-8"),
+            }).getvalue() ),
+            ( "site.zip", "application/zip", build_cache_stream({
+                "/index.txt": bytes("index","utf-8"),
+            }).getvalue() ),
+        ],
+        envvars = {
+            ENVVAR_CONTENT_BUCKET_NAME: "test1_bucket",
+            ENVVAR_CACHE_SHARDS: json.dumps({
+                "/": "site.zip",
+                "/docs/": "docs.zip",
+                "/media/": "media.zip",
+            })
+        }
+    )
+    waste.handler.caching_lambda_handler.invalidate_cache_for_test()
+    lambda_handler = waste.handler.caching_lambda_handler.lambda_handler
+    try:
+        doc_response = lambda_handler(doc_event("/docs/guide.txt"),context=None)
+        assert "guide" == doc_response["body"]
+        # Only the archive for the requested prefix has been loaded
+        assert [ "docs.zip" ] == [
+            key for key, _ in mock_s3_client.get_object_calls
+        ]
+        # Shards whose caches are loaded share the function's memory
+        entry_cache_stats = waste.handler.caching_lambda_handler.entry_cache_stats
+        docs_entry_budget = entry_cache_stats("/docs/")["byte_budget"]
+        assert cache_memory_budget("responses") == (
+            waste.handler.caching_lambda_handler.response_memo_stats("/docs/")[
+                "byte_budget"
+            ]
+        )
+        doc_response = lambda_handler(doc_event("/index.txt"),context=None)
+        assert "index" == doc_response["body"]
+        assert cache_memory_budget("responses", 1 / 2) == (
+            waste.handler.caching_lambda_handler.response_memo_stats("/docs/")[
+                "byte_budget"
+            ]
+        )
+        assert entry_cache_stats("/docs/")["byte_budget"] < docs_entry_budget
+        # The longest matching prefix selects the shard
+        doc_response = lambda_handler(doc_event("/media/logo.txt"),context=None)
+        assert "logo" == doc_response["body"]
+        assert [ "docs.zip", "site.zip", "media.zip" ] == [
+            key for key, _ in mock_s3_client.get_object_calls
+        ]
+        mock_s3_client.get_object_calls = []
+        doc_response = lambda_handler(doc_event("/docs/guide.txt"),context=None)
+        assert 0 == len(mock_s3_client.get_object_calls)
+        stats = waste.handler.caching_lambda_handler.response_memo_stats("/docs/")
+        assert 1 == stats["hits"]
+        assert cache_memory_budget("responses", 1 / 3) == stats["byte_budget"]
+    finally:
+        del os.environ[ENVVAR_CACHE_SHARDS]
+        waste.handler.caching_lambda_handler.invalidate_cache_for_test()
+        mock_s3_client.dispose()
+
+def test_wpack_cache(tmp_path):
+    print("") # close the line containing the '.' emitted by pytest
+    page_text = "<html>" + "Göteborg " * 500 + "</html>"
+    wpack_stream = io.BytesIO()
+    index = write_wpack(wpack_stream, [
+        ( "/index.html", bytes(page_text,"utf-8"), 1577836800 ),
+        ( "/logo.bin", SIMULATED_CACHE_CONTENTS["cached_10k"], 1577836800 ),
+    ])
+    # Compressible text is given a gzip variant
+    assert [ "/index.html", "/index.html.gz", "/logo.bin" ] == [
+        index_record["path"] for index_record in index
+    ]
+    mock_s3_client = MockS3Client(simulated_bucket_contents = [
+        ( "site.wpack", "application/octet-stream", wpack_stream.getvalue() )
+    ])
+    for spool_dir in ( None, str(tmp_path) ):
+        cache = waste.handler.caching_lambda_handler.Cache(spool_dir=spool_dir)
+        cache.load_from_s3_object("test1_bucket", "site.wpack")
+        assert "/index.html" == cache.resolve("/v1/index.html")
+        assert "text/html" == cache.content_type("/index.html")
+        # Text classification comes from the index
+        assert cache.entry_is_text == {
+            "/index.html": True, "/index.html.gz": False, "/logo.bin": False
+        }
+        etag, last_modified = cache.validators("/index.html")
+        assert index[0]["etag"] == etag
+        assert 2020 == last_modified.year
+        assert (
+            SIMULATED_CACHE_CONTENTS["cached_10k"] ==
+            cache.search("/logo.bin").read()
+        )
+        assert page_text == cache.encoded_body("/index.html")[0]
+        representation = cache.representation("/index.html", {
+            "headers": { "Accept-Encoding": "gzip" }
+        })
+        assert "/index.html.gz" == representation.source_name
+        stream, doc_len = cache.open_representation(representation)
+        assert page_text == gzip.decompress(stream.read()).decode("utf-8")
+    assert isinstance(cache.entry_bytes("/logo.bin"), memoryview)
+    mock_s3_client.dispose()
+
+def test_build_cache_archive(tmp_path):
+    print("") # close the line containing the '.' emitted by pytest
+    content_dir = tmp_path / "content"
+    ( content_dir / "docs" ).mkdir(parents=True)
+    page_text = "<html>" + "Göteborg " * 500 + "</html>"
+    ( content_dir / "index.html" ).write_text(page_text, encoding="utf-8")
+    ( content_dir / "docs" / "logo.bin" ).write_bytes(
+        SIMULATED_CACHE_CONTENTS["cached_10k"]
+    )
+    for archive_name in ( "site.zip", "site.wpack" ):
+        archive_path = str(tmp_path / archive_name)
+        index_records = build_cache_archive(
+            str(content_dir), archive_path, max_workers=2
+        )
+        assert [ "/docs/logo.bin", "/index.html", "/index.html.gz" ] == sorted(
+            index_record["path"] for index_record in index_records
+        )
+        cache = waste.handler.caching_lambda_handler.Cache()
+        with open(archive_path, "rb") as archive_file:
+            cache.load_from_stream(archive_name, archive_file)
+            assert page_text == cache.encoded_body("/index.html")[0]
+            assert (
+                SIMULATED_CACHE_CONTENTS["cached_10k"] ==
+                cache.search("/docs/logo.bin").read()
+            )
+            representation = cache.representation("/index.html", {
+                "headers": { "Accept-Encoding": "gzip" }
+            })
+            assert "/index.html.gz" == representation.source_name
+        report = cache_archive_report(
+            index_records, os.path.getsize(archive_path)
+        )
+        assert "Entries: 2 (1 text, 1 binary)" == report[0]
+        assert "Precompressed variants: 1" in report[2]
+        # The archive fits within the memory allocated to entries
+        minimum_memory_mb = int(report[4].split(": ")[1].split()[0])
+        assert (
+            minimum_memory_mb * 1024 * 1024 * cache_memory_fraction("entries")
+            >= os.path.getsize(archive_path)
+        )
+    # Zip archives have members which deflate well deflated, and
+    # others (including precompressed siblings) stored
+    with zipfile.ZipFile(str(tmp_path / "site.zip")) as cache_zip:
+        assert {
+            "/docs/logo.bin": zipfile.ZIP_STORED,
+            "/index.html": zipfile.ZIP_DEFLATED,
+            "/index.html.gz": zipfile.ZIP_STORED,
+        } == {
+            zip_info.filename: zip_info.compress_type
+            for zip_info in cache_zip.infolist()
+        }
+    # The content directory may be given with a trailing separator
+    index_records = build_cache_archive(
+        str(content_dir) + os.sep, str(tmp_path / "site2.zip"), max_workers=1
+    )
+    assert [ "/docs/logo.bin", "/index.html", "/index.html.gz" ] == sorted(
+        index_record["path"] for index_record in index_records
+    )
+
+def test_build_zip_cache_archive_members(tmp_path, monkeypatch):
+    print("") # close the line containing the '.' emitted by pytest
+    content_dir = tmp_path / "content"
+    content_dir.mkdir()
+    page_text = "<html>" + "Göteborg " * 500 + "</html>"
+    ( content_dir / "Göteborg.html" ).write_text(page_text, encoding="utf-8")
+    ( content_dir / "empty.txt" ).write_bytes(b"")
+    os.utime(str(content_dir / "empty.txt"), (0, 0))
+    expected_contents = {
+        "/Göteborg.html": bytes(page_text, "utf-8"),
+        "/Göteborg.html.gz": None,
+        "/empty.txt": b"",
+    }
+    # Archives too large for the plain zip format are written by zipfile
+    for max_entries in ( 0xFFFF, 1 ):
+        monkeypatch.setattr(
+            waste.deploy.content_support, "_ZIP_MAX_ENTRIES", max_entries
+        )
+        archive_path = str(tmp_path / ("site-%d.zip" % (max_entries,)))
+        build_cache_archive(str(content_dir), archive_path, max_workers=1)
+        with zipfile.ZipFile(archive_path) as cache_zip:
+            assert cache_zip.testzip() is None
+            assert sorted(expected_contents) == sorted(cache_zip.namelist())
+            assert bytes(page_text, "utf-8") == cache_zip.read("/Göteborg.html")
+            assert b"" == cache_zip.read("/empty.txt")
+            zip_info = cache_zip.getinfo("/Göteborg.html")
+            assert zipfile.ZIP_DEFLATED == zip_info.compress_type
+            # Timestamps before 1980 are written as 1980
+            assert (1980, 1, 1) == cache_zip.getinfo("/empty.txt").date_time[:3]
+        cache = waste.handler.caching_lambda_handler.Cache()
+        with open(archive_path, "rb") as archive_file:
+            cache.load_from_stream("site.zip", archive_file)
+            assert page_text == cache.encoded_body("/Göteborg.html")[0]
+
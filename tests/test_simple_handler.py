@@ -1,9 +1,12 @@
 #! python
 
+import base64
+import hashlib
 import io
 import os
 import zipfile
 import logging
+import queue
 
 import requests
 
@@ -12,10 +15,45 @@ import context
 from mock_client import MockS3Client
 
 
+from waste.handler.shared import (
+    begin_request_log,
+    serialize_response_for_log,
+    serialize_object_for_log,
+    get_mockable_s3_client,
+    override_max_body_length,
+    s3_client_config,
+    ENVVAR_LOG_SAMPLE_RATE,
+    ENVVAR_S3_MAX_POOL_CONNECTIONS,
+    ENVVAR_S3_READ_TIMEOUT,
+    ENVVAR_KEY_MANIFEST_NAME,
+    ENVVAR_KEY_MANIFEST_TTL
+)
+from waste.handler.key_manifest import (
+    KeyManifest,
+    KeyManifestEntry,
+    KEY_MANIFEST_OBJECT_NAME
+)
+from waste.handler.transforms import (
+    Transform,
+    TransformPipeline
+)
+from waste.handler.cache_control import (
+    CacheControlPolicy,
+    ENVVAR_CACHE_CONTROL_POLICY
+)
+import waste.handler.shared
+import waste.handler.simple_lambda_handler
+from waste.handler.shared import encode_body_bytes
+from waste.handler.streaming import collect_streamed_response
 from waste.handler.simple_lambda_handler import (
     lambda_handler,
+    streaming_lambda_handler,
+    _build_response_from_s3_object,
+    get_object_cache,
     ENVVAR_CONTENT_BUCKET_NAME, 
-    ENVVAR_DEFAULT_DOCUMENT_NAME
+    ENVVAR_DEFAULT_DOCUMENT_NAME,
+    ENVVAR_OBJECT_CACHE_TTL,
+    ENVVAR_OBJECT_CACHE_STALE_TTL
 )
 
 _SIMULATED_BUCKET_CONTENTS = (
@@ -103,3 +141,464 @@ def test_default_document():
         assert 200 == defaultable_doc_response["statusCode"],"path="+path
         assert type(defaultable_doc_response["body"]) == str
 
+
+def test_range_and_if_range():
+    range_event = {
+        "requestContext": {
+            "http": { "method": "GET", "path": "/public.html" }
+        },
+        "body": "",
+        "headers": { "Range": "bytes=6-11" }
+    }
+    mock_s3_client = MockS3Client(_SIMULATED_BUCKET_CONTENTS)
+    range_response = lambda_handler(range_event,context=None)
+    assert 206 == range_response["statusCode"]
+    assert "Public" == range_response["body"]
+    assert "text/html" == range_response["headers"]["Content-Type"]
+    # A stale If-Range validator results in the whole document
+    range_event["headers"]["If-Range"] = '"stale-etag"'
+    range_response = lambda_handler(range_event,context=None)
+    assert 200 == range_response["statusCode"]
+    assert "<html>Public HTML</html>" == range_response["body"]
+    range_event["headers"]["Range"] = "bytes=100-"
+    del range_event["headers"]["If-Range"]
+    range_response = lambda_handler(range_event,context=None)
+    mock_s3_client.dispose()
+    assert 416 == range_response["statusCode"]
+
+def test_object_cache_revalidation():
+    html_doc_event = {
+        "requestContext": {
+            "http": { "method": "GET", "path": "/public.html" }
+        },
+        "body": ""
+    }
+    mock_s3_client = MockS3Client(_SIMULATED_BUCKET_CONTENTS)
+    # With the default TTL of 0 every request revalidates the
+    # cached object, and an unchanged object is not downloaded again
+    first_response = lambda_handler(html_doc_event,context=None)
+    revalidations = get_object_cache().stats()["revalidations"]
+    second_response = lambda_handler(html_doc_event,context=None)
+    assert first_response["body"] == second_response["body"]
+    assert revalidations + 1 == get_object_cache().stats()["revalidations"]
+    # A changed object is downloaded and replaces the cached one
+    mock_s3_client.mock_put_object(
+        "/public.html", "text/html", bytes("<html>Changed</html>","utf-8")
+    )
+    changed_response = lambda_handler(html_doc_event,context=None)
+    assert "<html>Changed</html>" == changed_response["body"]
+    # A deleted object is no longer served
+    del mock_s3_client.bucket_sim["/public.html"]
+    deleted_response = lambda_handler(html_doc_event,context=None)
+    mock_s3_client.dispose()
+    assert 404 == deleted_response["statusCode"]
+
+def test_object_cache_ttl_and_stale_while_revalidate():
+    html_doc_event = {
+        "requestContext": {
+            "http": { "method": "GET", "path": "/public.html" }
+        },
+        "body": ""
+    }
+    mock_s3_client = MockS3Client(_SIMULATED_BUCKET_CONTENTS)
+    mock_s3_client.set_envvar(ENVVAR_OBJECT_CACHE_TTL,"3600")
+    lambda_handler(html_doc_event,context=None)
+    mock_s3_client.mock_put_object(
+        "/public.html", "text/html", bytes("<html>Changed</html>","utf-8")
+    )
+    # Within the TTL the cached object is served without contacting S3
+    get_object_call_count = len(mock_s3_client.get_object_calls)
+    fresh_response = lambda_handler(html_doc_event,context=None)
+    assert "<html>Public HTML</html>" == fresh_response["body"]
+    assert get_object_call_count == len(mock_s3_client.get_object_calls)
+    # Within the stale window the cached object is served and
+    # revalidated in the background
+    mock_s3_client.set_envvar(ENVVAR_OBJECT_CACHE_TTL,"0")
+    mock_s3_client.set_envvar(ENVVAR_OBJECT_CACHE_STALE_TTL,"3600")
+    stale_response = lambda_handler(html_doc_event,context=None)
+    assert "<html>Public HTML</html>" == stale_response["body"]
+    get_object_cache().wait_for_revalidation()
+    revalidated_response = lambda_handler(html_doc_event,context=None)
+    get_object_cache().wait_for_revalidation()
+    mock_s3_client.set_envvar(ENVVAR_OBJECT_CACHE_TTL,None)
+    mock_s3_client.set_envvar(ENVVAR_OBJECT_CACHE_STALE_TTL,None)
+    mock_s3_client.dispose()
+    assert "<html>Changed</html>" == revalidated_response["body"]
+
+def test_key_manifest():
+    key_manifest = KeyManifest([
+        KeyManifestEntry(
+            key, len(body), '"%s"' % (hashlib.md5(body).hexdigest(),),
+            content_type
+        )
+        for key, content_type, body in _SIMULATED_BUCKET_CONTENTS
+    ])
+    mock_s3_client = MockS3Client(_SIMULATED_BUCKET_CONTENTS)
+    mock_s3_client.mock_put_object(
+        KEY_MANIFEST_OBJECT_NAME, "application/json",
+        key_manifest.to_json().encode("utf-8")
+    )
+    mock_s3_client.set_envvar(ENVVAR_KEY_MANIFEST_NAME,KEY_MANIFEST_OBJECT_NAME)
+    mock_s3_client.set_envvar(ENVVAR_DEFAULT_DOCUMENT_NAME,"index.html")
+    responses = {}
+    for path in ( "/public.html", "/subdir", "/missing", KEY_MANIFEST_OBJECT_NAME ):
+        responses[path] = lambda_handler({
+            "requestContext": {
+                "http": { "method": "GET", "path": path }
+            },
+            "body": ""
+        },context=None)
+    mock_s3_client.set_envvar(ENVVAR_DEFAULT_DOCUMENT_NAME,None)
+    mock_s3_client.set_envvar(ENVVAR_KEY_MANIFEST_NAME,None)
+    mock_s3_client.dispose()
+    assert 200 == responses["/public.html"]["statusCode"]
+    assert (
+        key_manifest.get("/public.html").etag ==
+        responses["/public.html"]["headers"]["ETag"]
+    )
+    assert 200 == responses["/subdir"]["statusCode"]
+    assert 404 == responses["/missing"]["statusCode"]
+    # The manifest is not served as content
+    assert 404 == responses[KEY_MANIFEST_OBJECT_NAME]["statusCode"]
+    # Keys which are not in the bucket are never requested (objects
+    # cached by earlier requests whose ETags match the manifest may
+    # not be requested either)
+    content_get_object_keys = set(
+        key for key, _ in mock_s3_client.get_object_calls
+        if key != KEY_MANIFEST_OBJECT_NAME
+    )
+    assert content_get_object_keys <= { "/public.html", "/subdir/index.html" }
+
+def test_missing_key_manifest_retried_after_ttl():
+    mock_s3_client = MockS3Client(_SIMULATED_BUCKET_CONTENTS)
+    mock_s3_client.set_envvar(ENVVAR_KEY_MANIFEST_NAME,"/no-manifest.json")
+    mock_s3_client.set_envvar(ENVVAR_KEY_MANIFEST_TTL,"3600")
+    def manifest_requests():
+        return [
+            key for key, _ in mock_s3_client.get_object_calls
+            if key == "/no-manifest.json"
+        ]
+    public_event = {
+        "requestContext": {
+            "http": { "method": "GET", "path": "/public.html" }
+        },
+        "body": ""
+    }
+    try:
+        # Requests are served without the manifest, which is not
+        # requested again until the TTL has expired
+        for _ in range(0,3):
+            response = lambda_handler(public_event,context=None)
+            assert 200 == response["statusCode"]
+        assert 1 == len(manifest_requests())
+        mock_s3_client.set_envvar(ENVVAR_KEY_MANIFEST_TTL,"0")
+        response = lambda_handler(public_event,context=None)
+        assert 200 == response["statusCode"]
+        assert 2 == len(manifest_requests())
+    finally:
+        mock_s3_client.set_envvar(ENVVAR_KEY_MANIFEST_TTL,None)
+        mock_s3_client.set_envvar(ENVVAR_KEY_MANIFEST_NAME,None)
+        mock_s3_client.dispose()
+
+def test_ranged_s3_requests():
+    large_body = bytes(range(0,256)) * 64
+    mock_s3_client = MockS3Client(_SIMULATED_BUCKET_CONTENTS)
+    mock_s3_client.mock_put_object(
+        "/large.bin", "application/octet-stream", large_body
+    )
+    override_max_body_length(400)
+    # A single range is fetched from S3 rather than the whole object
+    range_response = lambda_handler({
+        "requestContext": {
+            "http": { "method": "GET", "path": "/public.html" }
+        },
+        "body": "",
+        "headers": { "Range": "bytes=-5" }
+    },context=None)
+    assert 206 == range_response["statusCode"]
+    assert "html>" == range_response["body"]
+    assert ( "/public.html", "bytes=-5" ) == mock_s3_client.get_object_calls[-1]
+    # An object too long for a single response is served in chunks.
+    # Without a key manifest its length is only known once it has been
+    # fetched, with one the first chunk is fetched by range too.
+    def fetch_in_chunks():
+        large_event = {
+            "requestContext": {
+                "http": { "method": "GET", "path": "/large.bin" }
+            },
+            "body": ""
+        }
+        large_body_received = bytes()
+        while len(large_body_received) < len(large_body):
+            if len(large_body_received) > 0:
+                large_event["headers"] = {
+                    "Range": "bytes=%d-" % (len(large_body_received),)
+                }
+            chunk_response = lambda_handler(large_event,context=None)
+            assert 206 == chunk_response["statusCode"]
+            assert chunk_response["isBase64Encoded"] is True
+            large_body_received += base64.b64decode(chunk_response["body"])
+        return large_body_received
+    def large_object_ranges():
+        return [
+            s3_range for key, s3_range in mock_s3_client.get_object_calls
+            if key == "/large.bin"
+        ]
+    assert large_body == fetch_in_chunks()
+    assert large_object_ranges()[0] is None
+    assert None not in large_object_ranges()[1:]
+    key_manifest = KeyManifest([ KeyManifestEntry(
+        "/large.bin", len(large_body),
+        '"%s"' % (hashlib.md5(large_body).hexdigest(),),
+        "application/octet-stream"
+    ) ])
+    mock_s3_client.mock_put_object(
+        "/ranged-manifest.json", "application/json",
+        key_manifest.to_json().encode("utf-8")
+    )
+    mock_s3_client.set_envvar(ENVVAR_KEY_MANIFEST_NAME,"/ranged-manifest.json")
+    mock_s3_client.get_object_calls = []
+    assert large_body == fetch_in_chunks()
+    mock_s3_client.set_envvar(ENVVAR_KEY_MANIFEST_NAME,None)
+    assert None not in large_object_ranges()
+    override_max_body_length()
+    mock_s3_client.dispose()
+
+def test_cached_object_chunks_encode_only_chunk(monkeypatch):
+    large_body = bytes(range(0,256)) * 64
+    mock_s3_client = MockS3Client(_SIMULATED_BUCKET_CONTENTS)
+    mock_s3_client.mock_put_object(
+        "/chunked.bin", "application/octet-stream", large_body
+    )
+    mock_s3_client.set_envvar(ENVVAR_OBJECT_CACHE_TTL,"3600")
+    encoded_lengths = []
+    def recording_encode_body_bytes(body_bytes,force_base64=False):
+        encoded_lengths.append(len(body_bytes))
+        return encode_body_bytes(body_bytes,force_base64)
+    monkeypatch.setattr(
+        waste.handler.simple_lambda_handler, "encode_body_bytes",
+        recording_encode_body_bytes
+    )
+    override_max_body_length(400)
+    large_event = {
+        "requestContext": {
+            "http": { "method": "GET", "path": "/chunked.bin" }
+        },
+        "body": "",
+        "headers": {}
+    }
+    # The first request fetches the whole object into the object
+    # cache, the rest are served from it
+    for chunk_start in ( 0, 300, 600 ):
+        if chunk_start > 0:
+            large_event["headers"]["Range"] = "bytes=%d-" % (chunk_start,)
+        chunk_response = lambda_handler(large_event,context=None)
+        assert 206 == chunk_response["statusCode"]
+        assert large_body[chunk_start:chunk_start + 300] == base64.b64decode(
+            chunk_response["body"]
+        )
+    override_max_body_length()
+    mock_s3_client.set_envvar(ENVVAR_OBJECT_CACHE_TTL,None)
+    mock_s3_client.dispose()
+    assert [ ( "/chunked.bin", None ) ] == mock_s3_client.get_object_calls
+    # Chunks are encoded by the response builder, the whole object
+    # is never encoded
+    assert [] == encoded_lengths
+
+def test_transform_pipeline():
+    transform_calls = []
+    def upper_case(body):
+        transform_calls.append(body)
+        return body.upper()
+    def pipeline(version):
+        return TransformPipeline("rewrite", version, [
+            Transform("html_to_page", lambda body: body.replace("HTML","Page")),
+            upper_case,
+        ])
+    mock_s3_client = MockS3Client(_SIMULATED_BUCKET_CONTENTS)
+    def transformed_response(transform_pipeline):
+        return _build_response_from_s3_object(
+            "/public.html", "dummy", transform_pipeline=transform_pipeline
+        )
+    first_response = transformed_response(pipeline(1))
+    assert "<HTML>PUBLIC PAGE</HTML>" == first_response["body"]
+    # The output is memoized for the version of the object
+    second_response = transformed_response(pipeline(1))
+    assert first_response["body"] == second_response["body"]
+    assert first_response["headers"]["ETag"] == second_response["headers"]["ETag"]
+    assert 1 == len(transform_calls)
+    # A new version of the pipeline or of the object is transformed again
+    new_version_response = transformed_response(pipeline(2))
+    assert 2 == len(transform_calls)
+    assert first_response["headers"]["ETag"] != new_version_response["headers"]["ETag"]
+    mock_s3_client.mock_put_object(
+        "/public.html", "text/html", bytes("<html>Changed HTML</html>","utf-8")
+    )
+    changed_response = transformed_response(pipeline(2))
+    assert "<HTML>CHANGED PAGE</HTML>" == changed_response["body"]
+    assert 3 == len(transform_calls)
+    # Bare lists of transforms have no version so are not memoized
+    _build_response_from_s3_object(
+        "/public.html", "dummy", pylambda_list=[ upper_case ]
+    )
+    _build_response_from_s3_object(
+        "/public.html", "dummy", pylambda_list=[ upper_case ]
+    )
+    mock_s3_client.dispose()
+    assert 5 == len(transform_calls)
+
+def test_cache_control_policy():
+    policy = CacheControlPolicy.from_json("""[
+        { "path": "/assets/*", "max_age": 31536000, "immutable": true },
+        { "content_type": "text/*", "max_age": 60, "stale_while_revalidate": 600 },
+        { "path": "/private/*", "no_store": true }
+    ]""")
+    assert "max-age=31536000, immutable" == policy.directives_for(
+        "/assets/app.js", "text/javascript"
+    )
+    assert "max-age=60, stale-while-revalidate=600" == policy.directives_for(
+        "/private/page.html", "text/html"
+    )
+    assert "no-store" == policy.directives_for("/private/data.bin", None)
+    assert policy.directives_for("/data.bin", "application/octet-stream") is None
+    for invalid_policy_json in ( '{}', '[ { "max_aeg": 1 } ]', '[' ):
+        try:
+            CacheControlPolicy.from_json(invalid_policy_json)
+            assert False, invalid_policy_json
+        except ValueError:
+            pass
+
+def test_cache_control_applied_to_responses():
+    doc_event = {
+        "requestContext": {
+            "http": { "method": "GET", "path": "/public.html" }
+        },
+        "body": ""
+    }
+    mock_s3_client = MockS3Client(_SIMULATED_BUCKET_CONTENTS)
+    mock_s3_client.set_envvar(
+        ENVVAR_CACHE_CONTROL_POLICY,
+        '[ { "content_type": "text/html", "max_age": 300 } ]'
+    )
+    doc_response = lambda_handler(doc_event,context=None)
+    doc_event["requestContext"]["http"]["path"] = "/nonexistent.html"
+    not_found_response = lambda_handler(doc_event,context=None)
+    mock_s3_client.set_envvar(ENVVAR_CACHE_CONTROL_POLICY,None)
+    mock_s3_client.dispose()
+    assert "max-age=300" == doc_response["headers"]["Cache-Control"]
+    assert "Cache-Control" not in not_found_response["headers"]
+
+def test_log_sampling():
+    mock_s3_client = MockS3Client()
+    mock_s3_client.set_envvar(ENVVAR_LOG_SAMPLE_RATE,"3")
+    sampled = [ begin_request_log() for _ in range(0,6) ]
+    mock_s3_client.set_envvar(ENVVAR_LOG_SAMPLE_RATE,None)
+    mock_s3_client.dispose()
+    assert 2 == sampled.count(True)
+    assert begin_request_log() is True
+
+def test_response_summary_omits_body(caplog):
+    response = { "statusCode": 200, "headers": {}, "body": "x" * 1000 }
+    with caplog.at_level(logging.INFO):
+        begin_request_log()
+        serialize_response_for_log("response", response)
+    assert "<1000 characters long>" in caplog.text
+    assert "xxx" not in caplog.text
+    assert "x" * 1000 == response["body"]
+
+def test_async_log_records_snapshot_responses():
+    log_queue = queue.SimpleQueue()
+    queue_handler = waste.handler.shared._DeferredFormatQueueHandler(log_queue)
+    root_logger = logging.getLogger()
+    root_logger.addHandler(queue_handler)
+    response = {
+        "statusCode": 200, "headers": { "ETag": '"abc"' }, "body": "x" * 1000
+    }
+    try:
+        begin_request_log()
+        serialize_response_for_log("response", response)
+        serialize_object_for_log("prelude", response)
+    finally:
+        root_logger.removeHandler(queue_handler)
+    # Headers added after the response is logged, before the records
+    # are formatted on the listener thread, are not logged
+    response["headers"]["Server-Timing"] = "total;dur=1"
+    response["isBase64Encoded"] = False
+    for _ in range(0,2):
+        message = log_queue.get_nowait().getMessage()
+        assert "abc" in message
+        assert "Server-Timing" not in message
+        assert "isBase64Encoded" not in message
+
+def test_s3_client_is_shared_and_configured():
+    mock_s3_client = MockS3Client()
+    mock_s3_client.set_envvar(ENVVAR_S3_MAX_POOL_CONNECTIONS,"32")
+    mock_s3_client.set_envvar(ENVVAR_S3_READ_TIMEOUT,"5")
+    config = s3_client_config()
+    mock_s3_client.set_envvar(ENVVAR_S3_MAX_POOL_CONNECTIONS,None)
+    mock_s3_client.set_envvar(ENVVAR_S3_READ_TIMEOUT,None)
+    assert 32 == config.max_pool_connections
+    assert 5.0 == config.read_timeout
+    assert config.tcp_keepalive is True
+    assert "adaptive" == config.retries["mode"]
+    assert mock_s3_client is get_mockable_s3_client()
+    mock_s3_client.dispose()
+    # Outside tests one client is created and reused
+    s3_client = get_mockable_s3_client()
+    assert s3_client is get_mockable_s3_client()
+    assert config.tcp_keepalive == s3_client.meta.config.tcp_keepalive
+
+def test_streaming_handler():
+    large_body = bytes(range(0,256)) * 1024
+    large_etag = '"%s"' % (hashlib.md5(large_body).hexdigest(),)
+    mock_s3_client = MockS3Client(_SIMULATED_BUCKET_CONTENTS)
+    mock_s3_client.mock_put_object(
+        "/streamed.bin", "application/octet-stream", large_body
+    )
+    def request(path, headers={}):
+        return collect_streamed_response(streaming_lambda_handler({
+            "requestContext": { "http": { "method": "GET", "path": path } },
+            "body": "",
+            "headers": headers
+        },context=None))
+    override_max_body_length(400)
+    try:
+        # Objects are streamed from S3 unencoded, in chunks, to their
+        # full length regardless of the maximum body length
+        response = request("/streamed.bin")
+        assert 200 == response["statusCode"]
+        assert large_body == response["body"]
+        assert 1 < response["bodyChunkCount"]
+        assert len(large_body) == response["headers"]["Content-Length"]
+        assert large_etag == response["headers"]["ETag"]
+        assert [ ( "/streamed.bin", None ) ] == mock_s3_client.get_object_calls
+        # A single range is fetched and streamed whole
+        mock_s3_client.get_object_calls = []
+        response = request("/streamed.bin", { "Range": "bytes=1000-" })
+        assert 206 == response["statusCode"]
+        assert large_body[1000:] == response["body"]
+        assert "bytes 1000-262143/262144" == response["headers"]["Content-Range"]
+        assert [ ( "/streamed.bin", "bytes=1000-" ) ] == (
+            mock_s3_client.get_object_calls
+        )
+        # If the object has changed the whole object is streamed
+        response = request("/streamed.bin", {
+            "Range": "bytes=1000-", "If-Range": '"stale"'
+        })
+        assert 200 == response["statusCode"]
+        assert large_body == response["body"]
+        response = request("/streamed.bin", {
+            "Range": "bytes=1000-", "If-Range": large_etag
+        })
+        assert 206 == response["statusCode"]
+        response = request("/streamed.bin", { "Range": "bytes=300000-" })
+        assert 416 == response["statusCode"]
+        response = request("/public.html")
+        assert 200 == response["statusCode"]
+        assert b"<html>Public HTML</html>" == response["body"]
+        assert "text/html" == response["headers"]["Content-Type"]
+        response = request("/missing.html")
+        assert 404 == response["statusCode"]
+    finally:
+        override_max_body_length()
+        mock_s3_client.dispose()
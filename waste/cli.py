@@ -11,6 +11,7 @@
 
 import argparse
 import logging
+import os
 import sys
 import traceback
 
@@ -21,26 +22,35 @@ import botocore
 _logger = logging.getLogger()
 _logger.setLevel(logging.INFO)
 
-try:
-    from .deploy.deploy_support import deploy_app
-    from .deploy.retire_support import retire_app
-    from .deploy.content_support import content_dir_to_in_memory_zip_stream
-    from .handler.shared import serialize_exception_for_log
-except botocore.exceptions.ClientError as e:
-    if "InvalidClientTokenId" in str(e):
-        logging.error("Environment does not contain a valid AWS token")
-        sys.exit(2)
-    else:
-        raise
+from .deploy.content_support import content_dir_to_in_memory_zip_stream
+from .deploy.content_support import build_cache_archive, cache_archive_report
+from .handler.shared import serialize_exception_for_log
+from .handler.cache_control import CacheControlPolicy
+
+def _import_aws_actions():
+    # The deployment modules connect to AWS when they are imported,
+    # so they are only imported for the actions which need them
+    try:
+        from .deploy.deploy_support import deploy_app
+        from .deploy.retire_support import retire_app
+    except botocore.exceptions.ClientError as e:
+        if "InvalidClientTokenId" in str(e):
+            logging.error("Environment does not contain a valid AWS token")
+            sys.exit(2)
+        else:
+            raise
+    return deploy_app, retire_app
 
 _ACTION_DEPLOY="deploy"
 _ACTION_RETIRE="retire"
+_ACTION_BUILD_CACHE="build-cache"
 
 class ArgParser(argparse.ArgumentParser):
     def __init__(self):
         super().__init__()
         self.add_argument(
-            "action", type=str, choices=[_ACTION_DEPLOY,_ACTION_RETIRE],
+            "action", type=str,
+            choices=[_ACTION_DEPLOY,_ACTION_RETIRE,_ACTION_BUILD_CACHE],
             help="Operation to be performed"
         )
         self.add_argument(
@@ -63,6 +73,24 @@ class ArgParser(argparse.ArgumentParser):
             help="Zipfile path under content_dir containing files to be cached in memory"
                 " (ignored if action=" + _ACTION_RETIRE + ")"
         )
+        self.add_argument(
+            "--cache-control-policy", type=str, action="store", default=None,
+            help="Path of a JSON file containing the Cache-Control policy rules"
+                " to be applied to responses"
+                " (ignored if action=" + _ACTION_RETIRE + ")"
+        )
+        self.add_argument(
+            "--output", type=str, action="store", default=None,
+            help="Path of the cache archive to be built (.zip or .wpack)"
+                " (only used if action=" + _ACTION_BUILD_CACHE + ","
+                " default: <app_name>.zip)"
+        )
+        self.add_argument(
+            "--jobs", type=int, action="store", default=None,
+            help="Number of processes used to prepare cache archive entries"
+                " (only used if action=" + _ACTION_BUILD_CACHE + ","
+                " default: number of CPUs)"
+        )
         self.add_argument(
             "--preserve-outdated", action="store_true", 
             help="Suppress retirement of previously deployed baselines of the same app"
@@ -83,20 +111,44 @@ class ArgParser(argparse.ArgumentParser):
 arg_parser = ArgParser()
 args = arg_parser.parse_args()
 try:
+    if args.action in (_ACTION_DEPLOY,_ACTION_RETIRE):
+        deploy_app, retire_app = _import_aws_actions()
     if args.action==_ACTION_DEPLOY:
         content_zip_stream = None
         if args.content_dir is not None:
             content_zip_stream, _ = content_dir_to_in_memory_zip_stream(
                 args.content_dir
             )
+        cache_control_policy = None
+        if args.cache_control_policy is not None:
+            with open(args.cache_control_policy) as policy_file:
+                cache_control_policy = policy_file.read()
+            # Fail at deploy time rather than in the handler if the
+            # policy is not valid
+            CacheControlPolicy.from_json(cache_control_policy)
         deploy_app(
             args.app_name, content_zip_stream, 
             default_doc_name = args.index_doc, 
             cache_zip_path = args.cache_zip_path,
-            create_groups = args.create_iam_groups
+            create_groups = args.create_iam_groups,
+            cache_control_policy = cache_control_policy
         )
     elif args.action==_ACTION_RETIRE:
         retire_app(args.app_name)
+    elif args.action==_ACTION_BUILD_CACHE:
+        if args.content_dir is None:
+            print("--content-dir is required if action=" + _ACTION_BUILD_CACHE)
+            sys.exit(1)
+        output_path = args.output
+        if output_path is None:
+            output_path = args.app_name + ".zip"
+        index_records = build_cache_archive(
+            args.content_dir, output_path, max_workers=args.jobs
+        )
+        for report_line in cache_archive_report(
+            index_records, os.path.getsize(output_path)
+        ):
+            print(report_line)
     else:
         print("Unsupported action",args.action)
         arg_parser.print_help()
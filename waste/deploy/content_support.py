@@ -5,6 +5,14 @@ import os
 import io
 import zipfile
 import logging
+import concurrent.futures
+import math
+import struct
+import time
+import zlib
+
+from ..handler.shared import cache_memory_fraction
+from ..handler.wpack import WPACK_FILE_EXT, prepare_entry, write_prepared_wpack
 
 def content_dir_to_in_memory_zip_stream(content_dir):
     namelist = None
@@ -23,3 +31,193 @@ def content_dir_to_in_memory_zip_stream(content_dir):
         logging.info("Zipfile contents: %s",namelist)
     return in_memory_zip_stream, namelist
 
+
+def _prepare_content_file(file_path, arcname, for_zip=False):
+    # Runs in a worker process.
+    # For zip archives each entry is returned with its deflated form
+    # if it is to be deflated, or None if it is to be stored, so that
+    # the compression is done in the workers.
+    with open(file_path, "rb") as content_file:
+        body_bytes = content_file.read()
+    prepared_entries = prepare_entry(
+        arcname, body_bytes, os.path.getmtime(file_path)
+    )
+    if not for_zip:
+        return prepared_entries
+    return [
+        ( index_record, body_bytes, _deflate_if_worthwhile(body_bytes) )
+        for index_record, body_bytes in prepared_entries
+    ]
+
+def _content_dir_files(content_dir):
+    for walk_path, subdir_names, file_basenames in os.walk(content_dir):
+        for fbn in sorted(file_basenames):
+            file_path = os.path.join(walk_path, fbn)
+            file_relpath = os.path.relpath(file_path, content_dir)
+            yield file_path, "/" + file_relpath.replace(os.sep, "/")
+
+# Entries are deflated in zip archives if that saves at least this
+# fraction of their length
+_MIN_DEFLATE_SAVING = 0.1
+
+def _deflate_if_worthwhile(body_bytes):
+    # Returns the raw deflate stream of an entry, as zip members hold
+    # it, or None if the saving is not large enough to outweigh
+    # inflating the entry when it is served
+    if len(body_bytes) == 0:
+        return None
+    deflater = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    deflated_bytes = deflater.compress(body_bytes) + deflater.flush()
+    if len(deflated_bytes) <= len(body_bytes) * (1 - _MIN_DEFLATE_SAVING):
+        return deflated_bytes
+    return None
+
+# Archives which would exceed these limits need the zip64 extensions
+_ZIP_MAX_ENTRIES = 0xFFFF
+_ZIP_MAX_OFFSET = 0xFFFFFFFF
+# Made by and needed to extract: version 2.0, Unix
+_ZIP_VERSION = 20
+_ZIP_CREATE_SYSTEM = 3
+_ZIP_UTF8_NAME_FLAG = 0x800
+_ZIP_FILE_ATTRIBUTES = 0o100644 << 16
+
+def _zip_date_time(last_modified):
+    # Zip timestamps cannot precede 1980
+    return max(time.gmtime(last_modified)[:6], (1980, 1, 1, 0, 0, 0))
+
+def _write_prepared_zip(output_stream, prepared_entries):
+    # Entries which deflate well are deflated, so that the archive is
+    # small to download and to hold, others (e.g. images and .gz
+    # siblings) are stored so that they can be served from a
+    # memory-mapped archive without being inflated.
+    # The entries were deflated by the workers which prepared them, so
+    # the archive is written directly rather than with zipfile, which
+    # would deflate them again.
+    archive_len = sum(
+        len(deflated_bytes if deflated_bytes is not None else body_bytes) +
+        2 * len(index_record["path"].encode("utf-8")) + 76
+        for index_record, body_bytes, deflated_bytes in prepared_entries
+    )
+    if (
+        len(prepared_entries) >= _ZIP_MAX_ENTRIES or
+        archive_len >= _ZIP_MAX_OFFSET
+    ):
+        _write_prepared_zip64(output_stream, prepared_entries)
+        return
+    central_directory = bytes()
+    offset = 0
+    for index_record, body_bytes, deflated_bytes in prepared_entries:
+        name_bytes = index_record["path"].encode("utf-8")
+        flag_bits = 0 if name_bytes.isascii() else _ZIP_UTF8_NAME_FLAG
+        if deflated_bytes is None:
+            compress_type, member_bytes = zipfile.ZIP_STORED, body_bytes
+        else:
+            compress_type, member_bytes = zipfile.ZIP_DEFLATED, deflated_bytes
+        year, month, day, hour, minute, second = _zip_date_time(
+            index_record["last_modified"]
+        )
+        dos_time = hour << 11 | minute << 5 | second // 2
+        dos_date = (year - 1980) << 9 | month << 5 | day
+        crc = zlib.crc32(body_bytes)
+        output_stream.write(struct.pack(
+            zipfile.structFileHeader, zipfile.stringFileHeader,
+            _ZIP_VERSION, 0, flag_bits, compress_type, dos_time, dos_date,
+            crc, len(member_bytes), len(body_bytes), len(name_bytes), 0
+        ) + name_bytes)
+        output_stream.write(member_bytes)
+        central_directory += struct.pack(
+            zipfile.structCentralDir, zipfile.stringCentralDir,
+            _ZIP_VERSION, _ZIP_CREATE_SYSTEM, _ZIP_VERSION, 0,
+            flag_bits, compress_type, dos_time, dos_date,
+            crc, len(member_bytes), len(body_bytes), len(name_bytes),
+            0, 0, 0, 0, _ZIP_FILE_ATTRIBUTES, offset
+        ) + name_bytes
+        offset += (
+            struct.calcsize(zipfile.structFileHeader) + len(name_bytes) +
+            len(member_bytes)
+        )
+    output_stream.write(central_directory)
+    output_stream.write(struct.pack(
+        zipfile.structEndArchive, zipfile.stringEndArchive,
+        0, 0, len(prepared_entries), len(prepared_entries),
+        len(central_directory), offset, 0
+    ))
+
+def _write_prepared_zip64(output_stream, prepared_entries):
+    # Archives too large for the plain zip format are written with
+    # zipfile, which deflates the entries to be deflated again
+    with zipfile.ZipFile(output_stream, "w", zipfile.ZIP_STORED) as cache_zip:
+        for index_record, body_bytes, deflated_bytes in prepared_entries:
+            zip_info = zipfile.ZipInfo(
+                index_record["path"],
+                date_time=_zip_date_time(index_record["last_modified"])
+            )
+            if deflated_bytes is not None:
+                zip_info.compress_type = zipfile.ZIP_DEFLATED
+            cache_zip.writestr(zip_info, body_bytes)
+
+def build_cache_archive(content_dir, output_path, max_workers=None):
+    # Builds a cache archive from the files under content_dir,
+    # preparing the entries (classification, hashing and
+    # precompression) on a process pool.
+    # The archive is a .wpack file if output_path ends with .wpack,
+    # otherwise a zip file.
+    # Returns the index records of the entries written.
+    content_files = list(_content_dir_files(content_dir))
+    logging.info(
+        "Preparing %d files from %s",len(content_files),content_dir
+    )
+    for_zip = not output_path.endswith(WPACK_FILE_EXT)
+    prepared_entries = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        for prepared_file_entries in executor.map(
+            _prepare_content_file,
+            [ file_path for file_path, _ in content_files ],
+            [ arcname for _, arcname in content_files ],
+            [ for_zip ] * len(content_files),
+            chunksize=max(1, len(content_files) // 64)
+        ):
+            prepared_entries += prepared_file_entries
+    with open(output_path, "wb") as output_file:
+        if for_zip:
+            _write_prepared_zip(output_file, prepared_entries)
+        else:
+            write_prepared_wpack(output_file, prepared_entries)
+    return [ prepared_entry[0] for prepared_entry in prepared_entries ]
+
+def cache_archive_report(index_records, archive_size):
+    # Returns lines describing the size of an archive and the
+    # memory the caching handler will need to serve it
+    variant_records = [
+        index_record for index_record in index_records
+        if index_record["content_type"] == "application/gzip" and
+        index_record["path"].endswith(".gz")
+    ]
+    entry_count = len(index_records) - len(variant_records)
+    text_count = len([
+        index_record for index_record in index_records
+        if index_record["is_text"] is True
+    ])
+    content_bytes = sum(
+        index_record["length"] for index_record in index_records
+    ) - sum(index_record["length"] for index_record in variant_records)
+    # The caching handler keeps the archive and the decompressed
+    # entries within the fraction of the function's memory allocated
+    # to entries (divided between the shards whose caches are loaded)
+    minimum_memory_mb = int(math.ceil(
+        archive_size / cache_memory_fraction("entries") / (1024 * 1024)
+    ))
+    return [
+        "Entries: %d (%d text, %d binary)" % (
+            entry_count, text_count, entry_count - text_count
+        ),
+        "Content bytes: %d" % (content_bytes,),
+        "Precompressed variants: %d (%d bytes)" % (
+            len(variant_records),
+            sum(index_record["length"] for index_record in variant_records)
+        ),
+        "Archive bytes: %d" % (archive_size,),
+        "Minimum function memory to load the archive in full: %d MB" % (
+            minimum_memory_mb,
+        ),
+    ]
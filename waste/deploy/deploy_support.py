@@ -47,11 +47,16 @@ TEST_EVENT_FOR_HANDLER = {
 }
 
 from .kit_abstract_factory import create_factory_for_kit
+from ..handler.key_manifest import (
+    KeyManifest, KeyManifestEntry, KEY_MANIFEST_OBJECT_NAME
+)
 
 #TODO: Find a way of making a single definition span here and the handler
 ENVVAR_DEFAULT_DOCUMENT_NAME = "WASTE_DEFAULT_DOCUMENT_NAME"
 ENVVAR_CONTENT_BUCKET_NAME = "WASTE_CONTENT_BUCKET_NAME"
 ENVVAR_CACHE_OBJECT_NAME = "WASTE_CACHE_OBJECT_NAME"
+ENVVAR_CACHE_CONTROL_POLICY = "WASTE_CACHE_CONTROL_POLICY"
+ENVVAR_KEY_MANIFEST_NAME = "WASTE_KEY_MANIFEST_NAME"
 
 _factory = create_factory_for_kit()
 
@@ -78,7 +83,9 @@ def create_function(
     app_baseline_name='waste', 
     default_doc_name=None, 
     cache_zip_path=None,
-    do_test_invocation=True 
+    do_test_invocation=True,
+    cache_control_policy=None,
+    key_manifest_name=None
 ):
     retval = {}
     _lambda_zip_name = app_baseline_name + ".zip"
@@ -104,6 +111,10 @@ def create_function(
     if cache_zip_path is not None:
         fn_env_vars[ENVVAR_CACHE_OBJECT_NAME] = cache_zip_path
         which_handler = 'handler.caching_lambda_handler.lambda_handler'
+    if cache_control_policy is not None:
+        fn_env_vars[ENVVAR_CACHE_CONTROL_POLICY] = cache_control_policy
+    if key_manifest_name is not None:
+        fn_env_vars[ENVVAR_KEY_MANIFEST_NAME] = key_manifest_name
     create_fn_response = lambda_client.create_function(
         FunctionName=app_baseline_name,
         Runtime='python3.12',
@@ -178,6 +189,8 @@ def create_function(
     return retval
 
 def create_bucket(app_bucket_name, content_zip_stream=None):
+    # Returns the key of the manifest of the content written to
+    # the bucket, or None if no content was written
     create_bucket_response = s3_client.create_bucket(
         Bucket=app_bucket_name,
         ACL = 'private',
@@ -204,6 +217,7 @@ def create_bucket(app_bucket_name, content_zip_stream=None):
     # Populate the bucket (if content is provided)
     if content_zip_stream is not None:
         last_bucket_key = None
+        manifest_entries = []
         with zipfile.ZipFile(content_zip_stream) as content_zip_file:
             for object_name in content_zip_file.namelist():
                 _logger.info("Adding %s",object_name)
@@ -213,19 +227,33 @@ def create_bucket(app_bucket_name, content_zip_stream=None):
                 content_type, _  = mimetypes.guess_type(object_name,strict=True)
                 if content_type is None or "/" not in content_type: #pragma: nocover
                     content_type = "application/octet-stream"
-                s3_client.put_object(
+                body_bytes = content_zip_file.read(object_name)
+                put_object_response = s3_client.put_object(
                     Bucket = app_bucket_name,
                     Key = bucket_key,
-                    Body = content_zip_file.read(object_name),
+                    Body = body_bytes,
                     ContentType =  content_type
                 )
+                manifest_entries += [ KeyManifestEntry(
+                    bucket_key, len(body_bytes),
+                    put_object_response["ETag"], content_type
+                ) ]
                 last_bucket_key = bucket_key
+        _logger.info("Adding key manifest %s",KEY_MANIFEST_OBJECT_NAME)
+        s3_client.put_object(
+            Bucket = app_bucket_name,
+            Key = KEY_MANIFEST_OBJECT_NAME,
+            Body = KeyManifest(manifest_entries).to_json().encode("utf-8"),
+            ContentType = "application/json"
+        )
         # Loop until the last object created is retrievable
         logging.info("Waiting for last uploaded object to be retrievable")
         get_last_object_response = s3_client.get_object(
             Bucket = app_bucket_name,
             Key = last_bucket_key
         )
+        return KEY_MANIFEST_OBJECT_NAME
+    return None
 
 def deploy_api(app_baseline_name,lambda_deployment_result, api_key):
     get_fn_response = lambda_client.get_function(FunctionName=app_baseline_name)
@@ -331,12 +359,16 @@ def deploy_bucket(app_baseline_name,initial_bucket_content_zip=None):
 def deploy_lambda(
     app_baseline_name, 
     default_doc_name, 
-    cache_zip_path=None
+    cache_zip_path=None,
+    cache_control_policy=None,
+    key_manifest_name=None
 ):
     return create_function(
         app_baseline_name, 
         default_doc_name, 
-        cache_zip_path
+        cache_zip_path,
+        cache_control_policy=cache_control_policy,
+        key_manifest_name=key_manifest_name
     )
 
 def generate_random_api_key():
@@ -348,7 +380,8 @@ def deploy_app(
     default_doc_name=None, 
     cache_zip_path=None,
     create_groups=True,
-    api_key=None
+    api_key=None,
+    cache_control_policy=None
 ):
     logging.info("")
 
@@ -356,13 +389,15 @@ def deploy_app(
     logging.info("app_baseline_name: %s",app_baseline_name)
 
     # Create a default content bucket for the app
-    deploy_bucket_result = deploy_bucket(app_baseline_name,content_zip_stream)
+    key_manifest_name = deploy_bucket(app_baseline_name,content_zip_stream)
 
     logging.info("Deploying lambda")
     lambda_deployment_result = deploy_lambda(
         app_baseline_name,
         default_doc_name,
-        cache_zip_path
+        cache_zip_path,
+        cache_control_policy,
+        key_manifest_name
     )
     logging.info("Deploying API")
     if api_key == "*":
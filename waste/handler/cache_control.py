@@ -0,0 +1,140 @@
+# python3
+# waste/handler/cache_control.py
+
+# Copyright Tim Littlefair 2020-
+# This file is open source software under the MIT license.
+# For terms of this license, see the file LICENSE in the source
+# code distribution or visit
+# https://opensource.org/licenses/mit-license.php
+
+# This file implements the declarative Cache-Control policy which
+# both handlers apply to the responses they return.
+# The policy is a JSON list of rules, set at deploy time in the
+# environment variable named by ENVVAR_CACHE_CONTROL_POLICY, e.g.
+# [
+#     { "path": "/assets/*", "max_age": 31536000, "immutable": true },
+#     { "content_type": "text/html", "max_age": 60,
+#       "stale_while_revalidate": 600 },
+#     { "path": "/private/*", "no_store": true }
+# ]
+# The first rule whose path glob and/or content type glob match
+# the request determines the Cache-Control header.  Responses which
+# match no rule are returned without a Cache-Control header.
+
+import fnmatch
+import json
+import logging
+import os
+
+from .shared import HDR_CONTENT_TYPE_KEY
+
+ENVVAR_CACHE_CONTROL_POLICY = "WASTE_CACHE_CONTROL_POLICY"
+HDR_CACHE_CONTROL_KEY = 'Cache-Control'
+
+_RULE_MATCH_KEYS = ( "path", "content_type" )
+_RULE_DIRECTIVE_KEYS = (
+    "max_age", "immutable", "stale_while_revalidate", "no_store"
+)
+
+# Only successful and not modified responses are cacheable
+_CACHEABLE_STATUS_CODES = ( 200, 206, 304 )
+
+
+class CacheControlPolicy:
+
+    def __init__(self, rules=[]):
+        for rule in rules:
+            if not isinstance(rule, dict):
+                raise ValueError("Cache control rule %s is not an object" % (rule,))
+            unknown_keys = set(rule) - set(_RULE_MATCH_KEYS + _RULE_DIRECTIVE_KEYS)
+            if len(unknown_keys) > 0:
+                raise ValueError(
+                    "Unknown keys %s in cache control rule %s" % (
+                        sorted(unknown_keys), rule
+                    )
+                )
+        self.rules = [
+            ( rule, self._directives_for_rule(rule) ) for rule in rules
+        ]
+
+    @staticmethod
+    def from_json(policy_json):
+        rules = json.loads(policy_json)
+        if not isinstance(rules, list):
+            raise ValueError("Cache control policy must be a JSON list")
+        return CacheControlPolicy(rules)
+
+    @staticmethod
+    def _directives_for_rule(rule):
+        if rule.get("no_store", False) is True:
+            return "no-store"
+        directives = []
+        if "max_age" in rule:
+            directives += [ "max-age=%d" % (int(rule["max_age"]),) ]
+        if rule.get("immutable", False) is True:
+            directives += [ "immutable" ]
+        if "stale_while_revalidate" in rule:
+            directives += [
+                "stale-while-revalidate=%d" % (
+                    int(rule["stale_while_revalidate"]),
+                )
+            ]
+        if len(directives) == 0:
+            return None
+        return ", ".join(directives)
+
+    def directives_for(self, path, content_type):
+        # Returns the Cache-Control header value for a request
+        # path and response content type, or None
+        for rule, rule_directives in self.rules:
+            if "path" in rule and not fnmatch.fnmatchcase(
+                path, rule["path"]
+            ):
+                continue
+            if "content_type" in rule and not fnmatch.fnmatchcase(
+                content_type or "", rule["content_type"]
+            ):
+                continue
+            return rule_directives
+        return None
+
+    def apply(self, request_path, response):
+        if response.get("statusCode") not in _CACHEABLE_STATUS_CODES:
+            return response
+        if not request_path.startswith("/"):
+            request_path = "/" + request_path
+        content_type = response.get("headers",{}).get(HDR_CONTENT_TYPE_KEY)
+        if content_type is not None:
+            # Match on the media type without parameters
+            content_type = content_type.split(";")[0].strip()
+        directives = self.directives_for(request_path, content_type)
+        if directives is not None:
+            response.setdefault("headers",{})[HDR_CACHE_CONTROL_KEY] = directives
+        return response
+
+
+# The policy is parsed once per sandbox, or again if the
+# environment variable changes (which only happens in tests)
+_policy_json = None
+_policy = CacheControlPolicy()
+
+def get_cache_control_policy():
+    global _policy_json, _policy
+    policy_json = os.environ.get(ENVVAR_CACHE_CONTROL_POLICY, None)
+    if policy_json != _policy_json:
+        _policy_json = policy_json
+        try:
+            if policy_json is None:
+                _policy = CacheControlPolicy()
+            else:
+                _policy = CacheControlPolicy.from_json(policy_json)
+        except ValueError:
+            # The policy is validated at deploy time, so this should
+            # not happen: serve responses without Cache-Control
+            # rather than failing every request
+            logging.error("Ignoring invalid cache control policy %s",policy_json)
+            _policy = CacheControlPolicy()
+    return _policy
+
+def apply_cache_control(request_path, response):
+    return get_cache_control_policy().apply(request_path, response)
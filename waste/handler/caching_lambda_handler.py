@@ -10,129 +10,1574 @@
 # This file implements an alternative lambda handler which creates and
 # loads a memory resident cache, and serves requests from there.
 
-import copy
+import collections
+import concurrent.futures
+import datetime
+import fnmatch
+import gzip
+import hashlib
 import io
+import json
 import logging
+import mimetypes
+import mmap
 import os
-import pathlib
+import re
+import struct
+import threading
+import time
 import zipfile
 
+import botocore.exceptions
+
+try:
+    # Brotli is not part of the Lambda python runtime, it is used
+    # for on-the-fly compression only if it has been packaged
+    # alongside the handler
+    import brotli
+except ImportError:
+    brotli = None
+
 # sibling file shared.py contains common definitions which are
 # used by both handlers
 from .shared import HDR_CONTENT_TYPE_KEY, JSON_CONTENT_TYPE_KEY
 from .shared import logger, debug_log, serialize_object_for_log
+from .shared import serialize_response_for_log, begin_request_log
 from .shared import serialize_exception_for_log
 from .shared import get_http_header
 from .shared import (
     ENVVAR_DEFAULT_DOCUMENT_NAME, 
     ENVVAR_CONTENT_BUCKET_NAME,
-    ENVVAR_CACHE_OBJECT_NAME
+    ENVVAR_CACHE_OBJECT_NAME,
+    ENVVAR_PINNED_ENTRIES,
+    ENVVAR_CACHE_SPOOL_DIR,
+    ENVVAR_CACHE_LAZY,
+    ENVVAR_CACHE_DOWNLOAD_PART_SIZE,
+    ENVVAR_CACHE_DOWNLOAD_CONCURRENCY,
+    ENVVAR_CACHE_RELOAD_INTERVAL,
+    ENVVAR_CACHE_SHARDS
 )
 from .shared import get_mockable_s3_client
-from .shared import build_positive_response
+from .shared import build_positive_response, apply_if_range
+from .shared import build_encoded_response, fits_in_single_response
+from .shared import encode_body_bytes
+from .shared import cache_memory_budget, ByteBudgetLRU
+from .shared import HDR_ETAG_KEY, HDR_LAST_MODIFIED_KEY
+from .shared import is_not_modified, build_not_modified_response, http_date
+from .shared import HDR_CONTENT_ENCODING_KEY, HDR_VARY_KEY
+from .shared import negotiate_content_encoding
+
+from .cache_control import apply_cache_control
+from .metrics import phase, begin_request_timing, end_request_timing
+from .metrics import set_cache_result
+from .metrics import PHASE_CACHE_LOAD, PHASE_CACHE_LOOKUP, PHASE_S3_GET
+from .metrics import PHASE_DECOMPRESS
+from .metrics import (
+    CACHE_RESULT_HIT, CACHE_RESULT_MEMO,
+    CACHE_RESULT_NOT_MODIFIED, CACHE_RESULT_MISS
+)
+from .streaming import stream_document, streamed_response
+from .streaming import split_buffered_response
 
-from .simple_lambda_handler import lambda_handler as simple_lambda_handler
+from .simple_lambda_handler import handle_request as simple_handle_request
+from .simple_lambda_handler import stream_request as simple_stream_request
+from .wpack import WPACK_FILE_EXT, WpackArchive, WpackEntry
 
 ZIP_FILE_EXT = ".zip"
 
+# Approximate per-response cost of the response dict and headers
+_RESPONSE_MEMO_ENTRY_OVERHEAD = 512
+
+class ResponseMemo(ByteBudgetLRU):
+    # LRU of finished responses, bounded by the total length of
+    # the response bodies it holds
+
+    def __init__(self, byte_budget=None):
+        if byte_budget is None:
+            byte_budget = cache_memory_budget("responses")
+        super().__init__(byte_budget)
+
+    def _cost(self, response):
+        return len(response.get("body","")) + _RESPONSE_MEMO_ENTRY_OVERHEAD
+
+    @staticmethod
+    def _copy_response(response):
+        # Bodies are immutable strings and can be shared, but
+        # callers may add headers to the response they receive
+        return dict(response, headers=dict(response["headers"]))
+
+    def get(self, key):
+        response = self._lookup(key)
+        if response is None:
+            return None
+        return self._copy_response(response)
+
+    def put(self, key, response):
+        self._store(key, self._copy_response(response))
+
+
+# Entries larger than this fraction of the entry cache budget
+# are not admitted, so that one large entry does not flush
+# the others
+_ENTRY_CACHE_MAX_ENTRY_FRACTION = 0.25
+
+class EntryCache(ByteBudgetLRU):
+    # LRU of decompressed archive entries.
+    # Pinned entries are never evicted, but count against the budget.
+
+    def __init__(self, byte_budget):
+        super().__init__(byte_budget)
+        self._pinned = {}
+
+    def _cost(self, entry_bytes):
+        return len(entry_bytes)
+
+    def admits(self, entry_size):
+        return entry_size <= self.byte_budget * _ENTRY_CACHE_MAX_ENTRY_FRACTION
+
+    def get(self, file_name):
+        entry_bytes = self._pinned.get(file_name)
+        if entry_bytes is not None:
+            self.hits += 1
+            return entry_bytes
+        return self._lookup(file_name)
+
+    def put(self, file_name, entry_bytes):
+        if self.admits(len(entry_bytes)):
+            self._store(file_name, entry_bytes)
+
+    def pin(self, file_name, entry_bytes):
+        if file_name in self._values:
+            self.bytes_used -= self._cost(self._values.pop(file_name))
+        if file_name in self._pinned or not self._make_room(len(entry_bytes)):
+            return False
+        self._pinned[file_name] = entry_bytes
+        self.bytes_used += len(entry_bytes)
+        return True
+
+    def stats(self):
+        stats = super().stats()
+        stats["pinned_entries"] = len(self._pinned)
+        return stats
+
+
+# Size of the fixed part of a zip local file header, and the offset
+# within it of the lengths of the file name and extra field
+_ZIP_LOCAL_HEADER_SIZE = 30
+_ZIP_LOCAL_HEADER_NAME_LENGTHS_OFFSET = 26
+_ZIP_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+def _member_data_offset(header_offset, local_header):
+    # Returns the offset in the archive of the data of the member
+    # whose local header is at header_offset, or None if local_header
+    # (the fixed size part of it) is not valid
+    if not local_header.startswith(_ZIP_LOCAL_HEADER_SIGNATURE):
+        return None
+    name_length, extra_length = struct.unpack_from(
+        "<HH", local_header, _ZIP_LOCAL_HEADER_NAME_LENGTHS_OFFSET
+    )
+    return header_offset + _ZIP_LOCAL_HEADER_SIZE + name_length + extra_length
+
+class MemoryViewStream:
+    # Read-only stream over a memoryview whose reads return slices
+    # of the view rather than copies
+
+    def __init__(self, view):
+        self._view = view
+        self._position = 0
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        start = min(self._position, len(self._view))
+        if size is None or size < 0:
+            stop = len(self._view)
+        else:
+            stop = min(start + size, len(self._view))
+        self._position = stop
+        return self._view[start:stop]
+
+    def close(self):
+        pass
+
+class SharedMemberStream:
+    # Read-only stream over an archive member which shares one open
+    # stream of the member with the other SharedMemberStreams over it,
+    # seeking that stream to its own position before each read.
+    # A stream of a compressed member can only seek by decompressing
+    # everything before the new position (from the start of the member
+    # if the position is behind it), so reads which continue from where
+    # the last one stopped, as the chunks of a chunked download do,
+    # cost time in proportion to their length rather than their offset.
+
+    def __init__(self, member_stream, size):
+        self._member_stream = member_stream
+        self._size = size
+        self._position = 0
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        if self._member_stream.tell() != self._position:
+            self._member_stream.seek(self._position)
+        chunk = self._member_stream.read(size)
+        self._position += len(chunk)
+        return chunk
+
+    def close(self):
+        pass
+
+class MemberWindowStream:
+    # Read-only stream over a stored member of a lazily loaded
+    # archive, each read of which fetches only the bytes it returns
+
+    def __init__(self, range_reader, data_offset, size):
+        self._range_reader = range_reader
+        self._data_offset = data_offset
+        self._size = size
+        self._position = 0
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        start = min(self._position, self._size)
+        if size is None or size < 0:
+            stop = self._size
+        else:
+            stop = min(start + size, self._size)
+        window_bytes = self._range_reader.read_range(
+            self._data_offset + start, self._data_offset + stop
+        )
+        self._position = start + len(window_bytes)
+        return window_bytes
+
+    def close(self):
+        pass
+
+# Number of members streamed from the archive whose open streams
+# are kept between requests
+_MAX_OPEN_MEMBERS = 2
+
+
+_DEFAULT_DOWNLOAD_PART_SIZE = 8 * 1024 * 1024
+_DEFAULT_DOWNLOAD_CONCURRENCY = 8
+# Number of hex digits of the hash of an object's bucket and key
+# in the names of local copies of it
+_SPOOL_KEY_HASH_LENGTH = 16
+
+def _parse_content_range(content_range):
+    # Returns the first byte and the object size from a
+    # Content-Range header of the form 'bytes first-last/size'
+    first_last, _, size = content_range.split(" ")[-1].partition("/")
+    return int(first_last.partition("-")[0]), int(size)
+
+def download_s3_object(
+    s3_client, bucket_name, object_name,
+    part_size=_DEFAULT_DOWNLOAD_PART_SIZE,
+    concurrency=_DEFAULT_DOWNLOAD_CONCURRENCY,
+    spool_file=None, etag=None
+):
+    # Downloads an S3 object with concurrent ranged GETs, in the same
+    # way as the S3 transfer manager.
+    # The first part also gives the size of the object, the remaining
+    # parts are fetched on a thread pool, each one conditional on the
+    # ETag of the first so that the parts of an object which is
+    # replaced during the download are not mixed.
+    # If etag is given, the first part is also conditional on it.
+    # Parts are written into spool_file if one is given, otherwise
+    # into a buffer of the size of the object, which is returned as
+    # a stream, along with the ETag of the object.
+    get_object_params = {
+        "Bucket": bucket_name, "Key": object_name,
+        "Range": "bytes=0-%d" % (part_size - 1,)
+    }
+    if etag is not None:
+        get_object_params["IfMatch"] = etag
+    s3_get_response = s3_client.get_object(**get_object_params)
+    first_part = s3_get_response["Body"].read()
+    _, object_size = _parse_content_range(s3_get_response["ContentRange"])
+    etag = s3_get_response.get("ETag", etag)
+    if spool_file is not None:
+        spool_file.truncate(object_size)
+        def write_part(part_start, part_bytes):
+            os.pwrite(spool_file.fileno(), part_bytes, part_start)
+    else:
+        object_stream = io.BytesIO()
+        if object_size > 0:
+            # Writing the last byte allocates the whole buffer once
+            object_stream.seek(object_size - 1)
+            object_stream.write(b"\0")
+        object_view = object_stream.getbuffer()
+        def write_part(part_start, part_bytes):
+            object_view[part_start:part_start + len(part_bytes)] = part_bytes
+    def download_part(part_start):
+        get_object_params = {
+            "Bucket": bucket_name, "Key": object_name,
+            "Range": "bytes=%d-%d" % (
+                part_start, min(part_start + part_size, object_size) - 1
+            )
+        }
+        if etag is not None:
+            get_object_params["IfMatch"] = etag
+        write_part(
+            part_start,
+            s3_client.get_object(**get_object_params)["Body"].read()
+        )
+    write_part(0, first_part)
+    del first_part
+    part_starts = list(range(part_size, object_size, part_size))
+    debug_log(
+        "Downloading %d bytes of %s in %d parts",
+        object_size, object_name, len(part_starts) + 1
+    )
+    if len(part_starts) > 0:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, concurrency)
+        ) as executor:
+            # Iterating over the results raises the first
+            # exception from any part
+            for _ in executor.map(download_part, part_starts):
+                pass
+    if spool_file is not None:
+        return None, etag
+    object_view.release()
+    object_stream.seek(0)
+    return object_stream, etag
+
+class CacheObjectChanged(Exception):
+    # Raised when a member of a lazily loaded archive is read after
+    # the cache object has been replaced in S3
+    pass
+
+# The end of central directory record is 22 bytes long and may be
+# followed by a comment of up to 65535 bytes
+_ZIP_TAIL_FETCH_SIZE = 22 + 65535
+
+class S3RangeReader:
+    # Seekable read-only stream over an S3 object which holds only
+    # the byte ranges which have been fetched with ranged GETs.
+    # Reads of bytes which have not been fetched issue a GET for
+    # exactly the bytes read, so callers which know which bytes they
+    # will need should fetch() them first.
+
+    def __init__(self, s3_client, bucket_name, object_name):
+        self._s3_client = s3_client
+        self._bucket_name = bucket_name
+        self._object_name = object_name
+        self._segments = {}
+        self._position = 0
+        self.get_count = 0
+        # Later GETs are conditional on the ETag returned with
+        # the tail, so that the ranges of different versions of
+        # the object are never mixed
+        self.etag = None
+        # Fetching the tail of the object finds its size and, for
+        # all but very large archives, the whole central directory
+        tail_start, tail_bytes, self.size = self._get_range(
+            "bytes=-%d" % (_ZIP_TAIL_FETCH_SIZE,)
+        )
+        self._segments[tail_start] = tail_bytes
+
+    def _get_range(self, range_header):
+        get_object_params = {
+            "Bucket": self._bucket_name, "Key": self._object_name,
+            "Range": range_header
+        }
+        if self.etag is not None:
+            get_object_params["IfMatch"] = self.etag
+        try:
+            with phase(PHASE_S3_GET):
+                s3_get_response = self._s3_client.get_object(**get_object_params)
+                range_bytes = s3_get_response["Body"].read()
+        except botocore.exceptions.ClientError as e:
+            if e.response.get("Error",{}).get("Code") == "PreconditionFailed":
+                raise CacheObjectChanged(self._object_name) from e
+            raise
+        self.get_count += 1
+        self.etag = s3_get_response.get("ETag", self.etag)
+        first, size = _parse_content_range(s3_get_response["ContentRange"])
+        return first, range_bytes, size
+
+    @property
+    def resident_size(self):
+        return sum(len(segment) for segment in self._segments.values())
+
+    def fetch(self, start, stop):
+        # Fetches bytes start to stop-1 and holds them until
+        # they are released
+        if self._find(start, stop) is None and stop > start:
+            first, range_bytes, _ = self._get_range(
+                "bytes=%d-%d" % (start, stop - 1)
+            )
+            self._segments[first] = range_bytes
+
+    def release(self, start):
+        self._segments.pop(start, None)
+
+    def release_all(self):
+        self._segments = {}
+
+    def _find(self, start, stop):
+        for segment_start, segment in self._segments.items():
+            if segment_start <= start and stop <= segment_start + len(segment):
+                return segment[start - segment_start:stop - segment_start]
+        return None
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        start = min(self._position, self.size)
+        if size is None or size < 0:
+            stop = self.size
+        else:
+            stop = min(start + size, self.size)
+        if self._find(start, stop) is None:
+            debug_log(
+                "Unplanned ranged GET of bytes %d-%d of %s",
+                start, stop - 1, self._object_name
+            )
+        range_bytes = self.read_range(start, stop)
+        self._position = start + len(range_bytes)
+        return range_bytes
+
+    def read_range(self, start, stop):
+        # Returns bytes start to stop-1, from the ranges held if they
+        # include them, otherwise with a GET for exactly those bytes
+        # which are not held afterwards
+        range_bytes = self._find(start, stop)
+        if range_bytes is None and stop > start:
+            _, range_bytes, _ = self._get_range(
+                "bytes=%d-%d" % (start, stop - 1)
+            )
+        return range_bytes or bytes()
+
+    def close(self):
+        pass
+
+
+class EncodedBodyCache(ByteBudgetLRU):
+    # LRU of (body_str, body_is_base64) tuples as returned by
+    # encode_body_bytes
+
+    def _cost(self, encoded_body):
+        return len(encoded_body[0])
+
+    def get(self, file_name):
+        return self._lookup(file_name)
+
+    def put(self, file_name, encoded_body):
+        self._store(file_name, encoded_body)
+
+# Entries larger than this fraction of the compressed body budget
+# are not compressed on demand, as their compressed copies could
+# not be kept
+_COMPRESSED_BODY_MAX_ENTRY_FRACTION = 0.25
+
+class CompressedBodyCache(ByteBudgetLRU):
+    # LRU of compressed copies of entries, keyed by
+    # (file_name, content_encoding)
+
+    def _cost(self, compressed_body):
+        return len(compressed_body)
+
+    def admits(self, entry_size):
+        # Compressed copies are assumed to be no larger than the entry
+        return (
+            entry_size <= self.byte_budget * _COMPRESSED_BODY_MAX_ENTRY_FRACTION
+        )
+
+    def get(self, file_name, content_encoding):
+        return self._lookup((file_name, content_encoding))
+
+    def put(self, file_name, content_encoding, compressed_body):
+        self._store((file_name, content_encoding), compressed_body)
+
+# Content encodings in order of server preference, with the
+# extension of the precompressed sibling entry for each
+_CONTENT_ENCODING_FILE_EXTS = collections.OrderedDict((
+    ( "br", ".br" ),
+    ( "gzip", ".gz" ),
+))
+_ON_THE_FLY_COMPRESSORS = {
+    "gzip": lambda body_bytes: gzip.compress(body_bytes, mtime=0),
+}
+if brotli is not None:
+    # brotli.compress only accepts bytes, not memoryviews
+    _ON_THE_FLY_COMPRESSORS["br"] = lambda body_bytes: brotli.compress(
+        bytes(body_bytes)
+    )
+
+# Entries smaller than this are not worth compressing
+_MIN_COMPRESSIBLE_SIZE = 1024
+
+def _is_compressible_content_type(content_type):
+    return (
+        content_type.startswith("text/") or
+        content_type.endswith("+xml") or
+        content_type.endswith("+json") or
+        content_type in (
+            "application/json",
+            "application/javascript",
+            "application/xml",
+        )
+    )
+
+# A form in which an entry can be served: the entry itself, a
+# precompressed sibling entry (source_name is the name of the
+# sibling) or a compressed copy made on demand (source_name is None).
+Representation = collections.namedtuple(
+    'Representation',
+    'file_name content_encoding source_name etag last_modified'
+)
+
 class Cache:
 
-    def __init__(self, search_subpaths=True):
+    def __init__(
+        self, search_subpaths=True,
+        encoded_body_budget=None,
+        compressed_body_budget=None,
+        default_doc_name=None, entry_cache_budget=None, spool_dir=None,
+        lazy=False,
+        download_part_size=_DEFAULT_DOWNLOAD_PART_SIZE,
+        download_concurrency=_DEFAULT_DOWNLOAD_CONCURRENCY,
+        memory_share=1.0
+    ):
         self.s3_object_name = None
+        self.s3_etag = None
         self.archive = None
+        self.archive_size = 0
+        # If spool_dir is set, archives loaded from S3 are written
+        # to a file in it and memory-mapped, and stored (uncompressed)
+        # members are served as views of the mapping without copying.
+        # The file is named for the object's ETag, so a later load
+        # (e.g. after the runtime is restarted in the same sandbox)
+        # which finds a copy of the current version does not need
+        # to download it again.
+        self.spool_dir = spool_dir
+        self._mapped_archive = None
+        # If lazy is True, archives loaded from S3 are read with
+        # ranged GETs: the central directory at load time and each
+        # member when it is first needed.
+        self.lazy = lazy
+        self._range_reader = None
+        self._member_extents = {}
+        # Open streams of the members which were most recently
+        # streamed from the archive
+        self._open_members = collections.OrderedDict()
+        # Offsets of the data of stored members of lazily loaded
+        # archives which have been streamed
+        self._member_data_offsets = {}
+        # Archives which are not loaded lazily are downloaded in
+        # parts with concurrent ranged GETs
+        self.download_part_size = download_part_size
+        self.download_concurrency = download_concurrency
         self.search_subpaths = search_subpaths
+        self.default_doc_name = default_doc_name
+        # Built once when the archive is loaded:
+        # _members maps archive member names to their ZipInfo records,
+        # _index maps normalized request paths to the ZipInfo records
+        # of the members served for them, including directory paths
+        # which resolve to a default document.
+        self._members = {}
+        self._index = {}
+        # Each entry is classified as text (valid UTF-8) or binary
+        # the first time it is read, so that later requests neither
+        # repeat the trial decode nor encode binary fragments twice.
+        self.entry_is_text = {}
+        # Entries requested more than once which fit in a single
+        # response have their encoded form retained in an LRU of
+        # encoded_body_budget characters, by default a fraction of
+        # the function's memory.
+        self._encoded_body_budget_given = encoded_body_budget is not None
+        if encoded_body_budget is None:
+            encoded_body_budget = cache_memory_budget(
+                "encoded_bodies", memory_share
+            )
+        self._entry_request_counts = {}
+        self._encoded_bodies = EncodedBodyCache(encoded_body_budget)
+        # Compressed copies of entries which have no precompressed
+        # sibling are retained in an LRU of compressed_body_budget
+        # bytes, by default a fraction of the function's memory.
+        self._compressed_body_budget_given = compressed_body_budget is not None
+        if compressed_body_budget is None:
+            compressed_body_budget = cache_memory_budget(
+                "compressed_bodies", memory_share
+            )
+        self._compressed_bodies = CompressedBodyCache(compressed_body_budget)
+        # Decompressed entries are held in an LRU whose budget, unless
+        # given, is what remains of the memory allocated to entries
+        # (or memory_share of it, if several caches share the
+        # function's memory) once the archive itself is loaded.
+        self.entry_cache_budget = entry_cache_budget
+        self.memory_share = memory_share
+        self.entry_cache = EntryCache(0)
+        self._resident_size = 0
 
     def load_from_stream(self, cache_object_name, cache_stream):
         if cache_object_name.endswith(ZIP_FILE_EXT):
             self.archive = zipfile.ZipFile(cache_stream, "r")
+        elif cache_object_name.endswith(WPACK_FILE_EXT):
+            self.archive = WpackArchive(cache_stream)
         else:
             logging.error(
                 "No archive type recognized for cache file name %s",
-                cache_file_name
+                cache_object_name
             )
             raise NotImplementedError
+        self.archive_size = cache_stream.seek(0, io.SEEK_END)
+        self._build_index()
+        # Streams which hold only part of the archive in memory
+        # report how much they hold
+        self._resident_size = getattr(
+            cache_stream, "resident_size", self.archive_size
+        )
+        entry_cache_budget = self._default_entry_cache_budget()
+        if self.entry_cache_budget is not None:
+            entry_cache_budget = self.entry_cache_budget
+        self.entry_cache = EntryCache(entry_cache_budget)
+        debug_log(
+            "Entry cache budget is %d bytes for an archive of %d bytes",
+            entry_cache_budget, self.archive_size
+        )
+
+    def _default_entry_cache_budget(self):
+        return max(0,
+            cache_memory_budget("entries", self.memory_share) -
+            self._resident_size
+        )
+
+    def set_memory_share(self, memory_share):
+        # Resizes the caches whose budgets were not given explicitly
+        # when the number of caches sharing the function's memory
+        # changes
+        self.memory_share = memory_share
+        if not self._encoded_body_budget_given:
+            self._encoded_bodies.resize(
+                cache_memory_budget("encoded_bodies", memory_share)
+            )
+        if not self._compressed_body_budget_given:
+            self._compressed_bodies.resize(
+                cache_memory_budget("compressed_bodies", memory_share)
+            )
+        if self.entry_cache_budget is None and self.archive is not None:
+            self.entry_cache.resize(self._default_entry_cache_budget())
+
+    @staticmethod
+    def _normalize_path(path):
+        return "/".join(part for part in path.split("/") if len(part) > 0)
+
+    def _build_index(self):
+        self._members = {}
+        self._index = {}
+        for zip_info in self.archive.infolist():
+            if zip_info.is_dir():
+                continue
+            self._members[zip_info.filename] = zip_info
+            self._index.setdefault(
+                self._normalize_path(zip_info.filename), zip_info
+            )
+            if isinstance(zip_info, WpackEntry) and zip_info.is_text is not None:
+                # .wpack archives record which entries are text
+                self.entry_is_text[zip_info.filename] = zip_info.is_text
+        if self.default_doc_name is not None:
+            # Directory paths resolve to the default document they
+            # contain, unless an entry has the same name as the directory
+            for normalized_path, zip_info in list(self._index.items()):
+                dir_path, _, base_name = normalized_path.rpartition("/")
+                if base_name == self.default_doc_name:
+                    self._index.setdefault(dir_path, zip_info)
+        debug_log(
+            "Cache index contains %d entries for %d paths",
+            len(self._members), len(self._index)
+        )
 
     def load_from_s3_object(self, bucket_name, cache_object_name):
         s3_client = get_mockable_s3_client()
+        if self.lazy is True and cache_object_name.endswith(WPACK_FILE_EXT):
+            # Lazy loading relies on the zip central directory
+            # being at the end of the archive
+            logging.warning(
+                "%s will be loaded in full, lazy loading is only "
+                "supported for zip archives", cache_object_name
+            )
+        elif self.lazy is True:
+            self.load_lazily_from_s3_object(
+                s3_client, bucket_name, cache_object_name
+            )
+            return
         debug_log(
             "About to do %s.get_object with params bucket_name=%s, key=%s",
             type(s3_client).__name__, bucket_name, cache_object_name
         )
-        s3_get_response = s3_client.get_object(
-            Bucket=bucket_name, Key=cache_object_name
+        if self.spool_dir is not None:
+            spool_path = self._spool_s3_object(
+                s3_client, bucket_name, cache_object_name
+            )
+            self.load_from_file(cache_object_name, spool_path)
+        else:
+            with phase(PHASE_S3_GET):
+                cache_stream, self.s3_etag = download_s3_object(
+                    s3_client, bucket_name, cache_object_name,
+                    self.download_part_size, self.download_concurrency
+                )
+            self.load_from_stream(cache_object_name, cache_stream)
+        self.s3_object_name = cache_object_name
+
+    def _spool_s3_object(self, s3_client, bucket_name, cache_object_name):
+        # Returns the path of a local copy of the current version of
+        # the cache object, downloading it only if there is none
+        with phase(PHASE_S3_GET):
+            s3_head_response = s3_client.head_object(
+                Bucket=bucket_name, Key=cache_object_name
+            )
+        etag = s3_head_response["ETag"]
+        self.s3_etag = etag
+        # Local copies are named for the object, a hash of its bucket
+        # and key (so that objects with the same name in different
+        # buckets or folders do not share copies) and its ETag
+        object_stem, object_ext = os.path.splitext(
+            os.path.basename(cache_object_name)
+        )
+        spool_prefix = "%s-%s-" % (
+            object_stem,
+            hashlib.sha256(
+                ("%s/%s" % (bucket_name, cache_object_name)).encode("utf-8")
+            ).hexdigest()[:_SPOOL_KEY_HASH_LENGTH]
+        )
+        spool_path = os.path.join(
+            self.spool_dir, "%s%s%s" % (
+                spool_prefix,
+                "".join(
+                    c if c.isalnum() else "_" for c in etag.strip('"')
+                ),
+                object_ext
+            )
         )
-        cache_stream = s3_get_response["Body"]
-        self.load_from_stream(
-            cache_object_name, 
-            io.BytesIO(cache_stream.read())
+        if (
+            os.path.exists(spool_path) and
+            os.path.getsize(spool_path) == s3_head_response["ContentLength"]
+        ):
+            debug_log("Using local copy %s of %s",spool_path,cache_object_name)
+            return spool_path
+        # The copy is only given its final name once it is complete,
+        # so that an interrupted download is never taken to be valid
+        partial_path = spool_path + ".partial"
+        with phase(PHASE_S3_GET):
+            with open(partial_path, "wb") as spool_file:
+                download_s3_object(
+                    s3_client, bucket_name, cache_object_name,
+                    self.download_part_size, self.download_concurrency,
+                    spool_file, etag
+                )
+        os.replace(partial_path, spool_path)
+        # Copies of earlier versions of this object, and downloads of
+        # them which were interrupted, are no longer needed
+        stale_copy_pattern = re.compile(
+            re.escape(spool_prefix) + r"\w+" + re.escape(object_ext) +
+            r"(\.partial)?$"
         )
+        for spool_file_name in os.listdir(self.spool_dir):
+            if (
+                stale_copy_pattern.match(spool_file_name) and
+                spool_file_name != os.path.basename(spool_path)
+            ):
+                debug_log("Removing stale local copy %s",spool_file_name)
+                os.remove(os.path.join(self.spool_dir, spool_file_name))
+        return spool_path
+
+    def load_lazily_from_s3_object(
+        self, s3_client, bucket_name, cache_object_name
+    ):
+        debug_log(
+            "About to read the central directory of %s with ranged GETs",
+            cache_object_name
+        )
+        range_reader = S3RangeReader(s3_client, bucket_name, cache_object_name)
+        self.load_from_stream(cache_object_name, range_reader)
+        # Each member extends from its local header to the local
+        # header of the next member or the central directory
+        self._member_extents = {}
+        self._member_data_offsets = {}
+        header_offsets = sorted(
+            zip_info.header_offset for zip_info in self.archive.infolist()
+        ) + [ self.archive.start_dir ]
+        next_header_offsets = dict(zip(header_offsets, header_offsets[1:]))
+        for file_name, zip_info in self._members.items():
+            self._member_extents[file_name] = (
+                zip_info.header_offset,
+                next_header_offsets[zip_info.header_offset]
+            )
+        # The central directory is not needed once the index is built
+        range_reader.release_all()
+        self._range_reader = range_reader
         self.s3_object_name = cache_object_name
+        self.s3_etag = range_reader.etag
+        debug_log(
+            "Read the index of %d bytes of %s with %d GETs",
+            self.archive_size, cache_object_name, range_reader.get_count
+        )
+
+    def _read_member(self, file_name):
+        # Returns the decompressed content of a member, fetching it
+        # with a single ranged GET if the archive is loaded lazily
+        if self._range_reader is None:
+            with phase(PHASE_DECOMPRESS):
+                return self.archive.read(file_name)
+        member_start, member_stop = self._member_extents[file_name]
+        self._range_reader.fetch(member_start, member_stop)
+        try:
+            with phase(PHASE_DECOMPRESS):
+                return self.archive.read(file_name)
+        finally:
+            # Members with open streams stay held until they are closed
+            if file_name not in self._open_members:
+                self._range_reader.release(member_start)
+
+    def load_from_file(self, cache_object_name, file_path):
+        # Memory-maps the archive so that stored members can be
+        # served from the page cache.
+        # Compressed members are still read through the ZipFile,
+        # which keeps the file open.
+        cache_file = open(file_path, "rb")
+        self._mapped_archive = mmap.mmap(
+            cache_file.fileno(), 0, access=mmap.ACCESS_READ
+        )
+        self.load_from_stream(cache_object_name, cache_file)
+
+    def _mapped_member_view(self, file_name):
+        # Returns a memoryview of the data of a stored member of a
+        # memory-mapped archive, or None if the member is compressed
+        # or the archive is not memory-mapped
+        zip_info = self._members[file_name]
+        if isinstance(zip_info, WpackEntry) and self._mapped_archive is not None:
+            return memoryview(self._mapped_archive)[
+                zip_info.offset:zip_info.offset + zip_info.file_size
+            ]
+        if (
+            self._mapped_archive is None or
+            zip_info.compress_type != zipfile.ZIP_STORED or
+            zip_info.flag_bits & 0x1
+        ):
+            return None
+        header_offset = zip_info.header_offset
+        data_offset = _member_data_offset(
+            header_offset, self._mapped_archive[
+                header_offset:header_offset + _ZIP_LOCAL_HEADER_SIZE
+            ]
+        )
+        if data_offset is None:
+            return None
+        return memoryview(self._mapped_archive)[
+            data_offset:data_offset + zip_info.file_size
+        ]
+
+    def pin(self, path_patterns):
+        # Decompresses the entries matching any of the glob patterns
+        # and holds them in the entry cache until the cache is reloaded
+        pinned_count = 0
+        for file_name in self._members:
+            normalized_path = self._normalize_path(file_name)
+            if not any(
+                fnmatch.fnmatchcase(normalized_path, pattern)
+                for pattern in path_patterns
+            ):
+                continue
+            if self._mapped_member_view(file_name) is not None:
+                # Stored members of a memory-mapped archive are
+                # served from the mapping without decompression
+                continue
+            entry_bytes = self._read_member(file_name)
+            if self.entry_cache.pin(file_name, entry_bytes):
+                pinned_count += 1
+            else:
+                logging.warning(
+                    "No room in the entry cache to pin %s", file_name
+                )
+        return pinned_count
+
+    def entry_bytes(self, file_name):
+        # Returns the decompressed content of an entry, as a
+        # memoryview if it is stored in a memory-mapped archive
+        member_view = self._mapped_member_view(file_name)
+        if member_view is not None:
+            return member_view
+        entry_bytes = self.entry_cache.get(file_name)
+        if entry_bytes is None:
+            entry_bytes = self._read_member(file_name)
+            self.entry_cache.put(file_name, entry_bytes)
+        return entry_bytes
 
     def open(self,file_name):
-        if file_name in self.archive.namelist():
-            return self.archive.open(file_name,"r")
-        else:
+        if file_name not in self._members:
             return None
-    
-    def search(self, requested_path):
-        if requested_path in self.archive.namelist():
-            return self.open(requested_path)
+        member_view = self._mapped_member_view(file_name)
+        if member_view is not None:
+            return MemoryViewStream(member_view)
+        entry_size = self.entry_size(file_name)
+        if self.entry_cache.admits(entry_size):
+            return io.BytesIO(self.entry_bytes(file_name))
+        # Entries too large for the entry cache are streamed from
+        # the archive so that they never need to be held in memory
+        if self._range_reader is not None:
+            data_offset = self._lazy_stored_member_data_offset(file_name)
+            if data_offset is not None:
+                return MemberWindowStream(
+                    self._range_reader, data_offset, entry_size
+                )
+        return SharedMemberStream(self._open_member(file_name), entry_size)
+
+    def _lazy_stored_member_data_offset(self, file_name):
+        # Returns the offset of the data of a stored member of a lazily
+        # loaded archive, fetching its local header the first time,
+        # or None if the member is compressed
+        zip_info = self._members[file_name]
+        if zip_info.compress_type != zipfile.ZIP_STORED or zip_info.flag_bits & 0x1:
+            return None
+        if file_name not in self._member_data_offsets:
+            header_offset = zip_info.header_offset
+            self._member_data_offsets[file_name] = _member_data_offset(
+                header_offset, self._range_reader.read_range(
+                    header_offset, header_offset + _ZIP_LOCAL_HEADER_SIZE
+                )
+            )
+        return self._member_data_offsets[file_name]
+
+    def _open_member(self, file_name):
+        # Returns an open stream of the member, which is kept so that
+        # the next request for the member can continue from where
+        # this one leaves it
+        member_stream = self._open_members.pop(file_name, None)
+        if member_stream is None:
+            if self._range_reader is not None:
+                # Members of lazily loaded archives are fetched with a
+                # single GET, and held until the stream is closed
+                self._range_reader.fetch(*self._member_extents[file_name])
+            member_stream = self.archive.open(file_name,"r")
+        self._open_members[file_name] = member_stream
+        while len(self._open_members) > _MAX_OPEN_MEMBERS:
+            evicted_name, evicted_stream = self._open_members.popitem(last=False)
+            evicted_stream.close()
+            if self._range_reader is not None:
+                self._range_reader.release(self._member_extents[evicted_name][0])
+        return member_stream
+
+    def resolve(self, requested_path):
+        # Returns the name of the archive member which will be
+        # served for requested_path, or None if there is no such member
+        normalized_path = self._normalize_path(requested_path)
+        zip_info = self._index.get(normalized_path)
+        if zip_info is not None:
+            return zip_info.filename
         elif self.search_subpaths == False:
             return None
-        else:
-            path_parts = pathlib.PurePosixPath(requested_path).parts
-            while len(path_parts)>0:
-                subpath = "/".join(path_parts)
-                if subpath in self.archive.namelist():
-                    return io.BytesIO(self.open(subpath).read())
-                path_parts=path_parts[1:]
+        # Try successively shorter suffixes of the path
+        path_parts = normalized_path.split("/")
+        for i in range(1, len(path_parts)):
+            zip_info = self._index.get("/".join(path_parts[i:]))
+            if zip_info is not None:
+                return zip_info.filename
+        return None
+
+    def entry_size(self, file_name):
+        return self._members[file_name].file_size
+
+    def validators(self, file_name):
+        # Returns a strong ETag and the last modification time of
+        # an entry, both derived from the zip directory so that
+        # conditional requests can be answered without reading
+        # the entry itself.
+        # Zip timestamps carry no timezone, they are taken to be UTC.
+        zip_info = self._members[file_name]
+        if isinstance(zip_info, WpackEntry):
+            return zip_info.etag, zip_info.last_modified
+        etag = '"%08x-%x"' % (zip_info.CRC, zip_info.file_size)
+        last_modified = datetime.datetime(
+            *zip_info.date_time, tzinfo=datetime.timezone.utc
+        )
+        return etag, last_modified
+
+    def encoded_body(self, file_name):
+        # Returns the whole entry encoded as for encode_body_bytes
+        encoded_body = self._encoded_bodies.get(file_name)
+        if encoded_body is not None:
+            return encoded_body
+        entry_bytes = self.entry_bytes(file_name)
+        body_str, body_is_base64 = encode_body_bytes(
+            entry_bytes,
+            force_base64=(self.entry_is_text.get(file_name) is False)
+        )
+        self.entry_is_text[file_name] = not body_is_base64
+        request_count = self._entry_request_counts.get(file_name, 0) + 1
+        self._entry_request_counts[file_name] = request_count
+        if request_count > 1:
+            debug_log("Retaining encoded body of %s",file_name)
+            self._encoded_bodies.put(file_name, (body_str, body_is_base64))
+        return body_str, body_is_base64
+
+    def content_type(self, file_name):
+        zip_info = self._members.get(file_name)
+        if isinstance(zip_info, WpackEntry):
+            return zip_info.content_type
+        content_type, _ = mimetypes.guess_type(file_name, strict=True)
+        return content_type
+
+    def _can_compress(self, file_name, content_encoding):
+        if content_encoding not in _ON_THE_FLY_COMPRESSORS:
+            return False
+        entry_size = self.entry_size(file_name)
+        if entry_size < _MIN_COMPRESSIBLE_SIZE:
+            return False
+        # Entries whose compressed copies could not be kept, or might
+        # not fit in a single response, are served uncompressed rather
+        # than compressed again on every request
+        if not (
+            self._compressed_bodies.admits(entry_size) and
+            fits_in_single_response(entry_size)
+        ):
+            return False
+        # Decide on the basis of the entry's name where possible
+        # so that the entry does not need to be read
+        content_type = self.content_type(file_name)
+        if content_type is not None:
+            return _is_compressible_content_type(content_type)
+        return self.entry_is_text.get(file_name) is True
+
+    def representation(self, file_name, request_event):
+        # Selects the representation of an entry which best suits
+        # the request's Accept-Encoding header
+        available_encodings = collections.OrderedDict()
+        zip_info = self._members[file_name]
+        for content_encoding, file_ext in _CONTENT_ENCODING_FILE_EXTS.items():
+            sibling_name = file_name + file_ext
+            if isinstance(zip_info, WpackEntry):
+                # .wpack archives name the variants of each entry
+                sibling_name = zip_info.encodings.get(
+                    content_encoding, sibling_name
+                )
+            if sibling_name in self._members:
+                available_encodings[content_encoding] = sibling_name
+            elif self._can_compress(file_name, content_encoding):
+                available_encodings[content_encoding] = None
+        content_encoding = negotiate_content_encoding(
+            request_event, list(available_encodings)
+        )
+        if content_encoding is None:
+            return Representation(
+                file_name, None, file_name, *self.validators(file_name)
+            )
+        source_name = available_encodings[content_encoding]
+        if source_name is not None:
+            return Representation(
+                file_name, content_encoding, source_name,
+                *self.validators(source_name)
+            )
+        # Compressed copies are distinguished from the entry by
+        # a suffix to its entity tag
+        etag, last_modified = self.validators(file_name)
+        return Representation(
+            file_name, content_encoding, None,
+            etag[:-1] + "-" + content_encoding + '"', last_modified
+        )
+
+    def compressed_body(self, file_name, content_encoding):
+        compressed_body = self._compressed_bodies.get(
+            file_name, content_encoding
+        )
+        if compressed_body is not None:
+            return compressed_body
+        entry_bytes = self.entry_bytes(file_name)
+        compressed_body = _ON_THE_FLY_COMPRESSORS[content_encoding](entry_bytes)
+        self._compressed_bodies.put(file_name, content_encoding, compressed_body)
+        return compressed_body
+
+    def open_representation(self, representation):
+        # Returns a stream containing the representation and its length
+        if representation.source_name is not None:
+            return (
+                self.open(representation.source_name),
+                self.entry_size(representation.source_name)
+            )
+        compressed_body = self.compressed_body(
+            representation.file_name, representation.content_encoding
+        )
+        return io.BytesIO(compressed_body), len(compressed_body)
+
+    def search(self, requested_path):
+        file_name = self.resolve(requested_path)
+        if file_name is None:
             return None
+        return self.open(file_name)
+
+
+class CacheShard:
+    # One cache archive, which serves the request paths under a
+    # prefix, and the state associated with it.
+    # The archive is loaded when the first request under the prefix
+    # is received.
+    # If WASTE_CACHE_RELOAD_INTERVAL is set, every that many seconds
+    # a request starts a background check of the cache object's ETag,
+    # and if it has changed a new cache is loaded while the current
+    # one continues to serve requests.
+
+    def __init__(self, path_prefix, cache_object_name, memory_share=1.0):
+        self.path_prefix = path_prefix
+        self.cache_object_name = cache_object_name
+        # The shards whose caches are loaded divide the memory
+        # budgets of the caches between them
+        self.memory_share = memory_share
+        self.cache = None
+        self.response_memo = None
+        self._checked_time = 0.0
+        self._reload_thread = None
+        self._reload_lock = threading.Lock()
+        self._reloaded_cache = None
+
+    def _new_cache(self):
+        cache = Cache(
+            default_doc_name=os.getenv(ENVVAR_DEFAULT_DOCUMENT_NAME),
+            memory_share=self.memory_share,
+            spool_dir=os.getenv(ENVVAR_CACHE_SPOOL_DIR),
+            lazy=len(os.getenv(ENVVAR_CACHE_LAZY, "")) > 0,
+            download_part_size=int(os.getenv(
+                ENVVAR_CACHE_DOWNLOAD_PART_SIZE,
+                _DEFAULT_DOWNLOAD_PART_SIZE
+            )),
+            download_concurrency=int(os.getenv(
+                ENVVAR_CACHE_DOWNLOAD_CONCURRENCY,
+                _DEFAULT_DOWNLOAD_CONCURRENCY
+            ))
+        )
+        cache.load_from_s3_object(
+            os.getenv(ENVVAR_CONTENT_BUCKET_NAME), self.cache_object_name
+        )
+        pinned_entries = os.getenv(ENVVAR_PINNED_ENTRIES, "")
+        if len(pinned_entries) > 0:
+            cache.pin([
+                pattern.strip() for pattern in pinned_entries.split(",")
+                if len(pattern.strip()) > 0
+            ])
+        return cache
+
+    def _new_response_memo(self):
+        return ResponseMemo(
+            byte_budget=cache_memory_budget("responses", self.memory_share)
+        )
+
+    def set_memory_share(self, memory_share):
+        self.memory_share = memory_share
+        if self.cache is not None:
+            self.cache.set_memory_share(memory_share)
+        if self.response_memo is not None:
+            self.response_memo.resize(
+                cache_memory_budget("responses", memory_share)
+            )
+
+    def _reload_if_changed(self, current_etag):
+        # Runs on a background thread: loads a new cache if the
+        # cache object's ETag differs from that of the current cache,
+        # and leaves it to be swapped in by the next request
+        try:
+            s3_head_response = get_mockable_s3_client().head_object(
+                Bucket=os.getenv(ENVVAR_CONTENT_BUCKET_NAME),
+                Key=self.cache_object_name
+            )
+            if s3_head_response["ETag"] == current_etag:
+                debug_log("Cache object %s is unchanged",self.cache_object_name)
+                return
+            debug_log(
+                "Cache object %s ETag has changed from %s to %s, reloading",
+                self.cache_object_name, current_etag, s3_head_response["ETag"]
+            )
+            reloaded_cache = self._new_cache()
+            with self._reload_lock:
+                self._reloaded_cache = reloaded_cache
+        except Exception:
+            # Keep serving the current cache, the next check will retry
+            logging.exception("Failed to reload cache %s",self.cache_object_name)
+
+    def start_reload(self):
+        # Starts a background check for a new version of the cache
+        # object, unless one is already running
+        if self.reload_in_progress():
+            return
+        self._checked_time = time.monotonic()
+        self._reload_thread = threading.Thread(
+            target=self._reload_if_changed, args=(self.cache.s3_etag,),
+            daemon=True
+        )
+        self._reload_thread.start()
+
+    def load_if_required(self):
+        if self.cache is None:
+            debug_log("Loading cache %s",self.cache_object_name)
+            with phase(PHASE_CACHE_LOAD):
+                self.cache = self._new_cache()
+                self.response_memo = self._new_response_memo()
+            self._checked_time = time.monotonic()
+            return
+        with self._reload_lock:
+            reloaded_cache, self._reloaded_cache = self._reloaded_cache, None
+        if reloaded_cache is not None:
+            # Requests are handled one at a time, so swapping the cache
+            # between requests means no request sees a mixture of the
+            # old and new caches
+            debug_log("Swapping in reloaded cache %s",self.cache_object_name)
+            # The share may have changed while the cache was loading
+            reloaded_cache.set_memory_share(self.memory_share)
+            self.cache = reloaded_cache
+            self.response_memo = self._new_response_memo()
+            return
+        reload_interval = float(os.getenv(ENVVAR_CACHE_RELOAD_INTERVAL, 0))
+        if (
+            reload_interval > 0 and
+            time.monotonic() - self._checked_time >= reload_interval
+        ):
+            self.start_reload()
+
+    def reload_in_progress(self):
+        return self._reload_thread is not None and self._reload_thread.is_alive()
+
+    def wait_for_reload(self):
+        if self._reload_thread is not None:
+            self._reload_thread.join()
+
 
+def _cache_shards_from_environment():
+    # The cache archives and the path prefixes they serve are given
+    # as a JSON object in WASTE_CACHE_SHARDS, e.g.
+    # { "/api-docs/": "api-docs.zip", "/": "site.zip" }
+    # or, if that is not set, WASTE_CACHE_OBJECT_NAME names a single
+    # archive serving all paths.
+    # Shards are returned longest prefix first.
+    shards_json = os.getenv(ENVVAR_CACHE_SHARDS)
+    if shards_json is None:
+        return [ CacheShard("/", os.getenv(ENVVAR_CACHE_OBJECT_NAME)) ]
+    shard_object_names = json.loads(shards_json)
+    return [
+        CacheShard(path_prefix, shard_object_names[path_prefix])
+        for path_prefix in sorted(shard_object_names, key=len, reverse=True)
+    ]
 
-_cache = None
+def _share_memory_with(loading_shard):
+    # Divides the function's memory equally between the shards whose
+    # caches are loaded, including one about to be loaded, so that a
+    # function which only ever serves one prefix is not limited to a
+    # fraction of its memory
+    sharing_shards = [
+        shard for shard in _cache_shards
+        if shard.cache is not None or shard is loading_shard
+    ]
+    for shard in sharing_shards:
+        shard.set_memory_share(1.0 / len(sharing_shards))
+
+# The shards are created on the first request and each one loads
+# its cache on the first request for a path under its prefix
+_cache_shards = None
 
 def invalidate_cache_for_test():
-    global _cache
-    _cache = None
+    global _cache_shards
+    if _cache_shards is not None:
+        for shard in _cache_shards:
+            shard.wait_for_reload()
+    _cache_shards = None
+
+def wait_for_reload_for_test():
+    for shard in _cache_shards:
+        shard.wait_for_reload()
+
+def _shard_for_path(requested_path):
+    global _cache_shards
+    if _cache_shards is None:
+        _cache_shards = _cache_shards_from_environment()
+    if not requested_path.startswith("/"):
+        requested_path = "/" + requested_path
+    for shard in _cache_shards:
+        if requested_path.startswith(shard.path_prefix):
+            return shard
+    return None
+
+def response_memo_stats(requested_path="/"):
+    shard = _shard_for_path(requested_path)
+    if shard is None or shard.response_memo is None:
+        return None
+    return shard.response_memo.stats()
+
+def entry_cache_stats(requested_path="/"):
+    shard = _shard_for_path(requested_path)
+    if shard is None or shard.cache is None:
+        return None
+    return shard.cache.entry_cache.stats()
+
+def _load_cache_if_required(requested_path):
+    # Returns the shard which serves requested_path, with its cache
+    # loaded, or None if no shard serves the path
+    shard = _shard_for_path(requested_path)
+    if shard is not None:
+        if shard.cache is None:
+            _share_memory_with(shard)
+        shard.load_if_required()
+    return shard
+
+def _decline_to_serve_cache_response(request_path, request_method):
+    # Return the same response the simpler handler
+    # would return for an absent document
+    return {
+        "statusCode": 404,
+        "headers":  {'Content-Type': 'text/plain'},
+        "body": "document not found at path %s for method %s" % (
+            request_path, request_method
+        )
+    }
+
+def _is_leading_fragment(response):
+    # True if the body of a single range response starts at the
+    # start of the document
+    if response["statusCode"] == 200:
+        return True
+    return response["statusCode"] == 206 and response["headers"].get(
+        "Content-Range", ""
+    ).startswith("bytes 0-")
+
+def _representation_headers(representation):
+    # The Content-Type is set by the response builders, as it is
+    # not the entry's type for multipart responses
+    headers = {
+        HDR_ETAG_KEY: representation.etag,
+        HDR_LAST_MODIFIED_KEY: http_date(representation.last_modified),
+        HDR_VARY_KEY: "Accept-Encoding",
+    }
+    if representation.content_encoding is not None:
+        headers[HDR_CONTENT_ENCODING_KEY] = representation.content_encoding
+    return headers
 
 def lambda_handler(event,context):
-    global _cache, _cache_object_name
-    if _cache is None:
-        debug_log("Loading cache")
-        _cache = Cache()
-        _cache.load_from_s3_object(
-            os.getenv(ENVVAR_CONTENT_BUCKET_NAME),
-            os.getenv(ENVVAR_CACHE_OBJECT_NAME)
+    begin_request_log()
+    begin_request_timing("caching")
+    return end_request_timing(_handle_request(event,context))
+
+def streaming_lambda_handler(event,context):
+    # Alternative entry point which returns a generator yielding
+    # the response in the Lambda response streaming format (see
+    # streaming.py).
+    # Documents served from the cache are streamed straight from
+    # the archive, and documents which are not in the cache are
+    # streamed from the bucket by the simple handler.  Other
+    # responses are built by the buffered handler and then streamed.
+    begin_request_log()
+    begin_request_timing("caching")
+    request_method = event["requestContext"]["http"]["method"]
+    requested_path = event["requestContext"]["http"]["path"]
+    shard = _load_cache_if_required(requested_path)
+    file_name = None
+    with phase(PHASE_CACHE_LOOKUP):
+        if (
+            shard is not None and request_method == "GET" and
+            requested_path != shard.cache.s3_object_name
+        ):
+            cache = shard.cache
+            file_name = cache.resolve(requested_path)
+        if file_name is not None:
+            representation = cache.representation(file_name, event)
+    if file_name is not None:
+        if not is_not_modified(
+            event, representation.etag, representation.last_modified
+        ):
+            range_spec = apply_if_range(
+                get_http_header(event,"Range",None),
+                get_http_header(event,"If-Range",None),
+                representation.etag, representation.last_modified
+            )
+            try:
+                stream, doc_len = cache.open_representation(representation)
+            except CacheObjectChanged:
+                _reload_after_cache_object_changed(shard)
+                return _stream_from_bucket(event, context)
+            headers = _representation_headers(representation)
+            content_type = cache.content_type(file_name)
+            if content_type is not None:
+                headers[HDR_CONTENT_TYPE_KEY] = content_type
+            prelude, body_chunks = stream_document(
+                stream, range_spec, doc_len, headers
+            )
+            serialize_object_for_log("streamed_response_prelude", prelude)
+            set_cache_result(CACHE_RESULT_HIT)
+            # Timings cover the work done before the body is streamed
+            prelude = end_request_timing(
+                apply_cache_control(requested_path, prelude)
+            )
+            return streamed_response(prelude, body_chunks)
+    elif request_method == "GET" and (
+        shard is None or requested_path != shard.cache.s3_object_name
+    ):
+        set_cache_result(CACHE_RESULT_MISS)
+        return _stream_from_bucket(event, context)
+    return streamed_response(
+        *split_buffered_response(
+            end_request_timing(_handle_request(event,context))
         )
-    else:
-        debug_log("Cache already loaded")
-        pass
+    )
+
+def _stream_from_bucket(event, context):
+    prelude, body_chunks = simple_stream_request(event, context)
+    return streamed_response(end_request_timing(prelude), body_chunks)
+
+def _reload_after_cache_object_changed(shard):
+    # The archive of a lazily loaded cache has been replaced, so its
+    # members can no longer be read: a new cache is loaded in the
+    # background, and until it is swapped in requests which need
+    # members not already held are served from the bucket
+    logging.warning(
+        "Cache object %s has changed, reloading",shard.cache_object_name
+    )
+    shard.start_reload()
+    set_cache_result(CACHE_RESULT_MISS)
+
+def _serve_after_cache_object_changed(shard, event, context):
+    _reload_after_cache_object_changed(shard)
+    return simple_handle_request(event,context)
+
+def _handle_request(event,context):
+    shard = _load_cache_if_required(event["requestContext"]["http"]["path"])
     serialize_object_for_log("request_event", event)
+    try:
+        return _handle_cache_request(shard, event, context)
+    except CacheObjectChanged:
+        return _serve_after_cache_object_changed(shard, event, context)
+
+def _handle_cache_request(shard, event, context):
 
-    if event["requestContext"]["http"]["method"] in ( "GET", "POST" ):
+    if (
+        shard is not None and
+        event["requestContext"]["http"]["method"] in ( "GET", "POST" )
+    ):
+        cache = shard.cache
+        response_memo = shard.response_memo
         requested_path = event["requestContext"]["http"]["path"]
-        if requested_path == _cache.s3_object_name:
-            # Return the same response the simpler handler
-            # would return for an absent document
-            decline_to_serve_cache_response = {
-                "statusCode": 404,
-                "headers":  {'Content-Type': 'text/plain'},
-                "body": "document not found at path %s for method %s" % (
-                    request_path, request_method
-                )
-            }
-            return decline_to_server_cache_response
+        if requested_path == cache.s3_object_name:
+            return _decline_to_serve_cache_response(
+                requested_path, event["requestContext"]["http"]["method"]
+            )
         # otherwise continue ...
-        stream = _cache.search(requested_path)
-        if stream is not None:
-            range_spec = get_http_header(event,"Range","bytes=0-")
-            cached_doc_response = build_positive_response(stream,range_spec)
+        with phase(PHASE_CACHE_LOOKUP):
+            file_name = cache.resolve(requested_path)
+            if file_name is not None:
+                representation = cache.representation(file_name, event)
+        if file_name is not None:
+            etag = representation.etag
+            last_modified = representation.last_modified
+            if (
+                event["requestContext"]["http"]["method"] == "GET" and
+                is_not_modified(event, etag, last_modified)
+            ):
+                debug_log("%s not modified",requested_path)
+                set_cache_result(CACHE_RESULT_NOT_MODIFIED)
+                not_modified_response = build_not_modified_response(
+                    etag, last_modified
+                )
+                not_modified_response["headers"][HDR_VARY_KEY] = "Accept-Encoding"
+                return apply_cache_control(requested_path, not_modified_response)
+            range_spec = apply_if_range(
+                get_http_header(event,"Range",None),
+                get_http_header(event,"If-Range",None),
+                etag, last_modified
+            )
+            memo_key = (file_name, representation.content_encoding, range_spec)
+            with phase(PHASE_CACHE_LOOKUP):
+                cached_doc_response = response_memo.get(memo_key)
+            if cached_doc_response is not None:
+                debug_log("Serving %s from response memo",memo_key)
+                set_cache_result(CACHE_RESULT_MEMO)
+                return apply_cache_control(requested_path, cached_doc_response)
+            set_cache_result(CACHE_RESULT_HIT)
+            content_type = cache.content_type(file_name)
+            if representation.content_encoding is not None:
+                # Byte ranges apply to the encoded representation
+                stream, doc_len = cache.open_representation(representation)
+                cached_doc_response = build_positive_response(
+                    stream, range_spec, doc_len, content_type, is_text=False
+                )
+            else:
+                doc_len = cache.entry_size(file_name)
+                if range_spec is None and fits_in_single_response(doc_len):
+                    cached_doc_response = build_encoded_response(
+                        *cache.encoded_body(file_name), doc_len, content_type
+                    )
+                else:
+                    # If the entry has not been classified the fragment
+                    # served is, so that entries which are streamed
+                    # from the archive are never read whole
+                    is_text = cache.entry_is_text.get(file_name)
+                    cached_doc_response = build_positive_response(
+                        cache.open(file_name),
+                        range_spec,
+                        doc_len,
+                        content_type,
+                        is_text=is_text
+                    )
+                    if (
+                        is_text is None and
+                        cached_doc_response.get("isBase64Encoded") is True and
+                        _is_leading_fragment(cached_doc_response)
+                    ):
+                        # A fragment from the start of the entry which
+                        # is not valid UTF-8 shows that it is binary
+                        # (other fragments, and the parts of multipart
+                        # responses, may start part way through a
+                        # character)
+                        cache.entry_is_text[file_name] = False
+            if cached_doc_response["statusCode"] != 416:
+                cached_doc_response["headers"].update(
+                    _representation_headers(representation)
+                )
             debug_log(
                 "response range:%s",
                 cached_doc_response["headers"].get("Content-Range","whole document")
             )
-            loggable_response = copy.deepcopy(cached_doc_response)
-            loggable_response["body"] = "<%d characters long>" % (len(cached_doc_response["body"]),)
-            serialize_object_for_log("cached_doc_response",loggable_response)
-            return cached_doc_response
-    return simple_lambda_handler(event,context)
+            serialize_response_for_log("cached_doc_response",cached_doc_response)
+            if cached_doc_response["statusCode"] in (200, 206):
+                response_memo.put(memo_key, cached_doc_response)
+            # The policy is applied after the response is memoized
+            # because it depends on the requested path as well as
+            # on the entry which was served
+            return apply_cache_control(requested_path, cached_doc_response)
+    set_cache_result(CACHE_RESULT_MISS)
+    return simple_handle_request(event,context)
@@ -0,0 +1,83 @@
+# python3
+# waste/handler/key_manifest.py
+
+# Copyright Tim Littlefair 2020-
+# This file is open source software under the MIT license.
+# For terms of this license, see the file LICENSE in the source
+# code distribution or visit
+# https://opensource.org/licenses/mit-license.php
+
+# This file defines the key manifest, a compact list of the objects
+# in the content bucket which deploy writes to the bucket alongside
+# them.  With the manifest loaded, the simple handler knows which
+# key (if any) serves a request before it calls S3, so a request
+# costs at most one GET, and requests for paths which are not in
+# the bucket are answered 404 without calling S3 at all.
+# The manifest is a UTF-8 JSON object mapping each key to its size,
+# ETag and content type, e.g.
+# { "version": 1,
+#   "keys": {
+#     "/index.html": [ 5678, "\"0123...\"", "text/html" ],
+#     ...
+# } }
+
+import json
+
+KEY_MANIFEST_OBJECT_NAME = "/.waste/key-manifest.json"
+
+_KEY_MANIFEST_FORMAT_VERSION = 1
+
+
+class KeyManifestEntry:
+
+    def __init__(self, key, size, etag, content_type):
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.content_type = content_type
+
+
+class KeyManifest:
+
+    def __init__(self, entries=[]):
+        self._entries = { entry.key: entry for entry in entries }
+
+    @staticmethod
+    def from_json(manifest_json):
+        manifest = json.loads(manifest_json)
+        if manifest.get("version") != _KEY_MANIFEST_FORMAT_VERSION:
+            raise ValueError(
+                "Unsupported key manifest version %s" % (
+                    manifest.get("version"),
+                )
+            )
+        return KeyManifest([
+            KeyManifestEntry(key, *key_details)
+            for key, key_details in manifest["keys"].items()
+        ])
+
+    def to_json(self):
+        return json.dumps({
+            "version": _KEY_MANIFEST_FORMAT_VERSION,
+            "keys": {
+                entry.key: [ entry.size, entry.etag, entry.content_type ]
+                for entry in sorted(
+                    self._entries.values(), key=lambda entry: entry.key
+                )
+            }
+        }, separators=(",", ":"))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def resolve(self, keys_to_try):
+        # Returns the entry of the first key which is in the bucket,
+        # or None if none of them are
+        for key in keys_to_try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry
+        return None
@@ -0,0 +1,164 @@
+# python3
+# waste/handler/metrics.py
+
+# Copyright Tim Littlefair 2020-
+# This file is open source software under the MIT license.
+# For terms of this license, see the file LICENSE in the source
+# code distribution or visit
+# https://opensource.org/licenses/mit-license.php
+
+# This file implements per-request phase timing for both handlers.
+# Each handler starts a timer when a request arrives, code on the
+# request path wraps the phases of interest (cache lookup, S3
+# requests, decompression, encoding, logging) in 'with phase(...)'
+# blocks, and when the response is ready the timings are
+#  - printed as a CloudWatch Embedded Metric Format record, if the
+#    environment variable WASTE_EMIT_METRICS is set to a non-empty
+#    value (one request in WASTE_METRICS_SAMPLE_RATE is recorded),
+#  - added to the response as a Server-Timing header, if the
+#    environment variable WASTE_SERVER_TIMING is set to a non-empty
+#    value.
+# This module deliberately has no dependencies on the other handler
+# modules so that all of them can use it.
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+ENVVAR_EMIT_METRICS = "WASTE_EMIT_METRICS"
+ENVVAR_METRICS_SAMPLE_RATE = "WASTE_METRICS_SAMPLE_RATE"
+ENVVAR_SERVER_TIMING = "WASTE_SERVER_TIMING"
+HDR_SERVER_TIMING_KEY = 'Server-Timing'
+
+METRICS_NAMESPACE = "waste"
+
+# Names of the phases timed on the request path
+PHASE_CACHE_LOAD = "cache_load"
+PHASE_CACHE_LOOKUP = "cache_lookup"
+PHASE_S3_GET = "s3_get_object"
+PHASE_DECOMPRESS = "decompress"
+PHASE_ENCODE = "encode"
+PHASE_TRANSFORM = "transform"
+PHASE_LOGGING = "logging"
+PHASE_TOTAL = "total"
+
+# Values of the cache result dimension
+CACHE_RESULT_HIT = "hit"
+CACHE_RESULT_MEMO = "memo"
+CACHE_RESULT_NOT_MODIFIED = "not_modified"
+CACHE_RESULT_MISS = "miss"
+
+
+class RequestTimer:
+
+    def __init__(self, handler_name):
+        self.start_time = time.perf_counter()
+        self.thread_id = threading.get_ident()
+        self.phase_durations = collections.OrderedDict()
+        self.dimensions = collections.OrderedDict((
+            ( "Handler", handler_name ),
+        ))
+
+    def add_phase_duration(self, phase_name, duration):
+        self.phase_durations[phase_name] = (
+            self.phase_durations.get(phase_name, 0.0) + duration
+        )
+
+    def durations_ms(self):
+        durations_ms = collections.OrderedDict(
+            ( phase_name, round(duration * 1000.0, 3) )
+            for phase_name, duration in self.phase_durations.items()
+        )
+        durations_ms[PHASE_TOTAL] = round(
+            (time.perf_counter() - self.start_time) * 1000.0, 3
+        )
+        return durations_ms
+
+    def emf_record(self, durations_ms):
+        # https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [ {
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [ list(self.dimensions) ],
+                    "Metrics": [
+                        { "Name": phase_name, "Unit": "Milliseconds" }
+                        for phase_name in durations_ms
+                    ]
+                } ]
+            }
+        }
+        record.update(self.dimensions)
+        record.update(durations_ms)
+        return record
+
+    @staticmethod
+    def server_timing(durations_ms):
+        return ", ".join(
+            "%s;dur=%s" % (phase_name, duration_ms)
+            for phase_name, duration_ms in durations_ms.items()
+        )
+
+
+_current_timer = None
+_request_count = 0
+
+def begin_request_timing(handler_name):
+    global _current_timer
+    _current_timer = RequestTimer(handler_name)
+    return _current_timer
+
+@contextlib.contextmanager
+def phase(phase_name):
+    # Adds the time spent in the body of the with block to the
+    # named phase of the current request.
+    # Work done on other threads (e.g. a background cache reload)
+    # is not part of the request so is not timed.
+    timer = _current_timer
+    if timer is None or timer.thread_id != threading.get_ident():
+        yield
+        return
+    phase_start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add_phase_duration(
+            phase_name, time.perf_counter() - phase_start_time
+        )
+
+def set_dimension(dimension_name, dimension_value):
+    if _current_timer is not None:
+        _current_timer.dimensions[dimension_name] = dimension_value
+
+def set_cache_result(cache_result):
+    set_dimension("CacheResult", cache_result)
+
+def end_request_timing(response):
+    # Emits the timings of the current request and returns the
+    # response, with a Server-Timing header if one is enabled.
+    global _current_timer, _request_count
+    timer = _current_timer
+    _current_timer = None
+    if timer is None:
+        return response
+    emit_metrics = len(os.environ.get(ENVVAR_EMIT_METRICS, "")) > 0
+    add_server_timing = len(os.environ.get(ENVVAR_SERVER_TIMING, "")) > 0
+    if not ( emit_metrics or add_server_timing ):
+        return response
+    durations_ms = timer.durations_ms()
+    if emit_metrics:
+        sample_rate = int(os.environ.get(ENVVAR_METRICS_SAMPLE_RATE, 1))
+        if sample_rate <= 1 or _request_count % sample_rate == 0:
+            # EMF records must be written to stdout as a line of
+            # their own, not through the logging module
+            print(json.dumps(timer.emf_record(durations_ms)), flush=True)
+        _request_count += 1
+    if add_server_timing:
+        response.setdefault("headers",{})[HDR_SERVER_TIMING_KEY] = (
+            timer.server_timing(durations_ms)
+        )
+    return response
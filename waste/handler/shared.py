@@ -10,24 +10,94 @@
 # This file contains definitions which are shared between the two
 # handler modules.
 
+import atexit
 import base64
+import collections
+import email.utils
 import io
 import json
 import logging
+import logging.handlers
 import math
+import os
+import queue
 import traceback
+import uuid
 
 import boto3
+import botocore.config
+
+from .metrics import phase, PHASE_DECOMPRESS, PHASE_ENCODE, PHASE_LOGGING
 
 ENVVAR_DEFAULT_DOCUMENT_NAME = "WASTE_DEFAULT_DOCUMENT_NAME"
 ENVVAR_CONTENT_BUCKET_NAME = "WASTE_CONTENT_BUCKET_NAME"
 ENVVAR_CACHE_OBJECT_NAME = "WASTE_CACHE_OBJECT_NAME"
+# Comma-separated globs matching cache entries which are held
+# decompressed in memory from the time the cache is loaded
+ENVVAR_PINNED_ENTRIES = "WASTE_PINNED_ENTRIES"
+# If WASTE_CACHE_SPOOL_DIR is set, the cache archive is written to
+# a file in that directory (normally /tmp) and memory-mapped rather
+# than being read into memory.  The file is reused by later loads
+# for as long as the object's ETag is unchanged.
+ENVVAR_CACHE_SPOOL_DIR = "WASTE_CACHE_SPOOL_DIR"
+# If WASTE_CACHE_LAZY is set to a non-empty value, only the zip
+# central directory of the cache archive is read at load time, and
+# members are fetched from S3 by byte range when first requested
+ENVVAR_CACHE_LAZY = "WASTE_CACHE_LAZY"
+# The cache archive is downloaded in parts of
+# WASTE_CACHE_DOWNLOAD_PART_SIZE bytes, up to
+# WASTE_CACHE_DOWNLOAD_CONCURRENCY of them at a time
+ENVVAR_CACHE_DOWNLOAD_PART_SIZE = "WASTE_CACHE_DOWNLOAD_PART_SIZE"
+ENVVAR_CACHE_DOWNLOAD_CONCURRENCY = "WASTE_CACHE_DOWNLOAD_CONCURRENCY"
+# If WASTE_CACHE_RELOAD_INTERVAL is set, the caching handler checks
+# for a new version of the cache object that often (in seconds)
+ENVVAR_CACHE_RELOAD_INTERVAL = "WASTE_CACHE_RELOAD_INTERVAL"
+# WASTE_CACHE_SHARDS maps path prefixes to the names of the cache
+# objects serving them, as a JSON object; if it is set it is used
+# instead of WASTE_CACHE_OBJECT_NAME
+ENVVAR_CACHE_SHARDS = "WASTE_CACHE_SHARDS"
+# Objects fetched by the simple handler are served from memory for
+# WASTE_OBJECT_CACHE_TTL seconds (default 0), then served while they
+# are revalidated in the background for WASTE_OBJECT_CACHE_STALE_TTL
+# seconds (default 0), then revalidated before they are served
+ENVVAR_OBJECT_CACHE_TTL = "WASTE_OBJECT_CACHE_TTL"
+ENVVAR_OBJECT_CACHE_STALE_TTL = "WASTE_OBJECT_CACHE_STALE_TTL"
+# If WASTE_KEY_MANIFEST_NAME is set, the simple handler loads the
+# key manifest (see key_manifest.py) from that object in the content
+# bucket and serves only the keys it lists, checking for a new
+# version of it every WASTE_KEY_MANIFEST_TTL seconds (default 300)
+ENVVAR_KEY_MANIFEST_NAME = "WASTE_KEY_MANIFEST_NAME"
+ENVVAR_KEY_MANIFEST_TTL = "WASTE_KEY_MANIFEST_TTL"
+# Settings of the S3 client which is shared by all requests served
+# by a sandbox: the size of its connection pool (which needs to be
+# at least WASTE_CACHE_DOWNLOAD_CONCURRENCY), its connect and read
+# timeouts in seconds, and the number of attempts made at each
+# request before it fails
+ENVVAR_S3_MAX_POOL_CONNECTIONS = "WASTE_S3_MAX_POOL_CONNECTIONS"
+ENVVAR_S3_CONNECT_TIMEOUT = "WASTE_S3_CONNECT_TIMEOUT"
+ENVVAR_S3_READ_TIMEOUT = "WASTE_S3_READ_TIMEOUT"
+ENVVAR_S3_MAX_ATTEMPTS = "WASTE_S3_MAX_ATTEMPTS"
+
+# Request and response details are logged for one in every
+# WASTE_LOG_SAMPLE_RATE requests (default: every request)
+ENVVAR_LOG_SAMPLE_RATE = "WASTE_LOG_SAMPLE_RATE"
+# If WASTE_LOG_ASYNC is set to a non-empty value, log records are
+# formatted and emitted on a background thread
+ENVVAR_LOG_ASYNC = "WASTE_LOG_ASYNC"
+
+# Set by the Lambda runtime to the configured memory size in MB
+ENVVAR_LAMBDA_MEMORY_SIZE = "AWS_LAMBDA_FUNCTION_MEMORY_SIZE"
+_DEFAULT_LAMBDA_MEMORY_SIZE_MB = 128
 
 # Constants associated with attributes in the header
 # of the HTTPS response document
 HDR_CONTENT_TYPE_KEY = 'Content-Type'
 HDR_CONTENT_DISPOSITION_KEY = 'Content-Disposition'
 HDR_ATTACHMENT_FILENAME_PREFIX = 'attachment;filename='
+HDR_ETAG_KEY = 'ETag'
+HDR_LAST_MODIFIED_KEY = 'Last-Modified'
+HDR_CONTENT_ENCODING_KEY = 'Content-Encoding'
+HDR_VARY_KEY = 'Vary'
 
 # Constants associated with attributes of the JSON documents
 # which are transmitted and received as HTTPS bodies
@@ -36,14 +106,53 @@ JSON_CONTENT_TYPE_KEY = 'ContentType'
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Debug output goes through a child logger which is permanently
+# enabled, so that debug_log does not need to change the level of
+# the root logger on every call.
+_debug_logger = logging.getLogger("waste.debug")
+_debug_logger.setLevel(logging.DEBUG)
+
 mock_s3_client = None
 
+_DEFAULT_S3_MAX_POOL_CONNECTIONS = 16
+_DEFAULT_S3_CONNECT_TIMEOUT = 2.0
+_DEFAULT_S3_READ_TIMEOUT = 10.0
+_DEFAULT_S3_MAX_ATTEMPTS = 3
+
+def s3_client_config():
+    return botocore.config.Config(
+        max_pool_connections=int(os.environ.get(
+            ENVVAR_S3_MAX_POOL_CONNECTIONS, _DEFAULT_S3_MAX_POOL_CONNECTIONS
+        )),
+        connect_timeout=float(os.environ.get(
+            ENVVAR_S3_CONNECT_TIMEOUT, _DEFAULT_S3_CONNECT_TIMEOUT
+        )),
+        read_timeout=float(os.environ.get(
+            ENVVAR_S3_READ_TIMEOUT, _DEFAULT_S3_READ_TIMEOUT
+        )),
+        tcp_keepalive=True,
+        retries={
+            "mode": "adaptive",
+            "max_attempts": int(os.environ.get(
+                ENVVAR_S3_MAX_ATTEMPTS, _DEFAULT_S3_MAX_ATTEMPTS
+            ))
+        }
+    )
+
+# Creating a client loads botocore's service model and each client
+# has its own connection pool, so one client is created per sandbox
+# and reused by every invocation (boto3 clients are thread safe)
+_s3_client = None
+
 def get_mockable_s3_client():
+    global _s3_client
     if mock_s3_client is None:
         # This code is not reachable when the handler is running under control
         # of unit tests in test_handler
         # pragma: nocover
-        return boto3.client('s3')
+        if _s3_client is None:
+            _s3_client = boto3.client('s3', config=s3_client_config())
+        return _s3_client
     else:
         debug_log("Using mock S3 client")
         return mock_s3_client
@@ -52,24 +161,222 @@ def debug_log(*vars):
     if mock_s3_client is None:
         # Running in AWS - supress log
         return
-    logger.setLevel(logging.DEBUG)
-    logger.log(logging.DEBUG, *vars, stacklevel=2)
-    logger.setLevel(logging.INFO)
+    _debug_logger.log(logging.DEBUG, *vars, stacklevel=2)
+
+class _LazyJson:
+    # Defers serialization of an object until the log record
+    # containing it is formatted, which does not happen at all
+    # if the record is filtered out
+    __slots__ = ( "obj", )
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(self.obj, default=str)
+
+    def snapshot(self):
+        # Returns a copy which is not affected by later changes to
+        # the object, for records formatted on another thread.
+        # Dictionaries (e.g. events and responses) are copied two
+        # levels deep, which covers their headers.
+        obj = self.obj
+        if isinstance(obj, dict):
+            obj = {
+                key: dict(value) if isinstance(value, dict) else value
+                for key, value in obj.items()
+            }
+        return _LazyJson(obj)
+
+class _LazyResponseSummary(_LazyJson):
+    # As _LazyJson, but the body of the response is replaced by
+    # its length, without copying the response
+    def _summary(self):
+        summary = { 
+            key: value for key, value in self.obj.items() if key != "body"
+        }
+        if "body" in self.obj:
+            summary["body"] = "<%d characters long>" % (len(self.obj["body"]),)
+        return summary
+
+    def __str__(self):
+        return json.dumps(self._summary(), default=str)
+
+    def snapshot(self):
+        # The summary leaves out the body, so it is cheap to copy
+        return _LazyJson(self._summary()).snapshot()
+
+_request_count = 0
+_request_is_sampled = True
+
+def begin_request_log():
+    # Called once at the start of each request to decide whether
+    # the request is one of those whose details will be logged
+    global _request_count, _request_is_sampled
+    sample_rate = int(os.environ.get(ENVVAR_LOG_SAMPLE_RATE, 1))
+    _request_is_sampled = sample_rate <= 1 or _request_count % sample_rate == 0
+    _request_count += 1
+    return _request_is_sampled
 
 def serialize_object_for_log(name, obj):
-    def json_dump_default(obj):
-        return str(obj)
-    logger.log(
-        logging.INFO,
-        "%s: %s" % (name, json.dumps(obj,default=json_dump_default)),
-        stacklevel=2
-    )
+    if _request_is_sampled is False or not logger.isEnabledFor(logging.INFO):
+        return
+    with phase(PHASE_LOGGING):
+        logger.log(logging.INFO, "%s: %s", name, _LazyJson(obj), stacklevel=2)
+
+def serialize_response_for_log(name, response):
+    if _request_is_sampled is False or not logger.isEnabledFor(logging.INFO):
+        return
+    with phase(PHASE_LOGGING):
+        logger.log(
+            logging.INFO, "%s: %s", name, _LazyResponseSummary(response),
+            stacklevel=2
+        )
 
 
 def serialize_exception_for_log(e):
     logging.error("Exception: %s", traceback.format_exc())
 
 
+class _DeferredFormatQueueHandler(logging.handlers.QueueHandler):
+    # The base class formats each record in the thread which
+    # logged it, this class leaves formatting to the handlers
+    # attached to the listener thread.
+    # Objects which are serialized lazily are snapshotted first,
+    # as the handlers go on changing them (e.g. adding headers to
+    # responses) after they are logged.
+    def prepare(self, record):
+        if isinstance(record.args, tuple) and any(
+            isinstance(arg, _LazyJson) for arg in record.args
+        ):
+            record.args = tuple(
+                arg.snapshot() if isinstance(arg, _LazyJson) else arg
+                for arg in record.args
+            )
+        return record
+
+def _enable_async_logging():
+    # Records queued while the Lambda sandbox is frozen between
+    # invocations are emitted when it is thawed.
+    target_handlers = logger.handlers[:]
+    if len(target_handlers) == 0:
+        return None
+    log_queue = queue.SimpleQueue()
+    for target_handler in target_handlers:
+        logger.removeHandler(target_handler)
+    logger.addHandler(_DeferredFormatQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(
+        log_queue, *target_handlers, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+if len(os.environ.get(ENVVAR_LOG_ASYNC, "")) > 0:
+    _enable_async_logging()
+
+
+def lambda_memory_size():
+    # Returns the memory available to the function in bytes
+    memory_size_mb = int(
+        os.environ.get(ENVVAR_LAMBDA_MEMORY_SIZE, _DEFAULT_LAMBDA_MEMORY_SIZE_MB)
+    )
+    return memory_size_mb * 1024 * 1024
+
+# The fraction of the function's memory allocated to each of the
+# caches kept by the handlers.  The fractions sum to well under 1,
+# leaving room for the runtime and for the request being served.
+# Caches which each cache shard keeps divide their allocation
+# between the shards.
+_CACHE_MEMORY_FRACTIONS = {
+    # The cache archive (or the part of it held in memory)
+    # together with its decompressed entries
+    "entries": 0.3,
+    "responses": 0.1,
+    "encoded_bodies": 0.05,
+    "compressed_bodies": 0.05,
+    "objects": 0.07,
+    "transformed_bodies": 0.03,
+}
+
+def cache_memory_fraction(cache_name):
+    # Returns the fraction of the function's memory allocated to
+    # the named cache
+    return _CACHE_MEMORY_FRACTIONS[cache_name]
+
+def cache_memory_budget(cache_name, memory_share=1.0):
+    # Returns the number of bytes allocated to the named cache,
+    # or to memory_share of it
+    return int(
+        lambda_memory_size() * cache_memory_fraction(cache_name) *
+        memory_share
+    )
+
+class ByteBudgetLRU:
+    # Least recently used cache bounded by the total cost (roughly
+    # the size in bytes) of the values it holds
+
+    def __init__(self, byte_budget):
+        self.byte_budget = byte_budget
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._values = collections.OrderedDict()
+
+    def _cost(self, value):
+        raise NotImplementedError
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def _lookup(self, key):
+        value = self._values.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._values.move_to_end(key)
+        return value
+
+    def _make_room(self, cost):
+        # Evicts least recently used values until cost bytes are
+        # available, returns False if that is not possible
+        while self.bytes_used + cost > self.byte_budget:
+            if len(self._values) == 0:
+                return False
+            _, evicted_value = self._values.popitem(last=False)
+            self.bytes_used -= self._cost(evicted_value)
+            self.evictions += 1
+        return True
+
+    def resize(self, byte_budget):
+        # Changes the budget, evicting least recently used values
+        # if they no longer fit
+        self.byte_budget = byte_budget
+        self._make_room(0)
+
+    def _store(self, key, value):
+        cost = self._cost(value)
+        if key in self._values or cost > self.byte_budget:
+            return False
+        if not self._make_room(cost):
+            return False
+        self._values[key] = value
+        self.bytes_used += cost
+        return True
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._values),
+            "bytes_used": self.bytes_used,
+            "byte_budget": self.byte_budget,
+        }
+
+
 def set_mock_s3_client(new_mock_s3_client):
     global mock_s3_client
     mock_s3_client = new_mock_s3_client
@@ -102,35 +409,246 @@ def get_http_header(request_event,header_name,default_value):
     # Python requests sends camel case headers
     # This function attempts to cover both
     # providing header_name is passed in camel case
+    request_headers = request_event.get("headers") or {}
     for hn in header_name, header_name.lower():
-        if hn in request_event["headers"]:
-            return request_event["headers"][hn]
+        if hn in request_headers:
+            return request_headers[hn]
     # ... otherwise
     return default_value
 
 def _parse_range_spec(range_spec):
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Range
-    assert range_spec.startswith("bytes=")
-    range_spec_rhs=range_spec.replace("bytes=","")
-    range_string_tuple=range_spec_rhs.split("-")
-    if len(range_string_tuple) != 2:
-        logging.error("Multiple ranges not yet supported for range spec %s",range_spec)
-        raise NotImplementedError
-    elif range_string_tuple[1] != "":
-        logging.error("Ranges with defined end not yet supported for range spec %s",range_spec)
-        raise NotImplementedError
+    # https://www.rfc-editor.org/rfc/rfc7233#section-2.1
+    # Returns a list of (first, last) tuples, where last is None
+    # for an open ended range and first is None for a suffix range,
+    # or None if the range spec is not syntactically valid, in
+    # which case RFC 7233 requires the header to be ignored.
+    unit, _, range_set = range_spec.partition("=")
+    if unit.strip().lower() != "bytes":
+        logging.warning("Ignoring range spec %s with unsupported unit",range_spec)
+        return None
+    byte_ranges = []
+    for byte_range_spec in range_set.split(","):
+        first, dash, last = byte_range_spec.strip().partition("-")
+        if dash != "-" or not ((first + last).isascii() and (first + last).isdigit()):
+            logging.warning("Ignoring malformed range spec %s",range_spec)
+            return None
+        byte_ranges += [(
+            int(first) if len(first) > 0 else None,
+            int(last) if len(last) > 0 else None
+        )]
     debug_log(
-        "range_spec:%s range_string_tuple:%s",
-        range_spec, range_string_tuple
+        "range_spec:%s byte_ranges:%s",
+        range_spec, byte_ranges
     )
-    return int(range_string_tuple[0]),None
+    for first, last in byte_ranges:
+        if first is not None and last is not None and last < first:
+            logging.warning("Ignoring range spec %s with inverted range",range_spec)
+            return None
+    return byte_ranges
+
+def _resolve_byte_ranges(byte_ranges, doc_len):
+    # Converts the output of _parse_range_spec into a list of
+    # satisfiable (start, stop) tuples with exclusive stop offsets,
+    # sorted and with overlapping or adjacent ranges coalesced.
+    resolved_ranges = []
+    for first, last in byte_ranges:
+        if first is None:
+            # Suffix range: the last 'last' bytes of the document
+            start, stop = max(0, doc_len - last), doc_len
+        elif last is None:
+            start, stop = first, doc_len
+        else:
+            start, stop = first, min(last + 1, doc_len)
+        if start < stop:
+            resolved_ranges += [(start, stop)]
+    coalesced_ranges = []
+    for start, stop in sorted(resolved_ranges):
+        if len(coalesced_ranges) > 0 and start <= coalesced_ranges[-1][1]:
+            previous_start, previous_stop = coalesced_ranges[-1]
+            coalesced_ranges[-1] = (previous_start, max(previous_stop, stop))
+        else:
+            coalesced_ranges += [(start, stop)]
+    return coalesced_ranges
+
+def resolve_range_spec(range_spec, doc_len):
+    # Returns None if the whole document should be served, otherwise
+    # a list of (start, stop) tuples as for _resolve_byte_ranges,
+    # which is empty if none of the ranges requested is satisfiable
+    if range_spec is None:
+        return None
+    byte_ranges = _parse_range_spec(range_spec)
+    if byte_ranges is None:
+        return None
+    return _resolve_byte_ranges(byte_ranges, doc_len)
+
+def range_window(range_spec, doc_len=None):
+    # Returns the HTTP Range header value requesting the bytes which
+    # build_positive_response reads to serve range_spec from a
+    # document of doc_len bytes, or of unknown length if doc_len is
+    # None, if they are a single run of bytes which is not the whole
+    # document, otherwise None.
+    # A handler which can fetch byte ranges of a document (e.g. from
+    # S3) can fetch the window rather than the whole document.
+    body_length_limit = _body_length_limit()
+    byte_ranges = None
+    if range_spec is not None:
+        byte_ranges = _parse_range_spec(range_spec)
+    if byte_ranges is None:
+        # The whole document, which is served in chunks if it is
+        # too long for a single response
+        if doc_len is None or fits_in_single_response(doc_len):
+            return None
+        return "bytes=0-%d" % (body_length_limit - 1,)
+    if doc_len is not None:
+        resolved_ranges = _resolve_byte_ranges(byte_ranges, doc_len)
+        if len(resolved_ranges) != 1:
+            return None
+        start, stop = resolved_ranges[0]
+        return "bytes=%d-%d" % (
+            start, min(stop, start + body_length_limit) - 1
+        )
+    if len(byte_ranges) != 1:
+        return None
+    first, last = byte_ranges[0]
+    if first is None:
+        # Without the length of the document the start of a suffix
+        # range is not known, so it can only be limited by its size
+        if last > body_length_limit:
+            return None
+        return "bytes=-%d" % (last,)
+    if last is None or last >= first + body_length_limit:
+        last = first + body_length_limit - 1
+    return "bytes=%d-%d" % (first, last)
+
+def build_unsatisfiable_range_response(range_spec, doc_len):
+    logging.warning("Range spec %s not satisfiable for length %d",range_spec,doc_len)
+    return {
+        "statusCode": 416,
+        "headers": {
+            "Content-Range": "bytes */%d" % (doc_len,),
+            HDR_CONTENT_TYPE_KEY: "text/plain",
+        },
+        "body": "range %s not satisfiable" % (range_spec,)
+    }
+
+def http_date(timestamp):
+    # Formats a datetime with timezone or a POSIX timestamp
+    # as an RFC 7231 IMF-fixdate
+    if isinstance(timestamp, (int, float)):
+        return email.utils.formatdate(timestamp, usegmt=True)
+    return email.utils.format_datetime(timestamp, usegmt=True)
+
+def apply_if_range(range_spec, if_range, etag=None, last_modified=None):
+    # https://www.rfc-editor.org/rfc/rfc7233#section-3.2
+    # Returns the range spec which should be served: range_spec
+    # itself if there is no If-Range precondition or the
+    # precondition holds, otherwise None, meaning that the whole
+    # document must be served.
+    # etag is a quoted entity tag, last_modified a timezone aware
+    # datetime; a handler which cannot supply either cannot
+    # confirm any If-Range precondition.
+    if range_spec is None or if_range is None:
+        return range_spec
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        # Entity tags must match using the strong comparison function
+        if etag is not None and if_range == etag:
+            return range_spec
+    elif if_range.startswith('W/'):
+        # Weak entity tags never satisfy If-Range
+        pass
+    elif last_modified is not None:
+        try:
+            if_range_date = email.utils.parsedate_to_datetime(if_range)
+            if if_range_date == last_modified.replace(microsecond=0):
+                return range_spec
+        except (TypeError, ValueError):
+            pass
+    debug_log("If-Range %s not satisfied, serving whole document",if_range)
+    return None
+
+def _parse_entity_tags(entity_tags_header):
+    # Splits an If-None-Match header value into its entity tags
+    return [
+        entity_tag.strip() for entity_tag in entity_tags_header.split(",")
+        if len(entity_tag.strip()) > 0
+    ]
+
+def is_not_modified(request_event, etag, last_modified):
+    # https://www.rfc-editor.org/rfc/rfc7232#section-6
+    # Returns True if the conditional headers of a GET request show
+    # that the client already holds the current representation.
+    if_none_match = get_http_header(request_event,"If-None-Match",None)
+    if if_none_match is not None:
+        # If-None-Match uses the weak comparison function, and
+        # when it is present If-Modified-Since is ignored
+        if if_none_match.strip() == "*":
+            return True
+        opaque_etag = etag.replace("W/","",1)
+        return any(
+            entity_tag.replace("W/","",1) == opaque_etag
+            for entity_tag in _parse_entity_tags(if_none_match)
+        )
+    if_modified_since = get_http_header(request_event,"If-Modified-Since",None)
+    if if_modified_since is not None and last_modified is not None:
+        try:
+            if_modified_since_date = email.utils.parsedate_to_datetime(
+                if_modified_since
+            )
+            return last_modified.replace(microsecond=0) <= if_modified_since_date
+        except (TypeError, ValueError):
+            pass
+    return False
+
+def build_not_modified_response(etag, last_modified):
+    response = { "statusCode": 304, "headers": { HDR_ETAG_KEY: etag } }
+    if last_modified is not None:
+        response["headers"][HDR_LAST_MODIFIED_KEY] = http_date(last_modified)
+    return response
+
+def negotiate_content_encoding(request_event, available_encodings):
+    # https://www.rfc-editor.org/rfc/rfc7231#section-5.3.4
+    # Returns the member of available_encodings (which is in order
+    # of server preference) most preferred by the client's
+    # Accept-Encoding header, or None if the identity encoding
+    # should be used.
+    accept_encoding = get_http_header(request_event,"Accept-Encoding",None)
+    if accept_encoding is None:
+        return None
+    qvalues = {}
+    for coding_spec in accept_encoding.split(","):
+        coding, _, params = coding_spec.partition(";")
+        qvalue = 1.0
+        for param in params.split(";"):
+            param_name, _, param_value = param.strip().partition("=")
+            if param_name.lower() == "q":
+                try:
+                    qvalue = float(param_value)
+                except ValueError:
+                    qvalue = 0.0
+        if len(coding.strip()) > 0:
+            qvalues[coding.strip().lower()] = qvalue
+    best_encoding, best_qvalue = None, 0.0
+    for encoding in available_encodings:
+        qvalue = qvalues.get(encoding, qvalues.get("*", 0.0))
+        if qvalue > best_qvalue:
+            best_encoding, best_qvalue = encoding, qvalue
+    return best_encoding
 
 def encode_body_bytes(body_bytes,force_base64=False):
+    with phase(PHASE_ENCODE):
+        return _encode_body_bytes(body_bytes,force_base64)
+
+def _encode_body_bytes(body_bytes,force_base64):
     # Content always comes back from an S3 object or a 
     # zipfile S3 cache as a stream of bytes.
     # It must be rendered as a valid UTF-8 string before it 
     # can be passed back to the API gateway, either with or
-    # without base64 encoding
+    # without base64 encoding.
+    # body_bytes may be any bytes-like object, including a
+    # memoryview of a memory-mapped cache entry, so it is
+    # decoded with str() rather than bytes.decode().
     stream_length = len(body_bytes)
     body_str = None
     body_is_base64 = None
@@ -144,16 +662,35 @@ def encode_body_bytes(body_bytes,force_base64=False):
             raise UnicodeDecodeError(
                 'utf-8',body_bytes, 0, 0, "force_base64==True"
             )
-        body_str = body_bytes.decode('utf-8')
+        body_str = str(body_bytes, 'utf-8')
         body_is_base64 = False
     except UnicodeDecodeError:
         body_str = base64.b64encode(body_bytes).decode('utf-8')
         body_is_base64 = True
     return body_str, body_is_base64
 
-def build_positive_response(stream, range_spec):
-    doc_bytes = stream.read()
-    doc_len = len(doc_bytes)
+def _decode_text_fragment(fragment_bytes, is_final_fragment):
+    # Attempts to render a fragment read from the middle of a
+    # document as UTF-8 text.
+    # A fragment which is not the last in the document may end
+    # part way through a multi-byte character, in which case the
+    # incomplete character is left for the next fragment.
+    # Returns a tuple containing the decoded string and the number
+    # of bytes it represents, or (None, 0) if the fragment is not
+    # valid UTF-8.
+    try:
+        return str(fragment_bytes, 'utf-8'), len(fragment_bytes)
+    except UnicodeDecodeError as e:
+        if (
+            is_final_fragment is False and
+            e.reason == 'unexpected end of data' and
+            e.start > 0 and
+            len(fragment_bytes) - e.start < 4
+        ):
+            return str(fragment_bytes[:e.start], 'utf-8'), e.start
+    return None, 0
+
+def _body_length_limit():
     # Lambda has a maximum response length of 6MBytes so
     # if the document requested (after base64 encoded if 
     # required) exceeds this size, it will be broken into 
@@ -162,57 +699,24 @@ def build_positive_response(stream, range_spec):
     # that, when base64-encoded data is broken up, 
     # each fragment contains a whole number of 
     # 4 base64 character/3 encoded byte units.
-    body_length_limit = 4 * math.floor(_active_max_body_length/4)
-    response = { "headers" : {
-            "Accept-Ranges": "bytes",
-    } } 
-    range_start, range_end = _parse_range_spec(range_spec)
-    assert range_end is None # guaranteed by _parse_range_spec
-    debug_log("range_start:%d",range_start)
-    body_str, body_is_base64 = encode_body_bytes(doc_bytes)
-    overall_body_len = len(body_str)
-    body_start, body_end = None, None
-    if body_is_base64 is False:
-        body_start = range_start
-        response["headers"][HDR_CONTENT_TYPE_KEY] = "text/plain"           
-    elif range_start % 3 == 0:
-        body_start = int((range_start*4)/3)
-        response["headers"][HDR_CONTENT_TYPE_KEY] = "application/octet-stream"
-        response["isBase64Encoded"] = True       
-    else:
-        # Warn about brain-dead client behaviour
-        logging.warning("Range start is not a multiple of 3 (problematic for for base64 reasons) for range spec %s",range_spec)
-        # Because the request starts at a byte which is not on a 
-        # 3 byte boundary of a base64 group, we need to re-encode the
-        # body so that alignment is restored
-        body_str, body_is_base64 = encode_body_bytes(doc_bytes[range_start:],force_base64=True)
-        debug_log(
-            "re-encoded stream: len(body_str):%d body_is_base64:%s",
-            len(body_str), body_is_base64
-        )
-        body_start = 0
-        response["headers"][HDR_CONTENT_TYPE_KEY] = "application/octet-stream"
-        response["isBase64Encoded"] = True       
-    body_fragment = body_str[body_start:]
-    debug_log(
-        "Before truncation: range_start:%d body_start:%d body_length:%d body_length_limit:%d fragment_len:%d ",
-        range_start, body_start, len(body_str), body_length_limit, len(body_fragment)
-    )
-    if len(body_fragment) > body_length_limit:
-        body_fragment=body_fragment[
-            0:body_length_limit
-        ]
-        debug_log(
-            "After truncation: fragment_len:%d ",
-            len(body_fragment)
+    return 4 * math.floor(_active_max_body_length/4)
+
+def fits_in_single_response(doc_len):
+    # True if a document of doc_len bytes can be returned whole
+    # whether or not it requires base64 encoding
+    return 4 * math.ceil(doc_len/3) <= _body_length_limit()
+
+def _complete_response(
+    response, body_fragment, body_is_base64, range_start, range_end, doc_len
+):
+    if body_is_base64 is True:
+        response["headers"].setdefault(
+            HDR_CONTENT_TYPE_KEY, "application/octet-stream"
         )
+        response["isBase64Encoded"] = True
     else:
-        debug_log("Truncation not required")
-    if body_is_base64 is False:
-        range_end = range_start + len(body_fragment)
-    else:
-        range_end = range_start + len(base64.b64decode(body_fragment))
-    if len(body_fragment)==overall_body_len:
+        response["headers"].setdefault(HDR_CONTENT_TYPE_KEY, "text/plain")
+    if range_start == 0 and range_end == doc_len:
         # The whole document has been served in a single request
         response["statusCode"]=200
     else:
@@ -226,3 +730,160 @@ def build_positive_response(stream, range_spec):
     response["headers"]["Content-Length"] = len(body_fragment)
     return response
 
+def _build_range_response(
+    stream, range_start, range_stop, doc_len, is_text, response
+):
+    body_length_limit = _body_length_limit()
+    debug_log("range_start:%d range_stop:%d",range_start,range_stop)
+    # Only the bytes which can be returned in this response are
+    # read and encoded, so the cost of serving a chunk depends on
+    # the size of the chunk rather than the size of the document.
+    # A text fragment can carry up to body_length_limit bytes,
+    # a base64 fragment can carry 3 bytes per 4 characters.
+    text_byte_limit = body_length_limit
+    base64_byte_limit = 3 * (body_length_limit // 4)
+    stream.seek(range_start)
+    body_fragment = None
+    if is_text is False:
+        # The document is known to be binary so there is no
+        # point attempting to decode the fragment
+        with phase(PHASE_DECOMPRESS):
+            fragment_bytes = stream.read(
+                max(0, min(range_stop - range_start, base64_byte_limit))
+            )
+    else:
+        with phase(PHASE_DECOMPRESS):
+            fragment_bytes = stream.read(
+                max(0, min(range_stop - range_start, text_byte_limit))
+            )
+        with phase(PHASE_ENCODE):
+            body_fragment, fragment_len = _decode_text_fragment(
+                fragment_bytes,
+                range_start + len(fragment_bytes) >= doc_len
+            )
+    body_is_base64 = body_fragment is None
+    if body_is_base64 is True:
+        # Because encoding starts at range_start, the base64 window
+        # is aligned with the start of the fragment whether or not
+        # range_start falls on a 3 byte boundary of the document, so
+        # no re-encoding is required for unaligned requests.
+        fragment_bytes = fragment_bytes[:base64_byte_limit]
+        fragment_len = len(fragment_bytes)
+        body_fragment, _ = encode_body_bytes(
+            fragment_bytes, force_base64=True
+        )
+    range_end = range_start + fragment_len
+    debug_log(
+        "range_start:%d range_end:%d doc_len:%d body_length_limit:%d fragment_len:%d ",
+        range_start, range_end, doc_len, body_length_limit, len(body_fragment)
+    )
+    return _complete_response(
+        response, body_fragment, body_is_base64,
+        range_start, range_end, doc_len
+    )
+
+_MULTIPART_PART_OVERHEAD = 256
+
+def multipart_part_header(boundary, content_type, range_start, range_stop, doc_len):
+    return bytes(
+        "--%s\r\n%s: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n" % (
+            boundary, HDR_CONTENT_TYPE_KEY, content_type,
+            range_start, range_stop - 1, doc_len
+        ), "utf-8"
+    )
+
+def multipart_trailer(boundary):
+    return bytes("--%s--\r\n" % (boundary,), "utf-8")
+
+def _build_multipart_response(
+    stream, byte_ranges, doc_len, content_type, is_text, response
+):
+    # https://www.rfc-editor.org/rfc/rfc7233#appendix-A
+    boundary = uuid.uuid4().hex
+    body_bytes = bytes()
+    for range_start, range_stop in byte_ranges:
+        stream.seek(range_start)
+        body_bytes += multipart_part_header(
+            boundary, content_type, range_start, range_stop, doc_len
+        )
+        with phase(PHASE_DECOMPRESS):
+            body_bytes += stream.read(range_stop - range_start)
+        body_bytes += b"\r\n"
+    body_bytes += multipart_trailer(boundary)
+    body_str, body_is_base64 = encode_body_bytes(
+        body_bytes, force_base64=(is_text is False)
+    )
+    response["statusCode"] = 206
+    response["headers"][HDR_CONTENT_TYPE_KEY] = (
+        "multipart/byteranges; boundary=" + boundary
+    )
+    response["headers"]["Content-Length"] = len(body_str)
+    response["body"] = body_str
+    if body_is_base64 is True:
+        response["isBase64Encoded"] = True
+    return response
+
+def _new_response(content_type):
+    response = { "headers" : {
+            "Accept-Ranges": "bytes",
+    } } 
+    if content_type is not None:
+        response["headers"][HDR_CONTENT_TYPE_KEY] = content_type
+    return response
+
+def build_encoded_response(body_str, body_is_base64, doc_len, content_type=None):
+    # Builds a whole document response from a body which has already
+    # been encoded by encode_body_bytes, for callers which keep the
+    # encoded form of frequently requested documents.
+    assert fits_in_single_response(doc_len)
+    return _complete_response(
+        _new_response(content_type), body_str, body_is_base64,
+        0, doc_len, doc_len
+    )
+
+def build_positive_response(
+    stream, range_spec, doc_len=None, content_type=None, is_text=None
+):
+    # range_spec is the value of the HTTP Range header, or None if
+    # the whole document was requested.
+    # content_type is the media type of the document if known, if
+    # not the response will be typed as text/plain or
+    # application/octet-stream according to whether the body
+    # needed base64 encoding.
+    # is_text is False if the document is already known not to be
+    # valid UTF-8, True if it is known to be, or None if unknown.
+    response = _new_response(content_type)
+    if doc_len is None:
+        # Callers which know the length of the document (e.g.
+        # from zip metadata) should pass it in, as finding the
+        # end of some streams requires the whole stream to be
+        # read.
+        stream.seek(0, io.SEEK_END)
+        doc_len = stream.tell()
+    byte_ranges = resolve_range_spec(range_spec, doc_len)
+    if byte_ranges is None:
+        return _build_range_response(
+            stream, 0, doc_len, doc_len, is_text, response
+        )
+    if len(byte_ranges) == 0:
+        return build_unsatisfiable_range_response(range_spec, doc_len)
+    # Allow for the boundary and part headers when estimating
+    # whether a multipart body will fit in a single response
+    multipart_len = sum(
+        stop - start + _MULTIPART_PART_OVERHEAD for start, stop in byte_ranges
+    )
+    if len(byte_ranges) > 1 and multipart_len * 4 < 3 * _active_max_body_length:
+        return _build_multipart_response(
+            stream, byte_ranges, doc_len,
+            content_type or "application/octet-stream",
+            is_text, response
+        )
+    elif len(byte_ranges) > 1:
+        # A multipart response would exceed the Lambda response
+        # size limit, the client will need to request the
+        # remaining ranges separately.
+        logging.warning("Serving only the first range of range spec %s",range_spec)
+    range_start, range_stop = byte_ranges[0]
+    return _build_range_response(
+        stream, range_start, range_stop, doc_len, is_text, response
+    )
@@ -11,9 +11,13 @@
 # maps the paths of URLs as S3 bucket object keys.
 
 import os
+import io
 import json
 import base64
+import collections
 import logging
+import threading
+import time
 
 import boto3
 import botocore.exceptions
@@ -23,20 +27,383 @@ import botocore.exceptions
 from .shared import HDR_CONTENT_TYPE_KEY, JSON_CONTENT_TYPE_KEY
 from .shared import ENVVAR_DEFAULT_DOCUMENT_NAME, ENVVAR_CONTENT_BUCKET_NAME
 from .shared import logger, debug_log, serialize_object_for_log
+from .shared import serialize_response_for_log, begin_request_log
 from .shared import serialize_exception_for_log
 from .shared import get_mockable_s3_client
 from .shared import encode_body_bytes
+from .shared import get_http_header
+from .shared import build_positive_response, apply_if_range
+from .shared import range_window, resolve_range_spec, fits_in_single_response
+from .shared import build_unsatisfiable_range_response
+from .shared import cache_memory_budget, ByteBudgetLRU
+from .shared import ENVVAR_OBJECT_CACHE_TTL, ENVVAR_OBJECT_CACHE_STALE_TTL
+from .shared import ENVVAR_KEY_MANIFEST_NAME, ENVVAR_KEY_MANIFEST_TTL
+from .shared import HDR_ETAG_KEY
+from .key_manifest import KeyManifest
+from .transforms import TransformPipeline, get_transformed_body_cache
+from .cache_control import apply_cache_control
+from .metrics import phase, begin_request_timing, end_request_timing
+from .metrics import PHASE_S3_GET
+from .streaming import stream_document, split_buffered_response
+from .streaming import streamed_response, read_stream_chunks
+
+# An object fetched from S3, and the time it was last known to be
+# the current version of the object
+S3Object = collections.namedtuple(
+    'S3Object', 'content_type body etag last_modified validated_time'
+)
+
+class ObjectCache(ByteBudgetLRU):
+    # LRU of objects fetched from S3, keyed by bucket and key.
+    # An object is served without contacting S3 for ttl seconds
+    # after it was last validated.  After that, for a further
+    # stale_ttl seconds it is still served but is revalidated in
+    # the background, and after that it is revalidated before it
+    # is served.  Revalidation is a GET conditional on the object's
+    # ETag, which returns no body if the object is unchanged.
+
+    def __init__(self, byte_budget=None, ttl=0.0, stale_ttl=0.0):
+        if byte_budget is None:
+            byte_budget = cache_memory_budget("objects")
+        super().__init__(byte_budget)
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.revalidations = 0
+        self._revalidation_threads = {}
+        # Background revalidation updates the cache while requests
+        # are being served
+        self._lock = threading.Lock()
+
+    def _cost(self, s3_object):
+        return len(s3_object.body)
+
+    def _fetch(self, s3_client, bucket_name, key, cached_object):
+        # Returns the HTTP status and the current version of an object,
+        # or None if there is no object
+        get_object_params = { "Bucket": bucket_name, "Key": key }
+        if cached_object is not None:
+            get_object_params["IfNoneMatch"] = cached_object.etag
+            self.revalidations += 1
+        try:
+            with phase(PHASE_S3_GET):
+                s3_get_response = s3_client.get_object(**get_object_params)
+        except botocore.exceptions.ClientError as e:
+            if (
+                cached_object is not None and
+                e.response.get("Error",{}).get("Code") in ("304", "NotModified")
+            ):
+                debug_log("%s is not modified",key)
+                return 200, cached_object._replace(validated_time=time.monotonic())
+            raise
+        status_code = s3_get_response["ResponseMetadata"]["HTTPStatusCode"]
+        if status_code != 200:
+            return status_code, None
+        with phase(PHASE_S3_GET):
+            body = s3_get_response["Body"].read()
+        return status_code, S3Object(
+            s3_get_response[JSON_CONTENT_TYPE_KEY], body,
+            s3_get_response.get("ETag"), s3_get_response.get("LastModified"),
+            time.monotonic()
+        )
+
+    def _evict(self, cache_key):
+        evicted_object = self._values.pop(cache_key, None)
+        if evicted_object is not None:
+            self.bytes_used -= self._cost(evicted_object)
+
+    def _refresh(self, s3_client, bucket_name, key, cached_object):
+        cache_key = ( bucket_name, key )
+        try:
+            status_code, s3_object = self._fetch(
+                s3_client, bucket_name, key, cached_object
+            )
+        except botocore.exceptions.ClientError:
+            with self._lock:
+                self._evict(cache_key)
+            raise
+        with self._lock:
+            self._evict(cache_key)
+            # Objects without an ETag can not be revalidated
+            if s3_object is not None and s3_object.etag is not None:
+                self._store(cache_key, s3_object)
+        return status_code, s3_object
+
+    def _revalidate_in_background(self, s3_client, bucket_name, key, cached_object):
+        def revalidate():
+            try:
+                self._refresh(s3_client, bucket_name, key, cached_object)
+            except Exception:
+                logging.exception("Failed to revalidate %s",key)
+        cache_key = ( bucket_name, key )
+        revalidation_thread = self._revalidation_threads.get(cache_key)
+        if revalidation_thread is not None and revalidation_thread.is_alive():
+            return
+        revalidation_thread = threading.Thread(target=revalidate, daemon=True)
+        self._revalidation_threads[cache_key] = revalidation_thread
+        revalidation_thread.start()
+
+    def wait_for_revalidation(self):
+        for revalidation_thread in list(self._revalidation_threads.values()):
+            revalidation_thread.join()
+        self._revalidation_threads = {}
+
+    def get_current(self, bucket_name, key, expected_etag=None):
+        # Returns the cached object if it can be served without
+        # contacting S3, otherwise None
+        with self._lock:
+            cached_object = self._values.get(( bucket_name, key ))
+        if cached_object is None:
+            return None
+        if expected_etag is not None and cached_object.etag == expected_etag:
+            return cached_object
+        if time.monotonic() - cached_object.validated_time < self.ttl:
+            return cached_object
+        return None
+
+    def get_object(self, s3_client, bucket_name, key, expected_etag=None):
+        # Returns the HTTP status and S3Object for the current version
+        # of an object, or the status and None if there is no object.
+        # expected_etag is the ETag of the current version if it is
+        # already known, e.g. from the key manifest.
+        with self._lock:
+            cached_object = self._lookup(( bucket_name, key ))
+        if cached_object is not None:
+            if expected_etag is not None and cached_object.etag == expected_etag:
+                return 200, cached_object
+            age = time.monotonic() - cached_object.validated_time
+            if age < self.ttl:
+                return 200, cached_object
+            if age < self.ttl + self.stale_ttl:
+                self._revalidate_in_background(
+                    s3_client, bucket_name, key, cached_object
+                )
+                return 200, cached_object
+        return self._refresh(s3_client, bucket_name, key, cached_object)
+
+    def stats(self):
+        stats = super().stats()
+        stats["revalidations"] = self.revalidations
+        return stats
+
+
+_object_cache = None
+
+def get_object_cache():
+    # The object cache is created on first use.  Its TTLs are read
+    # on every request because tests change them.
+    global _object_cache
+    if _object_cache is None:
+        _object_cache = ObjectCache()
+    _object_cache.ttl = float(os.environ.get(ENVVAR_OBJECT_CACHE_TTL, 0))
+    _object_cache.stale_ttl = float(
+        os.environ.get(ENVVAR_OBJECT_CACHE_STALE_TTL, 0)
+    )
+    return _object_cache
+
+# The key manifest is loaded when the first request arrives, then
+# revalidated by ETag every WASTE_KEY_MANIFEST_TTL seconds.  If it
+# cannot be loaded, requests are served without it, and the load is
+# retried after the same interval.
+_DEFAULT_KEY_MANIFEST_TTL = 300.0
+
+KeyManifestState = collections.namedtuple(
+    'KeyManifestState',
+    'bucket_name manifest_name key_manifest etag validated_time'
+)
+
+_key_manifest_state = None
+
+def get_key_manifest(s3_client, bucket_name):
+    # Returns the key manifest of the content bucket, or None if
+    # there is none, in which case requests are served by trying
+    # the keys which might match them in turn
+    global _key_manifest_state
+    manifest_name = os.environ.get(ENVVAR_KEY_MANIFEST_NAME, "")
+    if len(manifest_name) == 0:
+        return None
+    state = _key_manifest_state
+    get_object_params = { "Bucket": bucket_name, "Key": manifest_name }
+    if state is not None and (
+        state.bucket_name, state.manifest_name
+    ) == ( bucket_name, manifest_name ):
+        ttl = float(os.environ.get(
+            ENVVAR_KEY_MANIFEST_TTL, _DEFAULT_KEY_MANIFEST_TTL
+        ))
+        if time.monotonic() - state.validated_time < ttl:
+            return state.key_manifest
+        if state.etag is not None:
+            get_object_params["IfNoneMatch"] = state.etag
+    else:
+        state = None
+    try:
+        with phase(PHASE_S3_GET):
+            s3_get_response = s3_client.get_object(**get_object_params)
+            if s3_get_response["ResponseMetadata"]["HTTPStatusCode"] != 200:
+                raise ValueError("Key manifest %s not found" % (manifest_name,))
+            manifest_json = s3_get_response["Body"].read()
+        key_manifest = KeyManifest.from_json(manifest_json)
+    except botocore.exceptions.ClientError as e:
+        if (
+            state is not None and state.key_manifest is not None and
+            e.response.get("Error",{}).get("Code") in ("304", "NotModified")
+        ):
+            _key_manifest_state = state._replace(validated_time=time.monotonic())
+            return state.key_manifest
+        logging.warning("Serving without key manifest %s: %s",manifest_name,e)
+        _key_manifest_state = KeyManifestState(
+            bucket_name, manifest_name, None, None, time.monotonic()
+        )
+        return None
+    except ValueError as e:
+        logging.warning("Serving without key manifest %s: %s",manifest_name,e)
+        _key_manifest_state = KeyManifestState(
+            bucket_name, manifest_name, None, None, time.monotonic()
+        )
+        return None
+    debug_log("Loaded key manifest of %d keys",len(key_manifest))
+    _key_manifest_state = KeyManifestState(
+        bucket_name, manifest_name, key_manifest,
+        s3_get_response.get("ETag"), time.monotonic()
+    )
+    return key_manifest
+
+class RangeWindowStream:
+    # Presents a run of bytes fetched from part of a document as a
+    # stream over the whole document, so that the response builders
+    # can serve ranges from it.  Only the window can be read.
+
+    def __init__(self, window_bytes, window_start, doc_len):
+        self._window_bytes = window_bytes
+        self._window_start = window_start
+        self._doc_len = doc_len
+        self._position = 0
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_END:
+            offset += self._doc_len
+        elif whence == io.SEEK_CUR:
+            offset += self._position
+        self._position = offset
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        window_offset = self._position - self._window_start
+        window_end = len(self._window_bytes)
+        assert 0 <= window_offset <= window_end
+        if size >= 0:
+            window_end = min(window_end, window_offset + size)
+        chunk = self._window_bytes[window_offset:window_end]
+        self._position += len(chunk)
+        return chunk
+
+
+def _build_ranged_response(
+    s3_client, bucket_name, key, manifest_entry, range_spec, if_range
+):
+    # Serves a request for a single range of an object, or for the
+    # first chunk of an object too long for a single response, from
+    # a ranged GET of the bytes which the response will contain.
+    # Returns None if the request needs the whole object.
+    doc_len = None
+    get_object_params = { "Bucket": bucket_name, "Key": key }
+    if manifest_entry is not None:
+        doc_len = manifest_entry.size
+        # The window is only valid for the version of the object
+        # which the manifest describes
+        get_object_params["IfMatch"] = manifest_entry.etag
+        range_spec = apply_if_range(range_spec, if_range, manifest_entry.etag)
+        if resolve_range_spec(range_spec, doc_len) == []:
+            return build_unsatisfiable_range_response(range_spec, doc_len)
+    elif range_spec is not None and if_range is not None:
+        if not if_range.strip().startswith('"'):
+            # Only the whole object carries its modification time
+            return None
+        get_object_params["IfMatch"] = if_range.strip()
+    s3_range = range_window(range_spec, doc_len)
+    if s3_range is None:
+        return None
+    get_object_params["Range"] = s3_range
+    debug_log("Fetching %s of %s",s3_range,key)
+    try:
+        with phase(PHASE_S3_GET):
+            s3_get_response = s3_client.get_object(**get_object_params)
+    except botocore.exceptions.ClientError as e:
+        error = e.response.get("Error",{})
+        if error.get("Code") == "InvalidRange" and "ActualObjectSize" in error:
+            return build_unsatisfiable_range_response(
+                range_spec, int(error["ActualObjectSize"])
+            )
+        if error.get("Code") in ( "InvalidRange", "PreconditionFailed" ):
+            # Either If-Range was not satisfied or the object has
+            # changed since the manifest was loaded
+            return None
+        raise
+    status_code = s3_get_response["ResponseMetadata"]["HTTPStatusCode"]
+    if status_code not in ( 200, 206 ):
+        return { "statusCode": status_code }
+    window_start, doc_len = 0, s3_get_response.get("ContentLength")
+    if "ContentRange" in s3_get_response:
+        window, _, doc_len = s3_get_response["ContentRange"].partition("/")
+        window_start = int(window.split()[-1].partition("-")[0])
+    with phase(PHASE_S3_GET):
+        window_bytes = s3_get_response["Body"].read()
+    content_type = s3_get_response.get(JSON_CONTENT_TYPE_KEY)
+    if content_type is None and manifest_entry is not None:
+        content_type = manifest_entry.content_type
+    response = build_positive_response(
+        RangeWindowStream(window_bytes, window_start, int(doc_len)),
+        range_spec, int(doc_len), content_type
+    )
+    if s3_get_response.get("ETag") is not None:
+        response["headers"][HDR_ETAG_KEY] = s3_get_response["ETag"]
+    return response
+
+def _resolve_keys(s3_client, key, bucket_name, default_doc_name=None):
+    # Returns the keys which might serve a request for key, in the
+    # order in which they are tried, and if the key manifest is
+    # loaded the manifest entry of the one which does (in which case
+    # no keys are returned if none of them are in the bucket)
+    keys_to_try = [key]
+    if default_doc_name is not None:
+        default_doc_key = (key + "/" + default_doc_name).replace("//", "/")
+        keys_to_try += [default_doc_key]
+    # The manifest itself is not content
+    keys_to_try = [
+        key for key in keys_to_try
+        if key != os.environ.get(ENVVAR_KEY_MANIFEST_NAME)
+    ]
+    manifest_entry = None
+    key_manifest = get_key_manifest(s3_client, bucket_name)
+    if key_manifest is not None:
+        manifest_entry = key_manifest.resolve(keys_to_try)
+        if manifest_entry is None:
+            debug_log("None of %s are in the key manifest",keys_to_try)
+            return [], None
+        keys_to_try = [ manifest_entry.key ]
+    debug_log({ "keys_to_try": keys_to_try} )
+    return keys_to_try, manifest_entry
 
 def _build_response_from_s3_object(
     key,
     bucket_name,
     default_doc_name=None,
     bucket_key_prefix=None,
-    pylambda_list=[]
+    pylambda_list=[],
+    range_spec=None,
+    if_range=None,
+    transform_pipeline=None
 ):
     # assert len(key) > 0
     s3_client = get_mockable_s3_client()
 
+    # A bare list of transforms is applied as a pipeline which is
+    # not memoized, as it has no version
+    if transform_pipeline is None and len(pylambda_list) > 0:
+        transform_pipeline = TransformPipeline("pylambda_list", None, pylambda_list)
+
     if bucket_key_prefix is None:
         pass
     elif bucket_key_prefix.endswith("/") or key.startswith("/"):
@@ -44,49 +411,82 @@ def _build_response_from_s3_object(
     else:
         key = bucket_key_prefix + "/" + key
 
-    keys_to_try = [key]
-    if default_doc_name is not None:
-        default_doc_key = (key + "/" + default_doc_name).replace("//", "/")
-        keys_to_try += [default_doc_key]
-    debug_log({ "keys_to_try": keys_to_try} )
-    s3_get_response = None
+    keys_to_try, manifest_entry = _resolve_keys(
+        s3_client, key, bucket_name, default_doc_name
+    )
     responseStatusCode = None
-    response = None
+    response = { "statusCode": 404 }
     for candidate_key in keys_to_try:
         response = {}
-        logging.info(
+        debug_log(
             "About to do %s.get_object with params bucket_name=%s, key=%s",
             type(s3_client).__name__, bucket_name, candidate_key
         )
         try:
-            s3_get_response = s3_client.get_object(
-                Bucket=bucket_name, Key=candidate_key
-            )
-            responseStatusCode = (
-                s3_get_response["ResponseMetadata"]["HTTPStatusCode"]
+            # Ranges, and objects too long for a single response, are
+            # fetched by range unless the object is already cached
+            # (transforms need the whole object)
+            if transform_pipeline is None and get_object_cache().get_current(
+                bucket_name, candidate_key, expected_etag=(
+                    manifest_entry.etag if manifest_entry is not None else None
+                )
+            ) is None:
+                ranged_response = _build_ranged_response(
+                    s3_client, bucket_name, candidate_key,
+                    manifest_entry, range_spec, if_range
+                )
+                if ranged_response is not None:
+                    response = ranged_response
+                    if response["statusCode"] in ( 200, 206, 416 ):
+                        break
+                    continue
+            responseStatusCode, s3_object = get_object_cache().get_object(
+                s3_client, bucket_name, candidate_key,
+                expected_etag=(
+                    manifest_entry.etag if manifest_entry is not None else None
+                )
             )
-            # serialize_object_for_log("s3_get_response", s3_get_response)
             response["statusCode"] = responseStatusCode
             if responseStatusCode == 200:
+                content_type = s3_object.content_type
+                if content_type is None and manifest_entry is not None:
+                    content_type = manifest_entry.content_type
                 response["headers"] = {
-                    HDR_CONTENT_TYPE_KEY:
-                        s3_get_response[JSON_CONTENT_TYPE_KEY]
+                    HDR_CONTENT_TYPE_KEY: content_type
                 }
-                raw_body_stream = s3_get_response["Body"]
-                raw_body_bytes = raw_body_stream.read()
-                body_str, body_str_is_base64 = encode_body_bytes(raw_body_bytes)
-                if len(pylambda_list) == 0:
-                    pass
-                elif body_str_is_base64 is True:
-                    # Need to run the lambdas then re-encode the body
-                    for pylambda in pylambda_list:
-                        raw_body_bytes = pylambda(raw_body_bytes)
-                    body_str, body_str_is_base64 = encode_body_bytes(raw_body_bytes)
+                raw_body_bytes = s3_object.body
+                etag = s3_object.etag
+                if transform_pipeline is not None:
+                    raw_body_bytes = get_transformed_body_cache().transformed_body(
+                        transform_pipeline, bucket_name, candidate_key,
+                        s3_object.etag, raw_body_bytes
+                    )
+                    etag = transform_pipeline.derived_etag(s3_object.etag)
+                range_spec = apply_if_range(
+                    range_spec, if_range,
+                    etag, s3_object.last_modified
+                )
+                if (
+                    range_spec is not None or
+                    not fits_in_single_response(len(raw_body_bytes))
+                ):
+                    # Documents too long for a single response are
+                    # served in chunks, only the bytes of the chunk
+                    # are encoded
+                    response = build_positive_response(
+                        io.BytesIO(raw_body_bytes),
+                        range_spec,
+                        len(raw_body_bytes),
+                        content_type
+                    )
                 else:
-                    for pylambda in pylambda_list:
-                        body_str = pylambda(body_str)
-                response["body"] = body_str
-                response["isBase64Encoded"] = body_str_is_base64
+                    body_str, body_str_is_base64 = encode_body_bytes(
+                        raw_body_bytes
+                    )
+                    response["body"] = body_str
+                    response["isBase64Encoded"] = body_str_is_base64
+                if etag is not None:
+                    response["headers"][HDR_ETAG_KEY] = etag
                 break
         except botocore.exceptions.ClientError:
             pass
@@ -94,6 +494,88 @@ def _build_response_from_s3_object(
     return response
 
 
+def _stream_s3_object(key, bucket_name, default_doc_name, range_spec, if_range):
+    # Returns the prelude and body chunks of a response which streams
+    # an object, or a single range of it, to its full length, from
+    # the object cache if it holds the current version and otherwise
+    # straight from the body of the GET response.
+    # Returns None if the request is for several ranges of an object
+    # which is not cached, as S3 can only return one range.
+    s3_client = get_mockable_s3_client()
+    keys_to_try, manifest_entry = _resolve_keys(
+        s3_client, key, bucket_name, default_doc_name
+    )
+    for candidate_key in keys_to_try:
+        cached_object = get_object_cache().get_current(
+            bucket_name, candidate_key, expected_etag=(
+                manifest_entry.etag if manifest_entry is not None else None
+            )
+        )
+        if cached_object is not None:
+            headers = { HDR_ETAG_KEY: cached_object.etag }
+            if cached_object.content_type is not None:
+                headers[HDR_CONTENT_TYPE_KEY] = cached_object.content_type
+            return stream_document(
+                io.BytesIO(cached_object.body),
+                apply_if_range(
+                    range_spec, if_range,
+                    cached_object.etag, cached_object.last_modified
+                ),
+                len(cached_object.body), headers
+            )
+        get_object_params = { "Bucket": bucket_name, "Key": candidate_key }
+        if range_spec is not None:
+            if "," in range_spec:
+                return None
+            if if_range is None:
+                get_object_params["Range"] = range_spec
+            elif if_range.strip().startswith('"'):
+                # If the object has changed since the client's copy
+                # the GET fails and the whole object is fetched
+                get_object_params["Range"] = range_spec
+                get_object_params["IfMatch"] = if_range.strip()
+        debug_log("Streaming %s of %s",get_object_params.get("Range"),candidate_key)
+        try:
+            with phase(PHASE_S3_GET):
+                try:
+                    s3_get_response = s3_client.get_object(**get_object_params)
+                except botocore.exceptions.ClientError as e:
+                    if (
+                        e.response.get("Error",{}).get("Code") !=
+                        "PreconditionFailed" or
+                        "IfMatch" not in get_object_params
+                    ):
+                        raise
+                    s3_get_response = s3_client.get_object(
+                        Bucket=bucket_name, Key=candidate_key
+                    )
+        except botocore.exceptions.ClientError as e:
+            error = e.response.get("Error",{})
+            if error.get("Code") == "InvalidRange" and "ActualObjectSize" in error:
+                return split_buffered_response(build_unsatisfiable_range_response(
+                    range_spec, int(error["ActualObjectSize"])
+                ))
+            continue
+        status_code = s3_get_response["ResponseMetadata"]["HTTPStatusCode"]
+        if status_code not in ( 200, 206 ):
+            continue
+        headers = { "Accept-Ranges": "bytes" }
+        content_type = s3_get_response.get(JSON_CONTENT_TYPE_KEY)
+        if content_type is None and manifest_entry is not None:
+            content_type = manifest_entry.content_type
+        headers[HDR_CONTENT_TYPE_KEY] = content_type or "application/octet-stream"
+        if s3_get_response.get("ETag") is not None:
+            headers[HDR_ETAG_KEY] = s3_get_response["ETag"]
+        if "ContentLength" in s3_get_response:
+            headers["Content-Length"] = s3_get_response["ContentLength"]
+        if "ContentRange" in s3_get_response:
+            headers["Content-Range"] = s3_get_response["ContentRange"]
+        return (
+            { "statusCode": status_code, "headers": headers },
+            read_stream_chunks(s3_get_response["Body"])
+        )
+    return split_buffered_response({ "statusCode": 404 })
+
 
 def _save_event_to_s3_object(
     event,
@@ -124,8 +606,79 @@ def respond_on_exception_in_handler(e, request_path, request_method):
     }
 
 
+def _not_found_response(request_path, request_method):
+    # For security we send the same document not found
+    # response whether or a content bucket is not deployed
+    # in this integration, or whether one is deployed but
+    # the lookup into it fails.
+    return {
+        "statusCode": 404,
+        "headers":  {'Content-Type': 'text/plain'},
+        "body": "document not found at path %s for method %s" % (
+            request_path, request_method
+        )
+    }
+
+
 def lambda_handler(event, context):
-    logger.setLevel(logging.INFO)
+    begin_request_log()
+    begin_request_timing("simple")
+    return end_request_timing(handle_request(event, context))
+
+
+def streaming_lambda_handler(event, context):
+    # Alternative entry point which returns a generator yielding
+    # the response in the Lambda response streaming format (see
+    # streaming.py)
+    begin_request_log()
+    begin_request_timing("simple")
+    prelude, body_chunks = stream_request(event, context)
+    # Timings cover the work done before the body is streamed
+    return streamed_response(end_request_timing(prelude), body_chunks)
+
+
+def stream_request(event, context):
+    # Streaming counterpart of handle_request, which returns the
+    # prelude of the response and a generator of the chunks of its
+    # body.  Objects are streamed in chunks to their full length,
+    # rather than being returned a chunk per request as they are by
+    # handle_request, other responses are built by handle_request.
+    request_path = event["requestContext"]["http"]["path"]
+    if len(request_path) == 0:
+        request_path = "/"
+    request_method = event["requestContext"]["http"]["method"]
+    if "GET" != request_method:
+        return split_buffered_response(handle_request(event, context))
+    content_bucket_name = os.environ.get(ENVVAR_CONTENT_BUCKET_NAME, "")
+    if len(content_bucket_name) == 0:
+        content_bucket_name = "dummy"
+    try:
+        streamed = _stream_s3_object(
+            key=request_path,
+            bucket_name=content_bucket_name,
+            default_doc_name=os.environ.get(ENVVAR_DEFAULT_DOCUMENT_NAME, None),
+            range_spec=get_http_header(event,"Range",None),
+            if_range=get_http_header(event,"If-Range",None)
+        )
+        if streamed is None:
+            return split_buffered_response(handle_request(event, context))
+        prelude, body_chunks = streamed
+        if prelude["statusCode"] not in (200, 206, 416):
+            prelude, body_chunks = split_buffered_response(
+                _not_found_response(request_path, request_method)
+            )
+        prelude = apply_cache_control(request_path, prelude)
+        serialize_object_for_log("streamed_response_prelude", prelude)
+    except Exception as e:
+        prelude, body_chunks = split_buffered_response(
+            respond_on_exception_in_handler(e, request_path, request_method)
+        )
+    return prelude, body_chunks
+
+
+def handle_request(event, context):
+    # Serves a request without any per-request logging setup, so
+    # that the caching handler can delegate requests here.
     # For unit tests, we supply a mock s3 client object which accepts
     # the same messages as the real client and gives approximately
     # the same responses.
@@ -150,17 +703,9 @@ def lambda_handler(event, context):
         request_method = event["requestContext"]["http"]["method"]
 
         if "GET" == request_method:
-            # For security we send the same document not found
-            # response whether or a content bucket is not deployed
-            # in this integration, or whether one is deployed but
-            # the lookup into it fails.
-            not_found_response = {
-                "statusCode": 404,
-                "headers":  {'Content-Type': 'text/plain'},
-                "body": "document not found at path %s for method %s" % (
-                    request_path, request_method
-                )
-            }
+            not_found_response = _not_found_response(
+                request_path, request_method
+            )
             if content_bucket_name is None:
                 response = not_found_response
             else:
@@ -168,11 +713,13 @@ def lambda_handler(event, context):
                     content_bucket_response = _build_response_from_s3_object(
                         key=request_path,
                         bucket_name=content_bucket_name,
-                        default_doc_name=default_doc_name
+                        default_doc_name=default_doc_name,
+                        range_spec=get_http_header(event,"Range",None),
+                        if_range=get_http_header(event,"If-Range",None)
                     )
                     response = content_bucket_response
                     #debug_log({"content_bucket_response":str(content_bucket_response)})
-                    if response.get("statusCode", -1) != 200:
+                    if response.get("statusCode", -1) not in (200, 206, 416):
                         response = not_found_response
                 except botocore.exceptions.ClientError as e:
                     if str(e).endswith('Access Denied') is False:
@@ -204,20 +751,12 @@ def lambda_handler(event, context):
             }
             response = error_response
 
-        if "body" in response:
-            # assert isinstance(response["body"], str)
-            pass
-            
-        request_log_object = {
-            "AWS_EVENT": event,
-            "RESPONSE": response
-        }
+        response = apply_cache_control(request_path, response)
 
-        # serialize_object_for_log("request_log_object", request_log_object)
+        serialize_response_for_log("response", response)
         s3_client = None
     except Exception as e:
         response = respond_on_exception_in_handler(
             e, request_path, request_method
         )
-    logger.setLevel(logging.INFO)
     return response
@@ -0,0 +1,157 @@
+# python3
+# waste/handler/streaming.py
+
+# Copyright Tim Littlefair 2020-
+# This file is open source software under the MIT license.
+# For terms of this license, see the file LICENSE in the source
+# code distribution or visit
+# https://opensource.org/licenses/mit-license.php
+
+# This file contains definitions which support returning responses
+# in the Lambda response streaming format, in which the handler
+# yields the response as a sequence of byte strings: a JSON
+# prelude containing the status code and headers, a delimiter of
+# eight NUL bytes, and then the body, unencoded, in chunks.
+# Streamed bodies are not subject to the 6MB limit on buffered
+# responses, so documents are returned in a single response
+# without base64 encoding.
+# The AWS managed python runtimes do not support response
+# streaming, so a streaming handler must be run under a runtime
+# which does (e.g. a custom runtime or the Lambda Web Adapter).
+# collect_streamed_response is a local harness which consumes a
+# streamed response so that streaming handlers can be tested
+# without AWS.
+
+import base64
+import json
+import uuid
+
+from .shared import HDR_CONTENT_TYPE_KEY
+from .shared import debug_log
+from .shared import resolve_range_spec, build_unsatisfiable_range_response
+from .shared import multipart_part_header, multipart_trailer
+
+STREAMING_PRELUDE_DELIMITER = bytes(8)
+
+_DEFAULT_STREAM_CHUNK_SIZE = 65536
+
+
+def _read_chunks(stream, range_start, range_stop, chunk_size):
+    stream.seek(range_start)
+    remaining = range_stop - range_start
+    while remaining > 0:
+        chunk = stream.read(min(remaining, chunk_size))
+        if len(chunk) == 0:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+def read_stream_chunks(stream, chunk_size=_DEFAULT_STREAM_CHUNK_SIZE):
+    # Generates the chunks of a stream which cannot seek (e.g. the
+    # body of an S3 GET response) to its end, then closes it
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            yield chunk
+    finally:
+        stream.close()
+
+def _multipart_chunks(stream, byte_ranges, doc_len, boundary, content_type, chunk_size):
+    for range_start, range_stop in byte_ranges:
+        yield multipart_part_header(
+            boundary, content_type, range_start, range_stop, doc_len
+        )
+        yield from _read_chunks(stream, range_start, range_stop, chunk_size)
+        yield b"\r\n"
+    yield multipart_trailer(boundary)
+
+def stream_document(
+    stream, range_spec, doc_len, headers,
+    chunk_size=_DEFAULT_STREAM_CHUNK_SIZE
+):
+    # Returns the prelude (status code and headers) for a response
+    # serving the range(s) of a document requested by range_spec,
+    # and a generator of the chunks of its body.
+    # Nothing is read from stream until the generator is consumed.
+    prelude = { "statusCode": 200, "headers": dict(headers) }
+    prelude["headers"]["Accept-Ranges"] = "bytes"
+    content_type = prelude["headers"].setdefault(
+        HDR_CONTENT_TYPE_KEY, "application/octet-stream"
+    )
+    byte_ranges = resolve_range_spec(range_spec, doc_len)
+    if byte_ranges is None:
+        byte_ranges = [ (0, doc_len) ]
+    elif len(byte_ranges) == 0:
+        return split_buffered_response(
+            build_unsatisfiable_range_response(range_spec, doc_len)
+        )
+    debug_log("Streaming ranges %s of %d bytes",byte_ranges,doc_len)
+    if len(byte_ranges) > 1:
+        boundary = uuid.uuid4().hex
+        prelude["statusCode"] = 206
+        prelude["headers"][HDR_CONTENT_TYPE_KEY] = (
+            "multipart/byteranges; boundary=" + boundary
+        )
+        return prelude, _multipart_chunks(
+            stream, byte_ranges, doc_len, boundary, content_type, chunk_size
+        )
+    range_start, range_stop = byte_ranges[0]
+    if range_start != 0 or range_stop != doc_len:
+        prelude["statusCode"] = 206
+        prelude["headers"]["Content-Range"] = "bytes %d-%d/%d" % (
+            range_start, range_stop - 1, doc_len
+        )
+    prelude["headers"]["Content-Length"] = range_stop - range_start
+    return prelude, _read_chunks(stream, range_start, range_stop, chunk_size)
+
+def split_buffered_response(response):
+    # Converts a buffered response into a prelude and a body generator
+    prelude = {
+        "statusCode": response["statusCode"],
+        "headers": response.get("headers", {})
+    }
+    body = response.get("body", "")
+    if response.get("isBase64Encoded", False) is True:
+        body = base64.b64decode(body)
+    elif isinstance(body, str):
+        body = body.encode("utf-8")
+    return prelude, iter([ body ])
+
+def streamed_response(prelude, body_chunks):
+    # Generates the byte strings of a response in the
+    # Lambda response streaming format
+    yield json.dumps(prelude).encode("utf-8") + STREAMING_PRELUDE_DELIMITER
+    for chunk in body_chunks:
+        if len(chunk) > 0:
+            yield chunk
+
+def collect_streamed_response(streamed_chunks):
+    # Local harness: consumes a response in the Lambda response
+    # streaming format and returns it as a dictionary like a buffered
+    # response, except that the body is bytes and there is an extra
+    # item containing the number of body chunks received.
+    prelude_bytes = bytes()
+    prelude = None
+    body_chunks = []
+    for chunk in streamed_chunks:
+        # Chunks of memory-mapped cache entries are memoryviews
+        assert isinstance(chunk, (bytes, memoryview))
+        if prelude is None:
+            prelude_bytes += chunk
+            prelude_json, delimiter, body_start = prelude_bytes.partition(
+                STREAMING_PRELUDE_DELIMITER
+            )
+            if len(delimiter) == 0:
+                continue
+            prelude = json.loads(prelude_json.decode("utf-8"))
+            if len(body_start) > 0:
+                body_chunks += [ body_start ]
+        else:
+            body_chunks += [ bytes(chunk) ]
+    assert prelude is not None
+    response = dict(prelude)
+    response["body"] = b"".join(body_chunks)
+    response["bodyChunkCount"] = len(body_chunks)
+    return response
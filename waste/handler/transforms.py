@@ -0,0 +1,103 @@
+# python3
+# waste/handler/transforms.py
+
+# Copyright Tim Littlefair 2020-
+# This file is open source software under the MIT license.
+# For terms of this license, see the file LICENSE in the source
+# code distribution or visit
+# https://opensource.org/licenses/mit-license.php
+
+# This file implements transform pipelines, which rewrite the bodies
+# of the objects the simple handler serves (e.g. templating or link
+# rewriting).
+# A pipeline has a name and a version, and its output for each
+# version of each object is memoized, keyed by the object's ETag
+# and the pipeline's name and version, so each transform runs once
+# per version of an object rather than on every request.  The
+# version of a pipeline must be changed whenever the behaviour of
+# any of its transforms changes.
+# As for the pylambda_list which pipelines replace, transforms are
+# applied in turn to the whole body, as a str if it is valid UTF-8,
+# otherwise as bytes.
+
+from .shared import ByteBudgetLRU, cache_memory_budget, debug_log
+from .metrics import phase, PHASE_TRANSFORM
+
+
+class Transform:
+
+    def __init__(self, name, function):
+        self.name = name
+        self.function = function
+
+
+class TransformPipeline:
+
+    def __init__(self, name, version, transforms):
+        # transforms are Transform objects or plain functions.
+        # A pipeline whose version is None is not memoized.
+        self.name = name
+        self.version = version
+        self.transforms = [
+            transform if isinstance(transform, Transform)
+            else Transform(getattr(transform, "__name__", "transform"), transform)
+            for transform in transforms
+        ]
+
+    def is_memoizable(self):
+        return self.version is not None
+
+    def derived_etag(self, etag):
+        # Returns the entity tag of the output of the pipeline for
+        # the version of an object with the given entity tag
+        if etag is None or not self.is_memoizable():
+            return None
+        return '"%s-%s-%s"' % (etag.strip('"'), self.name, self.version)
+
+    def apply(self, body_bytes):
+        # Returns the transformed body as bytes
+        try:
+            body = str(body_bytes, 'utf-8')
+        except UnicodeDecodeError:
+            body = bytes(body_bytes)
+        with phase(PHASE_TRANSFORM):
+            for transform in self.transforms:
+                body = transform.function(body)
+        if isinstance(body, str):
+            return body.encode("utf-8")
+        return body
+
+
+class TransformedBodyCache(ByteBudgetLRU):
+    # LRU of the outputs of memoizable pipelines
+
+    def __init__(self, byte_budget=None):
+        if byte_budget is None:
+            byte_budget = cache_memory_budget("transformed_bodies")
+        super().__init__(byte_budget)
+
+    def _cost(self, body_bytes):
+        return len(body_bytes)
+
+    def transformed_body(self, pipeline, bucket_name, key, etag, body_bytes):
+        if etag is None or not pipeline.is_memoizable():
+            return pipeline.apply(body_bytes)
+        cache_key = ( bucket_name, key, etag, pipeline.name, pipeline.version )
+        transformed_body_bytes = self._lookup(cache_key)
+        if transformed_body_bytes is None:
+            debug_log(
+                "Applying pipeline %s version %s to %s",
+                pipeline.name, pipeline.version, key
+            )
+            transformed_body_bytes = pipeline.apply(body_bytes)
+            self._store(cache_key, transformed_body_bytes)
+        return transformed_body_bytes
+
+
+_transformed_body_cache = None
+
+def get_transformed_body_cache():
+    global _transformed_body_cache
+    if _transformed_body_cache is None:
+        _transformed_body_cache = TransformedBodyCache()
+    return _transformed_body_cache
@@ -0,0 +1,181 @@
+# python3
+# waste/handler/wpack.py
+
+# Copyright Tim Littlefair 2020-
+# This file is open source software under the MIT license.
+# For terms of this license, see the file LICENSE in the source
+# code distribution or visit
+# https://opensource.org/licenses/mit-license.php
+
+# This file defines the .wpack cache archive format, which is
+# designed to be served from rather than to be a general purpose
+# archive.
+# A .wpack file consists of
+#  - the 8 byte signature WPACK_SIGNATURE,
+#  - the length of the index as a 4 byte little-endian integer,
+#  - the index, a UTF-8 JSON object,
+#  - the bodies of the entries, uncompressed, at the offsets
+#    given in the index.
+# The index holds everything needed to serve an entry without
+# reading it: for each entry its path, offset, length, content
+# type, ETag, modification time, whether it is valid UTF-8 text
+# and the paths of the entries holding precompressed variants
+# of it, e.g.
+# { "entries": [
+#     { "path": "/index.html", "offset": 1234, "length": 5678,
+#       "content_type": "text/html", "etag": "\"...\"",
+#       "last_modified": 1600000000, "is_text": true,
+#       "encodings": { "gzip": "/index.html.gz" } },
+#     { "path": "/index.html.gz", ... }
+# ] }
+# so a .wpack file can be loaded with one read of the index (or
+# by memory-mapping the file) and one json.loads call.
+
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import struct
+
+WPACK_FILE_EXT = ".wpack"
+WPACK_SIGNATURE = b"WPACK\x00\x01\x00"
+_WPACK_HEADER_FORMAT = "<8sI"
+_WPACK_HEADER_SIZE = struct.calcsize(_WPACK_HEADER_FORMAT)
+
+# Text entries at least this long are given a gzip variant if
+# it saves at least a tenth of their length
+_MIN_VARIANT_SOURCE_SIZE = 1024
+_MIN_VARIANT_SAVING = 0.1
+
+
+class WpackEntry:
+    # Index record of an entry in a .wpack archive
+
+    def __init__(self, index_record):
+        self.filename = index_record["path"]
+        self.offset = index_record["offset"]
+        self.file_size = index_record["length"]
+        self.content_type = index_record.get("content_type")
+        self.etag = index_record["etag"]
+        self.last_modified = datetime.datetime.fromtimestamp(
+            index_record["last_modified"], tz=datetime.timezone.utc
+        )
+        self.is_text = index_record.get("is_text")
+        self.encodings = index_record.get("encodings", {})
+
+    def is_dir(self):
+        return False
+
+
+class WpackArchive:
+    # Reads a .wpack archive from a seekable stream.
+    # Implements the subset of the zipfile.ZipFile interface which
+    # the cache uses.
+
+    def __init__(self, stream):
+        self._stream = stream
+        stream.seek(0)
+        signature, index_length = struct.unpack(
+            _WPACK_HEADER_FORMAT, stream.read(_WPACK_HEADER_SIZE)
+        )
+        if signature != WPACK_SIGNATURE:
+            raise ValueError("Stream does not contain a .wpack archive")
+        index = json.loads(stream.read(index_length))
+        self._entries = [
+            WpackEntry(index_record) for index_record in index["entries"]
+        ]
+        self._entries_by_name = {
+            entry.filename: entry for entry in self._entries
+        }
+
+    def infolist(self):
+        return list(self._entries)
+
+    def getinfo(self, name):
+        return self._entries_by_name[name]
+
+    def read(self, name):
+        entry = self._entries_by_name[name]
+        self._stream.seek(entry.offset)
+        return self._stream.read(entry.file_size)
+
+    def open(self, name, mode="r"):
+        return io.BytesIO(self.read(name))
+
+
+def _is_text(body_bytes):
+    try:
+        body_bytes.decode("utf-8")
+        return True
+    except UnicodeDecodeError:
+        return False
+
+def prepare_entry(path, body_bytes, last_modified):
+    # Returns a list of (index record, body bytes) tuples for an
+    # entry and, if it is text and gzip saves enough to be
+    # worthwhile, a gzip variant of it.
+    # The offsets are filled in by write_prepared_wpack.
+    # This is where the work of building an archive is done, so
+    # builders can call it in parallel.
+    def index_record(path, body_bytes, content_type, is_text):
+        return {
+            "path": path,
+            "length": len(body_bytes),
+            "content_type": content_type,
+            "etag": '"%s"' % (hashlib.sha256(body_bytes).hexdigest()[:32],),
+            "last_modified": int(last_modified),
+            "is_text": is_text,
+        }
+    content_type, _ = mimetypes.guess_type(path, strict=True)
+    is_text = _is_text(body_bytes)
+    prepared_entries = [
+        ( index_record(path, body_bytes, content_type, is_text), body_bytes )
+    ]
+    if is_text and len(body_bytes) >= _MIN_VARIANT_SOURCE_SIZE:
+        gzip_bytes = gzip.compress(body_bytes, mtime=0)
+        if len(gzip_bytes) <= len(body_bytes) * (1 - _MIN_VARIANT_SAVING):
+            prepared_entries[0][0]["encodings"] = { "gzip": path + ".gz" }
+            prepared_entries += [ (
+                index_record(path + ".gz", gzip_bytes, "application/gzip", False),
+                gzip_bytes
+            ) ]
+    return prepared_entries
+
+def write_prepared_wpack(output_stream, prepared_entries):
+    # Writes a .wpack archive containing the (index record, body
+    # bytes) tuples returned by prepare_entry.
+    # Returns the index which was written.
+    index_records = [ index_record for index_record, _ in prepared_entries ]
+    # The offsets depend on the length of the index, which depends
+    # on the offsets, so the index is laid out with offsets which
+    # are too long and the bodies placed after it
+    for index_record in index_records:
+        index_record["offset"] = 0xffffffffff
+    index_length = len(json.dumps({ "entries": index_records }).encode("utf-8"))
+    offset = _WPACK_HEADER_SIZE + index_length
+    for index_record in index_records:
+        index_record["offset"] = offset
+        offset += index_record["length"]
+    index_bytes = json.dumps({ "entries": index_records }).encode("utf-8")
+    # Pad the index so that the bodies start where they were laid out
+    index_bytes += b" " * (index_length - len(index_bytes))
+    output_stream.write(struct.pack(
+        _WPACK_HEADER_FORMAT, WPACK_SIGNATURE, len(index_bytes)
+    ))
+    output_stream.write(index_bytes)
+    for _, body_bytes in prepared_entries:
+        output_stream.write(body_bytes)
+    return index_records
+
+def write_wpack(output_stream, entries):
+    # Writes a .wpack archive containing entries, an iterable of
+    # (path, body bytes, modification time as a POSIX timestamp)
+    # tuples, adding gzip variants of text entries where they save
+    # enough to be worthwhile.
+    # Returns the index which was written.
+    prepared_entries = []
+    for path, body_bytes, last_modified in entries:
+        prepared_entries += prepare_entry(path, body_bytes, last_modified)
+    return write_prepared_wpack(output_stream, prepared_entries)